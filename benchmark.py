@@ -0,0 +1,402 @@
+import argparse
+import collections
+import concurrent.futures
+import gzip
+import json
+import os
+import resource
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import copy_formats
+import json_backend
+import metrics
+import preprocess
+import preprocess_batch
+import schema
+import sinks
+from generate_data import ExportGenerator
+from id_set import IdSet
+from utils import not_duplicate
+
+
+def measure(func, *args):
+    # returns (seconds, peak python heap growth in bytes, result), tracemalloc slows
+    # allocations down a lot, so time and memory are taken from two separate runs
+    start = time.perf_counter()
+    func(*args)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    result = func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak, result
+
+
+def bench_id_set(num_ids=5000000, duplicate_rate=0.1, batch_size=1000):
+    rng = np.random.default_rng(0)
+    # tweet-like ids, a part of them repeated as in the conversation dumps
+    ids = rng.integers(1400000000000000000, 1600000000000000000, size=num_ids, dtype=np.int64)
+    num_dup = int(num_ids * duplicate_rate)
+    ids[rng.choice(num_ids, num_dup, replace=False)] = ids[rng.choice(num_ids, num_dup)]
+    id_list = ids.tolist()
+
+    def dict_dedup():
+        all_ids = {}
+        new = sum(not_duplicate(all_ids, i) for i in id_list)
+        return all_ids, new
+
+    def id_set_scalar():
+        all_ids = IdSet()
+        new = sum(all_ids.add(i) for i in id_list)
+        return all_ids, new
+
+    def id_set_batch():
+        all_ids = IdSet()
+        new = 0
+        for start in range(0, num_ids, batch_size):
+            new += int(all_ids.add_and_test(ids[start:start+batch_size]).sum())
+        return all_ids, new
+
+    print(f"{'dedup':<16}{'ids/s':>14}{'peak MB':>10}{'MB held':>10}{'unique':>12}")
+    for name, func in [("dict", dict_dedup), ("IdSet.add", id_set_scalar), ("IdSet batch", id_set_batch)]:
+        elapsed, peak, (all_ids, new) = measure(func)
+
+        if isinstance(all_ids, IdSet):
+            held = all_ids.nbytes()
+        else:
+            # dict table plus the int keys themselves
+            held = all_ids.__sizeof__() + sum(k.__sizeof__() for k in all_ids)
+
+        print(f"{name:<16}{num_ids / elapsed:>14,.0f}{peak / 2**20:>10.1f}{held / 2**20:>10.1f}{new:>12}")
+
+
+def tweet_json_lines(num_lines=20000):
+    # lines shaped like the conversations export, with hashtags, annotations,
+    # urls, context annotations, references and non-ascii text
+    rng = np.random.default_rng(0)
+    lines = []
+    for i in range(num_lines):
+        tweet_id = str(1496000000000000000 + i)
+        obj = {
+            "id": tweet_id,
+            "author_id": str(int(rng.integers(10**8, 10**18))),
+            "conversation_id": tweet_id,
+            "created_at": "2022-02-24T06:51:13.000Z",
+            "lang": "uk",
+            "possibly_sensitive": False,
+            "reply_settings": "everyone",
+            "source": "Twitter for Android",
+            "text": "RT @user: Слава Україні! Putin's forces are moving towards #Kyiv #Ukraine https://t.co/abcdefghij " * 2,
+            "public_metrics": {"retweet_count": int(rng.integers(0, 10**5)), "reply_count": 0, "like_count": 3, "quote_count": 0},
+            "entities": {
+                "hashtags": [{"start": 60, "end": 65, "tag": "Kyiv"}, {"start": 66, "end": 74, "tag": "Ukraine"}],
+                "annotations": [{"start": 40, "end": 45, "probability": 0.9871, "type": "Place", "normalized_text": "Kyiv"}],
+                "mentions": [{"start": 3, "end": 8, "username": "user", "id": "123456789"}],
+                "urls": [{"start": 75, "end": 98, "url": "https://t.co/abcdefghij",
+                          "expanded_url": "https://www.example.com/world/2022/02/24/ukraine-russia",
+                          "display_url": "example.com/world/2022/02/2…", "status": 200,
+                          "title": "Russia attacks Ukraine", "description": "Live updates", "unwound_url": "https://www.example.com/"}],
+            },
+            "context_annotations": [
+                {"domain": {"id": "123", "name": "Politician", "description": "Politicians in the world, like Joe Biden"},
+                 "entity": {"id": "1060", "name": "Vladimir Putin"}},
+                {"domain": {"id": "131", "name": "Unified Twitter Taxonomy", "description": "A taxonomy view into the Twitter interests graph"},
+                 "entity": {"id": "1270", "name": "Ukraine"}},
+            ],
+            "referenced_tweets": [{"type": "retweeted", "id": str(1495000000000000000 + i)}],
+        }
+        lines.append(json.dumps(obj, ensure_ascii=False).encode("utf-8") + b"\n")
+    return lines
+
+
+def bench_json(num_lines=20000, repeat=5):
+    lines = tweet_json_lines(num_lines)
+    mbytes = sum(len(line) for line in lines) * repeat / 2**20
+
+    print(f"{'backend':<12}{'lines/s':>14}{'MB/s':>10}")
+    for name in json_backend.BACKENDS:
+        try:
+            _, loads = json_backend.pick_backend(name)
+        except ImportError:
+            print(f"{name:<12}{'not installed':>24}")
+            continue
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for line in lines:
+                loads(line)
+        elapsed = time.perf_counter() - start
+
+        print(f"{name:<12}{num_lines * repeat / elapsed:>14,.0f}{mbytes / elapsed:>10.1f}")
+    print(f"importers use '{json_backend.BACKEND_NAME}'")
+
+
+def bench_preprocess(num_lines=20000, batch_size=1000):
+    lines = tweet_json_lines(num_lines)
+
+    def per_row(objs):
+        return [preprocess.prepare_conversation(o, prepare_other_models=True) for o in objs]
+
+    def batched(objs):
+        return [preprocess_batch.prepare_conversations_batch(objs[i:i+batch_size], prepare_other_models=True)
+                for i in range(0, len(objs), batch_size)]
+
+    print(f"{'preprocess':<12}{'rows/s':>14}")
+    for name, func in [("per-row", per_row), ("batch", batched)]:
+        # both versions may mutate the parsed objects, so each gets a fresh copy
+        objs = [json_backend.loads(line) for line in lines]
+
+        start = time.perf_counter()
+        func(objs)
+        elapsed = time.perf_counter() - start
+
+        print(f"{name:<12}{num_lines / elapsed:>14,.0f}")
+
+
+def bench_strings(num_lines=20000, repeat=5):
+    # make_string_valid on the text columns of the conversations, the full conversion
+    # every string used to get, the per-value fast path and the column version
+    from utils import _make_string_valid, make_string_valid, make_strings_valid
+
+    objs = [json_backend.loads(line) for line in tweet_json_lines(num_lines)]
+    columns = {
+        "content": [o["text"] for o in objs],
+        "source": [o["source"] for o in objs],
+        "tag": [h["tag"] for o in objs for h in o["entities"]["hashtags"]],
+        "title": [u["title"] for o in objs for u in o["entities"]["urls"]],
+    }
+
+    print(f"{'column':<12}{'full /s':>14}{'per-value /s':>16}{'column /s':>14}")
+    for name, values in columns.items():
+        rates = []
+        for func in [lambda: [_make_string_valid(v) for v in values],
+                     lambda: [make_string_valid(v) for v in values],
+                     lambda: make_strings_valid(values)]:
+            start = time.perf_counter()
+            for _ in range(repeat):
+                func()
+            rates.append(len(values) * repeat / (time.perf_counter() - start))
+        print(f"{name:<12}{rates[0]:>14,.0f}{rates[1]:>16,.0f}{rates[2]:>14,.0f}")
+
+
+class _Rows(list):
+    # stands in for a writer, collects the rows the router passes to it
+    def extend(self, rows):
+        if rows is not None:
+            super().extend(rows)
+
+
+def copy_benchmark_rows(num_lines=20000):
+    # rows of every table filled from the exports, keyed by copy query
+    import import_data
+
+    writers = collections.defaultdict(_Rows)
+    router = import_data.ConversationRouter(IdSet())
+    for line in tweet_json_lines(num_lines):
+        router.route(preprocess.prepare_conversation(json_backend.loads(line), prepare_other_models=True), writers)
+
+    rng = np.random.default_rng(0)
+    writers["authors"] = [
+        preprocess.prepare_authors({
+            "id": str(10**8 + i),
+            "name": "Олена Коваленко",
+            "username": f"user_{i}",
+            "description": "Journalist. Views are my own. https://t.co/abcdefghij",
+            "public_metrics": {"followers_count": int(rng.integers(0, 10**6)), "following_count": 120,
+                               "tweet_count": 5230, "listed_count": 4},
+        })
+        for i in range(num_lines)
+    ]
+
+    return {
+        copy_query: (table_name, writers[writer_name])
+        for writer_name, table_name, copy_query in import_data.conversation_export_writers(bulk_load=True)
+    }
+
+
+def bench_copy(num_lines=20000, repeat=3):
+    # needs the database from .env, every table is copied into a temporary table of the
+    # same name, without constraints, so only the COPY itself is measured
+    import import_data
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    tables = copy_benchmark_rows(num_lines)
+
+    print(f"{'table':<24}{'rows':>8}" + "".join(f"{f + ' rows/s':>22}" for f in copy_formats.COPY_FORMATS))
+    with import_data.connect() as connection:
+        with connection.cursor() as cursor:
+            for copy_query, (table_name, rows) in tables.items():
+                cursor.execute(schema.create_table_sql(table_name, bulk_load=True, temporary=True))
+
+                rates = []
+                for format_name in copy_formats.COPY_FORMATS:
+                    best = None
+                    for _ in range(repeat):
+                        cursor.execute(f"TRUNCATE {table_name}")
+                        connection.commit()
+
+                        start = time.perf_counter()
+                        copy_formats.copy_rows(cursor, copy_query, rows, format_name)
+                        connection.commit()
+                        elapsed = time.perf_counter() - start
+                        best = elapsed if best is None else min(best, elapsed)
+                    rates.append(len(rows) / best if best > 0 else 0)
+
+                print(f"{table_name:<24}{len(rows):>8}" + "".join(
+                    f"{rate:>14,.0f} ({rate / rates[0]:.2f}x)" for rate in rates))
+
+
+def generated_exports(num_lines, data_dir="./benchmark_data"):
+    # the exports of generate_data.py, written once per size and reused
+    out_dir = os.path.join(data_dir, str(num_lines))
+    paths = [os.path.join(out_dir, "authors.jsonl.gz"), os.path.join(out_dir, "conversations.jsonl.gz")]
+    if not all(os.path.exists(p) for p in paths):
+        ExportGenerator(num_conversations=num_lines, num_authors=max(num_lines // 5, 1)).write(out_dir)
+    return paths
+
+
+def read_export(path):
+    with gzip.open(path, "rb") as f:
+        return [json_backend.loads(line) for line in f]
+
+
+def bench_prepare(num_lines=20000):
+    # every prepare_* function on its own, the functions below prepare_conversation
+    # only ever see conversations it accepted
+    authors_path, conversations_path = generated_exports(num_lines)
+    authors = read_export(authors_path)
+    conversations = read_export(conversations_path)
+    valid = [i for i, obj in enumerate(conversations) if preprocess.check_conversation_validity(obj)]
+
+    functions = [
+        ("prepare_authors", preprocess.prepare_authors, authors, None),
+        ("prepare_conversation", preprocess.prepare_conversation, conversations, None),
+        ("prepare_conversation+other", lambda o: preprocess.prepare_conversation(o, prepare_other_models=True),
+         conversations, None),
+        ("prepare_hashtags", preprocess.prepare_hashtags, conversations, valid),
+        ("prepare_annotations", preprocess.prepare_annotations, conversations, valid),
+        ("prepare_links", preprocess.prepare_links, conversations, valid),
+        ("prepare_context_annotations", preprocess.prepare_context_annotations, conversations, valid),
+        ("prepare_conversation_references", preprocess.prepare_conversation_references, conversations, valid),
+    ]
+
+    print(f"{'function':<34}{'rows/s':>14}{'peak MB':>10}{'rows':>10}")
+    for name, func, objs, indexes in functions:
+        # the functions clean up the objects in place, each one gets a fresh copy
+        objs = json.loads(json.dumps(objs if indexes is None else [objs[i] for i in indexes]))
+        elapsed, peak, _ = measure(lambda: [func(o) for o in objs])
+        print(f"{name:<34}{len(objs) / elapsed:>14,.0f}{peak / 2**20:>10.1f}{len(objs):>10}")
+
+
+def _run_import(step, paths, sink, authors_ids):
+    # runs in a fresh process, so ru_maxrss is the peak of this importer alone
+    import import_data
+
+    sinks.set_sink(sink)
+    if sink == "postgres":
+        from dotenv import load_dotenv
+        load_dotenv()
+
+    authors_path, conversations_path = paths
+    steps = {
+        "drop_all_tables": lambda t: import_data.drop_all_tables(),
+        "import_authors_table": lambda t: import_data.import_authors_table(authors_path, t),
+        "import_conversation_table": lambda t: import_data.import_conversation_table(
+            conversations_path, t, authors_ids),
+        "import_hashtags": lambda t: import_data.import_hashtags(conversations_path, t),
+        "import_context_domains_entities_annotations_tables":
+            lambda t: import_data.import_context_domains_entities_annotations_tables(conversations_path, t),
+        "import_annotations_links_references_table":
+            lambda t: import_data.import_annotations_links_references_table(conversations_path, t),
+        "import_conversation_export_single_pass": lambda t: import_data.import_conversation_export_single_pass(
+            conversations_path, t, authors_ids),
+        "import_conversation_export_pipelined": lambda t: import_data.import_conversation_export_pipelined(
+            conversations_path, t, authors_ids),
+    }
+
+    start = time.time()
+    result = steps[step](start)
+    elapsed = time.time() - start
+
+    rows = sum(metrics.rows_written.values())
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+    return elapsed, rows, peak_rss, children_rss, result if step == "import_authors_table" else None
+
+
+def bench_import(num_lines=20000, sink="null"):
+    # every import_* function in the order main.py runs them, then the single pass and
+    # the pipeline, each after a fresh authors import, into one of the sinks of sinks.py;
+    # with sink="postgres" into the database from .env, whose tables are dropped first
+    paths = [os.path.abspath(p) for p in generated_exports(num_lines)]
+
+    modes = [
+        ["import_authors_table", "import_conversation_table", "import_hashtags",
+         "import_context_domains_entities_annotations_tables", "import_annotations_links_references_table"],
+        ["import_authors_table", "import_conversation_export_single_pass"],
+        ["import_authors_table", "import_conversation_export_pipelined"],
+    ]
+
+    # ./ids, ./logs, ./checkpoints and the files of the file sink go to a scratch directory
+    cwd = os.getcwd()
+    work_dir = tempfile.mkdtemp(prefix="pdt-benchmark-")
+    os.chdir(work_dir)
+    try:
+        print(f"{'function':<52}{'seconds':>9}{'rows/s':>12}{'rows':>10}{'peak RSS MB':>13}{'children MB':>13}")
+        for steps in modes:
+            for directory in ["./ids", "./checkpoints"]:
+                shutil.rmtree(directory, ignore_errors=True)
+            if sink == "postgres":
+                steps = ["drop_all_tables"] + steps
+
+            authors_ids = None
+            for step in steps:
+                with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+                    elapsed, rows, peak_rss, children_rss, result = executor.submit(
+                        _run_import, step, paths, sink, authors_ids).result()
+                if step == "import_authors_table":
+                    authors_ids = result
+                if step == "drop_all_tables":
+                    continue
+
+                print(f"{step:<52}{elapsed:>9.2f}{rows / elapsed if elapsed > 0 else 0:>12,.0f}{rows:>10}"
+                      f"{peak_rss / 2**20:>13.1f}{children_rss / 2**20:>13.1f}")
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+BENCHMARKS = {
+    "id_set": bench_id_set,
+    "json": bench_json,
+    "preprocess": bench_preprocess,
+    "strings": bench_strings,
+    "copy": bench_copy,
+    "prepare": bench_prepare,
+    "import": bench_import,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmarks", nargs="*", default=list(BENCHMARKS.keys()))
+    parser.add_argument("--lines", type=int, default=20000,
+                        help="conversations generated for the 'prepare' and 'import' benchmarks")
+    parser.add_argument("--sink", choices=sinks.SINKS, default="null",
+                        help="where the 'import' benchmark writes, 'null' only counts the rows")
+    args = parser.parse_args()
+
+    options = {
+        "prepare": {"num_lines": args.lines},
+        "import": {"num_lines": args.lines, "sink": args.sink},
+    }
+    for name in args.benchmarks:
+        print(f"...Running '{name}' benchmark...")
+        BENCHMARKS[name](**options.get(name, {}))
@@ -0,0 +1,110 @@
+import os
+import pickle
+
+
+CHECKPOINT_DIR = "./checkpoints"
+
+CREATE_CHECKPOINTS = """
+    CREATE TABLE IF NOT EXISTS import_checkpoints (
+    importer text PRIMARY KEY,
+    next_line int8 NOT NULL,
+    state_path text NOT NULL,
+    finished bool NOT NULL,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+"""
+UPSERT_CHECKPOINT = """
+    INSERT INTO import_checkpoints (importer, next_line, state_path, finished, updated_at)
+    VALUES (%s, %s, %s, %s, now())
+    ON CONFLICT (importer) DO UPDATE SET
+    next_line = EXCLUDED.next_line,
+    state_path = EXCLUDED.state_path,
+    finished = EXCLUDED.finished,
+    updated_at = EXCLUDED.updated_at
+"""
+
+
+def checkpoint_name(importer_name, row_range):
+    # every shard of an export keeps its own checkpoint
+    if row_range[0] == 0:
+        return importer_name
+    return f"{importer_name}-{row_range[0]}"
+
+
+class Checkpoint:
+    def __init__(self, next_line, state, finished):
+        self.next_line = next_line
+        self.state = state
+        self.finished = finished
+
+
+class Checkpointer:
+    # replaces connection.commit() in the importers; with a checkpoint_step it commits only
+    # every checkpoint_step lines, together with the line to continue from and a snapshot
+    # of the importer state (dedup structures and unflushed rows), so a resumed import
+    # starts exactly where the last committed transaction ended
+    def __init__(self, connection, importer_name, checkpoint_step=None):
+        self.connection = connection
+        self.importer_name = importer_name
+        self.checkpoint_step = checkpoint_step
+        self.last_line = 0
+        self.state_path = None
+
+    def load(self):
+        if self.checkpoint_step is None:
+            return None
+
+        with self.connection.cursor() as cursor:
+            cursor.execute(CREATE_CHECKPOINTS)
+            cursor.execute("""
+                SELECT next_line, state_path, finished FROM import_checkpoints WHERE importer = %s
+            """, (self.importer_name,))
+            row = cursor.fetchone()
+        self.connection.commit()
+
+        if row is None:
+            return None
+
+        next_line, self.state_path, finished = row
+        self.last_line = next_line
+        with open(self.state_path, "rb") as f:
+            state = pickle.load(f)
+
+        print(f"...Resuming '{self.importer_name}' from line {next_line}...")
+        return Checkpoint(next_line, state, finished)
+
+    def commit(self, it, get_state):
+        if self.checkpoint_step is None:
+            self.connection.commit()
+        elif it + 1 - self.last_line >= self.checkpoint_step:
+            self.save(it + 1, get_state())
+
+    def finish(self, it, get_state):
+        if self.checkpoint_step is None:
+            self.connection.commit()
+        else:
+            self.save(it + 1, get_state(), finished=True)
+
+    def save(self, next_line, state, finished=False):
+        # the snapshot is written first under a new name, so the committed checkpoint
+        # always points at a complete file, even if the commit itself never happens
+        os.makedirs(CHECKPOINT_DIR, exist_ok=True)
+        state_path = os.path.join(CHECKPOINT_DIR, f"{self.importer_name}-{next_line}.pkl")
+
+        with open(state_path + ".tmp", "wb") as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(state_path + ".tmp", state_path)
+
+        # the previous state file is deleted right after this commit, so the commit must
+        # survive a crash of postgres even in sessions with synchronous_commit=off
+        with self.connection.cursor() as cursor:
+            cursor.execute("SET LOCAL synchronous_commit = on")
+            cursor.execute(UPSERT_CHECKPOINT, (self.importer_name, next_line, state_path, finished))
+        self.connection.commit()
+
+        if self.state_path is not None and self.state_path != state_path and os.path.exists(self.state_path):
+            os.remove(self.state_path)
+        self.state_path = state_path
+        self.last_line = next_line
@@ -0,0 +1,204 @@
+import fcntl
+import os
+import re
+import time
+
+import psycopg as pg3
+
+
+# postgres connections of the "postgres" sink (sinks.py): every process keeps its
+# idle connections for the next connect(), every new session gets the settings
+# below, and all processes of an import together open at most MAX_SESSIONS sessions,
+# each one holds a lock on one of the files in SESSIONS_DIR while it is open.
+#
+#   PDT_POSTGRES_DSN       libpq connection string or URL, by default localhost with
+#                          PDT_POSTGRES_USER and PDT_POSTGRES_PASS
+#   PDT_SESSION_SETTINGS   "name=value,..." set in every session, "" for none
+#   PDT_MAX_SESSIONS       sessions open at once, by default what postgresql.conf allows
+#   PDT_POOL_SIZE          idle connections a process keeps
+
+# sorts and hashes of the constraint checks and the index builds stay in memory;
+# "synchronous_commit=off" can be added through PDT_SESSION_SETTINGS, the commits of
+# the checkpoints wait for the WAL flush either way (checkpoints.Checkpointer.save)
+DEFAULT_SESSION_SETTINGS = "work_mem=64MB,maintenance_work_mem=768MB"
+
+POSTGRESQL_CONF = os.path.join(os.path.dirname(os.path.abspath(__file__)), "postgresql.conf")
+
+SESSIONS_DIR = "./sessions"
+
+# seconds connect() waits for a free session before it gives up
+SESSION_WAIT = 600
+
+_idle = []
+_inherited = []
+_pid = os.getpid()
+
+
+def conninfo():
+    dsn = os.getenv("PDT_POSTGRES_DSN")
+    if dsn:
+        return dsn, {}
+    return "", {"host": "localhost", "user": os.getenv('PDT_POSTGRES_USER'),
+                "password": os.getenv('PDT_POSTGRES_PASS'), "dbname": "postgres"}
+
+
+def session_settings():
+    value = os.getenv("PDT_SESSION_SETTINGS", DEFAULT_SESSION_SETTINGS)
+    return [tuple(s.strip() for s in setting.split("=", 1)) for setting in value.split(",") if "=" in setting]
+
+
+def read_conf_setting(name, default, path=POSTGRESQL_CONF):
+    # the value of an uncommented "name = value" line of postgresql.conf
+    if not os.path.exists(path):
+        return default
+    with open(path) as f:
+        for line in f:
+            match = re.match(rf"\s*{name}\s*=\s*(\d+)", line)
+            if match:
+                return int(match.group(1))
+    return default
+
+
+def max_sessions():
+    # the connections postgres accepts from regular users
+    value = os.getenv("PDT_MAX_SESSIONS")
+    if value:
+        return int(value)
+    return max(1, read_conf_setting("max_connections", 100) - read_conf_setting("superuser_reserved_connections", 3))
+
+
+def pool_size():
+    return int(os.getenv("PDT_POOL_SIZE", 4))
+
+
+class SessionSlot:
+    # one of MAX_SESSIONS lock files, the lock goes away with the process if it dies
+    def __init__(self):
+        os.makedirs(SESSIONS_DIR, exist_ok=True)
+        num_slots = max_sessions()
+        deadline = time.time() + SESSION_WAIT
+
+        # processes start looking at different slots, so they rarely try the same lock
+        first = os.getpid() % num_slots
+        while True:
+            for i in range(num_slots):
+                f = open(os.path.join(SESSIONS_DIR, f"{(first + i) % num_slots}.lock"), "a")
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    self.file = f
+                    return
+                except BlockingIOError:
+                    f.close()
+
+            if time.time() > deadline:
+                raise RuntimeError(f"no free postgres session out of {num_slots} after {SESSION_WAIT} s, "
+                                   f"raise PDT_MAX_SESSIONS or lower the number of workers")
+            time.sleep(0.1)
+
+    def release(self):
+        fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.file.close()
+
+
+def _open():
+    slot = SessionSlot()
+    try:
+        dsn, params = conninfo()
+        connection = pg3.connect(dsn, **params)
+        for name, value in session_settings():
+            connection.execute("SELECT set_config(%s, %s, false)", (name, value))
+        connection.commit()
+    except BaseException:
+        slot.release()
+        raise
+    return connection, slot
+
+
+def _check_fork():
+    # a forked worker must not use, or close, the connections of its parent
+    global _pid
+    if os.getpid() != _pid:
+        _inherited.extend(_idle)
+        _idle.clear()
+        _pid = os.getpid()
+
+
+class PooledConnection:
+    # behaves like a psycopg connection, but close() and the end of a with block hand
+    # it back to the pool; like psycopg the with block commits, or rolls back on errors
+    def __init__(self, connection, slot):
+        self._connection = connection
+        self._slot = slot
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    @property
+    def autocommit(self):
+        return self._connection.autocommit
+
+    @autocommit.setter
+    def autocommit(self, value):
+        self._connection.autocommit = value
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._connection is None:
+            return False
+        if exc_type is None:
+            self._connection.commit()
+        else:
+            self._rollback()
+        self.close()
+        return False
+
+    def _rollback(self):
+        try:
+            self._connection.rollback()
+        except pg3.Error:
+            self._connection.close()
+
+    def close(self):
+        connection, slot = self._connection, self._slot
+        if connection is None:
+            return
+        self._connection = None
+        self._slot = None
+
+        _check_fork()
+        if not connection.closed and connection.info.transaction_status != pg3.pq.TransactionStatus.IDLE:
+            try:
+                connection.rollback()
+            except pg3.Error:
+                connection.close()
+
+        if connection.closed or connection.broken or len(_idle) >= pool_size():
+            connection.close()
+            slot.release()
+        else:
+            connection.autocommit = False
+            _idle.append((connection, slot))
+
+
+def connect(autocommit=False):
+    _check_fork()
+    while len(_idle) > 0:
+        connection, slot = _idle.pop()
+        if not connection.closed and not connection.broken:
+            break
+        slot.release()
+    else:
+        connection, slot = _open()
+
+    connection.autocommit = autocommit
+    return PooledConnection(connection, slot)
+
+
+def close_all():
+    _check_fork()
+    while len(_idle) > 0:
+        connection, slot = _idle.pop()
+        connection.close()
+        slot.release()
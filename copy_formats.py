@@ -0,0 +1,234 @@
+import os
+import struct
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from functools import lru_cache
+
+import metrics
+import schema
+
+
+# "text" sends every row with write_row and lets postgres parse the values again,
+# "binary" sends them in COPY's binary format with the types of schema.py (set_types),
+# "binary-buffer" encodes the binary rows here and sends them in large write() chunks
+COPY_FORMATS = ["text", "binary", "binary-buffer"]
+
+copy_format = os.getenv("PDT_COPY_FORMAT", "text")
+
+# rows encoded into one buffer for copy.write() in the "binary-buffer" format
+WRITE_CHUNK_ROWS = 1000
+
+BINARY_SIGNATURE = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+# a field count of -1
+BINARY_TRAILER = struct.pack(">h", -1)
+
+PG_EPOCH = datetime(2000, 1, 1, tzinfo=timezone.utc)
+PG_EPOCH_ORDINAL = PG_EPOCH.toordinal()
+
+
+def set_copy_format(name):
+    # also exported to the environment, so the worker processes use the same format
+    global copy_format
+    if name not in COPY_FORMATS:
+        raise ValueError(f"unknown copy format '{name}', expected one of {COPY_FORMATS}")
+    copy_format = name
+    os.environ["PDT_COPY_FORMAT"] = name
+
+
+@lru_cache(maxsize=2**16)
+def parse_timestamp(value):
+    # created_at is always "YYYY-MM-DDTHH:MM:SS.fffZ" in the exports, anything else
+    # goes through fromisoformat
+    if isinstance(value, datetime):
+        return value
+    if len(value) == 24 and value[10] == "T" and value[23] == "Z":
+        return datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                        int(value[11:13]), int(value[14:16]), int(value[17:19]),
+                        int(value[20:23]) * 1000, tzinfo=timezone.utc)
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
+@lru_cache(maxsize=2**16)
+def to_decimal(value):
+    # repr() is the text psycopg sends for a float, so both formats store the same number
+    if isinstance(value, float):
+        return Decimal(repr(value))
+    return Decimal(value)
+
+
+# values the "binary" format cannot take as they come from preprocess; the conversions
+# are cached, the exports repeat the same created_at second and probability many times
+CONVERTERS = {
+    "numeric": to_decimal,
+    "timestamptz": parse_timestamp,
+}
+
+
+def _encode_int8(value):
+    return struct.pack(">iq", 8, value)
+
+
+def _encode_int4(value):
+    return struct.pack(">ii", 4, value)
+
+
+def _encode_bool(value):
+    return b"\x00\x00\x00\x01\x01" if value else b"\x00\x00\x00\x01\x00"
+
+
+def _encode_text(value):
+    data = value.encode("utf-8")
+    return struct.pack(">i", len(data)) + data
+
+
+@lru_cache(maxsize=2**16)
+def _encode_timestamptz(value):
+    # microseconds since 2000-01-01 UTC
+    value = parse_timestamp(value).astimezone(timezone.utc)
+    seconds = (value.toordinal() - PG_EPOCH_ORDINAL) * 86400 + value.hour * 3600 + value.minute * 60 + value.second
+    return struct.pack(">iq", 8, seconds * 1000000 + value.microsecond)
+
+
+@lru_cache(maxsize=2**16)
+def _encode_numeric(value):
+    # sign, weight and base 10000 digits of postgres' numeric, the server rounds
+    # the value to the scale of the column like it does for text
+    sign, digits, exponent = to_decimal(value).as_tuple()
+
+    if exponent == "n" or exponent == "N":
+        return struct.pack(">ihhHH", 8, 0, 0, 0xC000, 0)
+    if exponent == "F":
+        return struct.pack(">ihhHH", 8, 0, 0, 0xF000 if sign else 0xD000, 0)
+
+    dscale = max(-exponent, 0)
+    digits = list(digits) + [0] * max(exponent, 0)
+    exponent = min(exponent, 0)
+
+    # pad both parts to whole groups of 4 decimal digits around the decimal point
+    int_len = len(digits) + exponent
+    if int_len < 0:
+        digits = [0] * -int_len + digits
+        int_len = 0
+    digits = [0] * (-int_len % 4) + digits + [0] * (exponent % 4)
+    weight = (int_len + (-int_len % 4)) // 4 - 1
+
+    groups = [digits[i] * 1000 + digits[i+1] * 100 + digits[i+2] * 10 + digits[i+3]
+              for i in range(0, len(digits), 4)]
+    while len(groups) > 0 and groups[0] == 0:
+        groups.pop(0)
+        weight -= 1
+    while len(groups) > 0 and groups[-1] == 0:
+        groups.pop()
+    if len(groups) == 0:
+        weight = 0
+        sign = 0
+
+    return struct.pack(f">ihhHH{len(groups)}H", 8 + 2 * len(groups), len(groups), weight,
+                       0x4000 if sign else 0, dscale, *groups)
+
+
+ENCODERS = {
+    "int8": _encode_int8,
+    "int4": _encode_int4,
+    "bool": _encode_bool,
+    "text": _encode_text,
+    "varchar": _encode_text,
+    "numeric": _encode_numeric,
+    "timestamptz": _encode_timestamptz,
+}
+
+NULL = struct.pack(">i", -1)
+
+
+def encode_rows(rows, encoders):
+    # one tuple of the binary COPY format per row: field count, then length and value of every field
+    field_count = struct.pack(">h", len(encoders))
+    parts = []
+    for row in rows:
+        parts.append(field_count)
+        for value, encode in zip(row, encoders):
+            parts.append(NULL if value is None else encode(value))
+    return b"".join(parts)
+
+
+def copy_columns(query_str):
+    # "COPY <table> (<columns>) FROM STDIN" -> (table, [columns])
+    columns = query_str[query_str.index("(") + 1:query_str.index(")")]
+    return query_str.split()[1], [c.strip() for c in columns.split(",")]
+
+
+@lru_cache(maxsize=None)
+def binary_copy_plan(query_str):
+    # "COPY <table> (<columns>) FROM STDIN" -> (query in binary format, column types)
+    table_name, columns = copy_columns(query_str)
+    types = schema.column_types(table_name, columns)
+    return f"{query_str.strip()} (FORMAT BINARY)", types
+
+
+class CopyStream:
+    # one COPY statement that stays open while several batches are written into it;
+    # a connection runs a single COPY at a time, close() must come before any other
+    # statement or the commit
+    def __init__(self, cursor, query_str, format_name=None):
+        self.format_name = copy_format if format_name is None else format_name
+        self.table_name = query_str.split()[1]
+
+        if self.format_name == "text":
+            self.context = cursor.copy(query_str)
+            self.copy = self.context.__enter__()
+            return
+
+        binary_query, types = binary_copy_plan(query_str)
+        self.context = cursor.copy(binary_query)
+        self.copy = self.context.__enter__()
+
+        if self.format_name == "binary":
+            self.copy.set_types(types)
+            self.converters = [(i, CONVERTERS[t]) for i, t in enumerate(types) if t in CONVERTERS]
+        else:
+            # psycopg adds neither the signature nor the trailer to data sent with write(),
+            # close() ends the data with the trailer
+            self.encoders = [ENCODERS[t] for t in types]
+            self.copy.write(BINARY_SIGNATURE)
+
+    def write(self, rows):
+        copy = self.copy
+        if self.format_name == "text":
+            for record in rows:
+                copy.write_row(record)
+        elif self.format_name == "binary":
+            converters = self.converters
+            for record in rows:
+                if len(converters) > 0:
+                    record = list(record)
+                    for i, convert in converters:
+                        if record[i] is not None:
+                            record[i] = convert(record[i])
+                copy.write_row(record)
+        else:
+            for start in range(0, len(rows), WRITE_CHUNK_ROWS):
+                copy.write(encode_rows(rows[start:start + WRITE_CHUNK_ROWS], self.encoders))
+
+        metrics.count_rows(self.table_name, len(rows))
+
+    def close(self, error=None):
+        # with an error the COPY is aborted instead of finished
+        if error is None:
+            if self.format_name == "binary-buffer":
+                self.copy.write(BINARY_TRAILER)
+            self.context.__exit__(None, None, None)
+        else:
+            self.context.__exit__(type(error), error, error.__traceback__)
+
+
+def copy_rows(cursor, query_str, rows, format_name=None):
+    stream = CopyStream(cursor, query_str, format_name)
+    try:
+        stream.write(rows)
+    except BaseException as e:
+        stream.close(e)
+        raise
+    stream.close()
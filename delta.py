@@ -0,0 +1,269 @@
+import argparse
+import time
+
+import copy_formats
+import import_data
+import json_backend
+import metrics
+import preprocess
+import progress
+import schema
+from copy_formats import copy_columns
+from dimensions import DimensionWriter
+from gzip_index import open_export, compressed_position
+from id_set import IdSet
+from utils import log_time
+from writers import WriterGroup
+
+
+# adds a new dump to the tables instead of importing everything again:
+#
+#   python delta.py --authors authors-0412.jsonl.gz --conversations conversations-0412.jsonl.gz
+#
+# the dump is copied into unlogged delta_<table> tables, then one transaction merges
+# them into the tables: authors and conversations are upserted, the rows of the child
+# tables are added for the conversations that are new. A reference whose parent is in
+# neither the tables nor the delta waits in pending_references, like in the single pass,
+# until the delta that brings its parent adds it. Every statement of the merge
+# looks the delta rows up by primary key, so it takes time for the rows of the delta,
+# not for the rows already in the tables. The dimension tables are inserted into
+# directly, like in every other import, with ON CONFLICT DO NOTHING
+
+# the counts of a conversation change between two dumps, the rest of it does not
+CONVERSATION_COUNTS = ["retweet_count", "reply_count", "like_count", "quote_count"]
+
+# the conversations of the delta that are not in the tables yet, only they get child rows
+CREATE_NEW_CONVERSATIONS = """
+    CREATE TEMPORARY TABLE delta_new_conversations ON COMMIT DROP AS
+    SELECT d.id FROM delta_conversations d
+    WHERE NOT EXISTS (SELECT 1 FROM conversations c WHERE c.id = d.id)
+"""
+
+# the pending references are looked up by the parents a delta brings
+CREATE_PENDING_PARENT_INDEX = "CREATE INDEX IF NOT EXISTS pending_references_parent_id ON pending_references (parent_id)"
+
+KEEP_PENDING_REFERENCES = """
+    INSERT INTO pending_references (conversation_id, parent_id, type)
+    SELECT d.conversation_id, d.parent_id, d.type FROM delta_conversation_references d
+    JOIN delta_new_conversations n ON n.id = d.conversation_id
+    WHERE NOT EXISTS (SELECT 1 FROM conversations c WHERE c.id = d.parent_id)
+"""
+
+RESOLVE_PENDING_REFERENCES = """
+    WITH resolved AS (
+        DELETE FROM pending_references p USING delta_new_conversations n
+        WHERE p.parent_id = n.id
+        RETURNING p.seq, p.conversation_id, p.parent_id, p.type
+    )
+    INSERT INTO conversation_references (conversation_id, parent_id, type)
+    SELECT conversation_id, parent_id, type FROM resolved ORDER BY seq
+"""
+
+
+def delta_copy_query(copy_query):
+    table_name, columns = copy_columns(copy_query)
+    return f"COPY {schema.delta_table_name(table_name)} ({', '.join(columns)}) FROM STDIN"
+
+
+def child_tables():
+    return [t for t in import_data.CONVERSATION_EXPORT_TABLES
+            if t != "conversations" and not schema.is_dimension(t)]
+
+
+def merge_authors_sql():
+    # a placeholder author (only the id) never overwrites anything, a real row fills in
+    # the placeholder the tables have for it; of two rows of one id the real one is merged.
+    # Returns the rows merged and the placeholders filled in: the select after the upsert
+    # still sees the authors as they were before it, an updated row that had no data was
+    # a placeholder
+    columns = copy_columns(import_data.COPY_AUTHORS)[1]
+    values = [f"COALESCE(EXCLUDED.{c}, authors.{c})" for c in columns[1:]]
+    return f"""
+        WITH merged AS (
+            INSERT INTO authors ({", ".join(columns)})
+            SELECT DISTINCT ON (id) {", ".join(columns)} FROM delta_authors
+            ORDER BY id, username IS NULL
+            ON CONFLICT (id) DO UPDATE SET
+            {", ".join(f"{c} = {v}" for c, v in zip(columns[1:], values))}
+            WHERE ({", ".join(f"authors.{c}" for c in columns[1:])}) IS DISTINCT FROM ({", ".join(values)})
+            RETURNING id, xmax <> 0 AS updated
+        )
+        SELECT count(*), count(*) FILTER (WHERE m.updated AND a.username IS NULL AND a.name IS NULL)
+        FROM merged m LEFT JOIN authors a ON a.id = m.id
+    """
+
+
+def merge_conversations_sql():
+    columns = copy_columns(import_data.COPY_CONVERSATIONS)[1]
+    return f"""
+        INSERT INTO conversations ({", ".join(columns)})
+        SELECT {", ".join(columns)} FROM delta_conversations
+        ON CONFLICT (id) DO UPDATE SET
+        {", ".join(f"{c} = EXCLUDED.{c}" for c in CONVERSATION_COUNTS)}
+        WHERE ({", ".join(f"conversations.{c}" for c in CONVERSATION_COUNTS)})
+        IS DISTINCT FROM ({", ".join(f"EXCLUDED.{c}" for c in CONVERSATION_COUNTS)})
+    """
+
+
+def merge_child_sql(table_name):
+    # the references get only parents that are in the tables after the merge, the
+    # others are kept in pending_references (KEEP_PENDING_REFERENCES)
+    columns = [c.split()[0] for c in schema.TABLES[table_name]["columns"] if c.split()[1] != "BIGSERIAL"]
+    parents = ""
+    if table_name == "conversation_references":
+        parents = "WHERE EXISTS (SELECT 1 FROM conversations c WHERE c.id = d.parent_id)"
+    return f"""
+        INSERT INTO {table_name} ({", ".join(columns)})
+        SELECT {", ".join(f"d.{c}" for c in columns)} FROM {schema.delta_table_name(table_name)} d
+        JOIN delta_new_conversations n ON n.id = d.conversation_id
+        {parents}
+    """
+
+
+def create_delta_tables(cursor):
+    # the live tables are created on the first delta
+    import_data.create_tables(cursor, schema.TABLES)
+    for table_name in ["authors", "conversations"] + child_tables():
+        cursor.execute(f"DROP TABLE IF EXISTS {schema.delta_table_name(table_name)}")
+        cursor.execute(schema.create_delta_table_sql(table_name))
+    cursor.execute(import_data.CREATE_PENDING_REFERENCES)
+    cursor.execute(CREATE_PENDING_PARENT_INDEX)
+
+
+def copy_authors(connection, cursor, path_to_author_export, start_time, log_step, batch_size):
+    print("...Copying the delta of 'authors'...")
+    metrics.record_start("delta-authors")
+    prev_block_time = time.time()
+
+    writers = WriterGroup(cursor, batch_size)
+    authors_writer = writers.add_table("authors", delta_copy_query(import_data.COPY_AUTHORS))
+    authors_ids = IdSet()
+    writers.memory.track("authors_ids", authors_ids)
+
+    with open_export(path_to_author_export) as (f, first_line):
+        it = -1
+        export_lines = progress.track("delta-authors", path_to_author_export, (0, -1), f, first_line)
+        for it, author_json_str in enumerate(export_lines, first_line):
+            author_row = preprocess.prepare_authors(json_backend.loads(author_json_str))
+            if author_row is not None and authors_ids.add(author_row[0]):
+                authors_writer.append(author_row)
+                writers.maybe_flush(connection.commit)
+
+            if it % log_step == 0 and it != 0:
+                prev_block_time = log_time("delta-authors", it, log_step, start_time, prev_block_time,
+                                           bytes_read=compressed_position(f))
+
+        writers.finish("delta-authors")
+    connection.commit()
+
+    log_time("delta-authors", it, log_step, start_time, prev_block_time, event="finish")
+    return authors_ids
+
+
+def copy_conversations(connection, cursor, path_to_conversation_export, start_time, authors_ids, log_step,
+                       batch_size):
+    # the rows of the single pass; the placeholders go to delta_authors with the rows
+    # of the authors export, the merge decides whether they are needed
+    print("...Copying the delta of all conversation tables...")
+    metrics.record_start("delta")
+    prev_block_time = time.time()
+
+    router = import_data.ConversationRouter(authors_ids)
+    writers = WriterGroup(cursor, batch_size, before_flush=lambda: router.drop_duplicates(writers))
+    for writer_name, table_name, copy_query in import_data.conversation_export_writers(bulk_load=True):
+        if schema.is_dimension(table_name):
+            writers.add_writer(writer_name, DimensionWriter(import_data.connect, copy_query))
+        else:
+            writers.add_table(writer_name, delta_copy_query(copy_query))
+    router.track_memory(writers.memory)
+
+    with open_export(path_to_conversation_export) as (f, first_line):
+        it = -1
+        export_lines = progress.track("delta", path_to_conversation_export, (0, -1), f, first_line)
+        for it, conversation_json_str in enumerate(export_lines, first_line):
+            conversation_obj = json_backend.loads(conversation_json_str)
+            prepared = preprocess.prepare_conversation(conversation_obj, prepare_other_models=True)
+
+            if router.route(prepared, writers):
+                writers.maybe_flush(connection.commit)
+
+            if it % log_step == 0 and it != 0:
+                prev_block_time = log_time("delta", it, log_step, start_time, prev_block_time,
+                                           bytes_read=compressed_position(f))
+
+        writers.finish("delta")
+    router.child_rows.finish("delta")
+    connection.commit()
+
+    log_time("delta", it, log_step, start_time, prev_block_time, event="finish")
+
+
+def merge_delta(connection, cursor):
+    # one transaction, a delta is merged completely or not at all
+    print("...Merging the delta into the tables...")
+    delta_tables = ["authors", "conversations"] + child_tables()
+    with metrics.timed("delta", "analyze"):
+        for table_name in delta_tables:
+            cursor.execute(f"ANALYZE {schema.delta_table_name(table_name)}")
+
+    with metrics.timed("delta", "merge-authors"):
+        cursor.execute(merge_authors_sql())
+        merged, placeholders_filled = cursor.fetchone()
+        print(f"...Merged {merged} rows of 'authors', {placeholders_filled} placeholders filled in...")
+
+    with metrics.timed("delta", "merge-conversations"):
+        cursor.execute(CREATE_NEW_CONVERSATIONS)
+        cursor.execute("ALTER TABLE delta_new_conversations ADD PRIMARY KEY (id)")
+        cursor.execute(merge_conversations_sql())
+        print(f"...Merged {cursor.rowcount} rows of 'conversations'...")
+
+    for table_name in child_tables():
+        with metrics.timed("delta", f"merge-{table_name}"):
+            cursor.execute(merge_child_sql(table_name))
+            metrics.count_rows(table_name, cursor.rowcount)
+            print(f"...Added {cursor.rowcount} rows to '{table_name}'...")
+
+    with metrics.timed("delta", "merge-pending-references"):
+        cursor.execute(RESOLVE_PENDING_REFERENCES)
+        metrics.count_rows("conversation_references", cursor.rowcount)
+        resolved = cursor.rowcount
+        cursor.execute(KEEP_PENDING_REFERENCES)
+        print(f"...Added {resolved} pending references whose parents came with the delta, "
+              f"{cursor.rowcount} wait in 'pending_references' for theirs...")
+
+    for table_name in delta_tables:
+        cursor.execute(f"DROP TABLE {schema.delta_table_name(table_name)}")
+    connection.commit()
+
+
+def import_delta(path_to_author_export, path_to_conversation_export, start_time, log_step=1000000,
+                 batch_size=1000):
+    with import_data.connect() as connection:
+        with connection.cursor() as cursor:
+            create_delta_tables(cursor)
+            connection.commit()
+
+            authors_ids = copy_authors(connection, cursor, path_to_author_export, start_time, log_step, batch_size)
+            copy_conversations(connection, cursor, path_to_conversation_export, start_time, authors_ids,
+                               log_step, batch_size)
+            merge_delta(connection, cursor)
+
+    print("...Finished merging the delta...")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--authors", required=True, help="path to the authors.jsonl.gz of the new dump")
+    parser.add_argument("--conversations", required=True, help="path to the conversations.jsonl.gz of the new dump")
+    parser.add_argument("--copy-format", choices=copy_formats.COPY_FORMATS, default=copy_formats.copy_format,
+                        help="format of the COPY data sent to postgres")
+    args = parser.parse_args()
+
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    copy_formats.set_copy_format(args.copy_format)
+
+    import_delta(args.authors, args.conversations, time.time())
+
+    metrics.print_report()
@@ -0,0 +1,135 @@
+import hashlib
+import os
+import sys
+from collections import OrderedDict
+
+import metrics
+import schema
+from copy_formats import copy_columns
+from writers import TableWriter
+
+
+# the dimension tables (hashtags, context domains and entities) get the same ids in
+# every worker: hashtags are numbered by a hash of their tag, the context tables keep
+# the ids of the export; a worker remembers the keys it has written in a bounded cache
+# and the rows it writes again after an eviction, or that another worker has written
+# already, are dropped by ON CONFLICT DO NOTHING
+
+# keys every DimensionKeys remembers at most
+CACHE_SIZE = int(os.getenv("PDT_DIMENSION_CACHE", 2**20))
+
+# rough size of a cache entry: the entry and link of the OrderedDict and the id
+ENTRY_BYTES = 150
+
+
+def hash_key(text):
+    # positive int64 taken from blake2b, python's hash() differs between processes;
+    # two tags sharing a hash would share their hashtags row, at 63 bits that does
+    # not happen for the few millions of tags in the exports
+    digest = hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") & 0x7FFFFFFFFFFFFFFF
+
+
+class DimensionKeys:
+    # natural key -> id of one dimension table; with surrogate=True the keys are
+    # strings that are hashed into the id, otherwise the key is the id itself
+    def __init__(self, surrogate=False, cache_size=None):
+        self.surrogate = surrogate
+        self.cache_size = CACHE_SIZE if cache_size is None else cache_size
+        self.cache = OrderedDict()
+        self.evicted = 0
+        # characters of the tags in the cache
+        self.key_bytes = 0
+
+    def __len__(self):
+        return len(self.cache)
+
+    def add(self, key):
+        # (id, True) when the worker has not written a row for the key recently
+        cache = self.cache
+        key_id = cache.get(key)
+        if key_id is not None:
+            cache.move_to_end(key)
+            return key_id, False
+
+        if self.surrogate:
+            # the cache holds one copy of every tag however many rows repeat it
+            key = sys.intern(key)
+            key_id = hash_key(key)
+            self.key_bytes += len(key)
+        else:
+            key_id = int(key)
+
+        cache[key] = key_id
+        if len(cache) > self.cache_size:
+            self.evict()
+        return key_id, True
+
+    def evict(self):
+        key, _ = self.cache.popitem(last=False)
+        self.evicted += 1
+        if self.surrogate:
+            self.key_bytes -= len(key)
+
+    def nbytes(self):
+        return len(self.cache) * ENTRY_BYTES + self.key_bytes
+
+    def spill(self):
+        # memory.py asks for memory back: the older half of the keys is forgotten, the rows
+        # written again for them are dropped by ON CONFLICT DO NOTHING
+        for _ in range(len(self.cache) // 2):
+            self.evict()
+
+
+def insert_sql(table_name, columns):
+    # sorted by id, so that workers inserting the same keys at once lock them in the
+    # same order and never deadlock
+    types = schema.column_types(table_name, columns)
+    arrays = ", ".join(f"%s::{t}[]" for t in types)
+    return f"""
+        INSERT INTO {table_name} ({", ".join(columns)})
+        SELECT * FROM unnest({arrays}) AS new_rows ({", ".join(columns)})
+        ORDER BY {columns[0]}
+        ON CONFLICT DO NOTHING
+    """
+
+
+def insert_rows(cursor, table_name, columns, rows):
+    # returns the number of rows that were not in the table yet
+    cursor.execute(insert_sql(table_name, columns), [list(c) for c in zip(*rows)])
+    metrics.count_rows(table_name, cursor.rowcount)
+    return cursor.rowcount
+
+
+class DimensionWriter(TableWriter):
+    # writes a dimension table on its own autocommit connection, every flush is one
+    # short transaction, so the key locks are never held while the importer's
+    # transaction goes on; the rows referencing the keys are copied after the flush
+    # and see them committed
+    keeps_stream = False
+
+    def __init__(self, connect, copy_query):
+        super().__init__(None, copy_query)
+        self.connect = connect
+        self.connection = None
+        self.table_name, self.columns = copy_columns(copy_query)
+        self.inserted = 0
+        self.duplicates = 0
+
+    def write(self, rows):
+        if self.connection is None:
+            self.connection = self.connect()
+            self.connection.autocommit = True
+
+        with self.connection.cursor() as cursor:
+            inserted = insert_rows(cursor, self.table_name, self.columns, rows)
+        self.inserted += inserted
+        self.duplicates += len(rows) - inserted
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+            if self.duplicates > 0:
+                print(f"...Inserted {self.inserted} rows into '{self.table_name}', "
+                      f"{self.duplicates} were there already...")
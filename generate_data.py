@@ -0,0 +1,268 @@
+import argparse
+import gzip
+import json
+import os
+
+import numpy as np
+
+
+# writes authors.jsonl.gz and conversations.jsonl.gz shaped like the twitter exports
+# preprocess.py reads, for benchmarks and tests without the real dumps:
+#
+#   python generate_data.py ./data --conversations 1000000 --authors 200000
+#
+# the same seed always gives the same files
+
+CONVERSATION_ID_BASE = 1496000000000000000
+AUTHOR_ID_BASE = 10**8
+
+# values that break naive COPY or string handling: NUL, COPY's escape characters,
+# characters outside the BMP, combining and zero-width characters, right-to-left
+# text and unicode line separators
+EDGE_CASE_STRINGS = [
+    "null \x00 byte",
+    "\x00",
+    "tab\tnew\nline\rreturn \\ backslash \\N",
+    "emoji \U0001F1FA\U0001F1E6\U0001F525\U0001F44D\U0001F3FD",
+    "combining e\u0301 and zero\u200bwidth\ufeff",
+    "right to left \u0645\u0631\u062d\u0628\u0627 \u05e9\u05dc\u05d5\u05dd",
+    "line\u2028separator\u2029paragraph",
+    "",
+]
+
+LANGUAGES = ["en", "uk", "ru", "de", "pl", "sk", "und", "zxx", "qme"]
+SOURCES = ["Twitter for Android", "Twitter for iPhone", "Twitter Web App", "TweetDeck"]
+ANNOTATION_TYPES = ["Place", "Person", "Organization", "Product", "Other"]
+REFERENCE_TYPES = ["retweeted", "quoted", "replied_to"]
+WORDS = ["Ukraine", "Kyiv", "Russia", "war", "peace", "NATO", "Slava", "Україні", "Путин", "news",
+         "breaking", "live", "update", "StandWithUkraine", "Zelensky", "sanctions", "Europe", "Mariupol"]
+
+
+class ExportGenerator:
+    # the densities are mean counts per conversation, the rates are fractions of the lines
+    def __init__(self, num_conversations=100000, num_authors=20000, seed=0,
+                 duplicate_rate=0.05, invalid_rate=0.01, edge_case_rate=0.01, unknown_author_rate=0.05,
+                 hashtags=1.0, annotations=0.8, context_annotations=2.0, urls=0.5, references=0.7,
+                 num_tags=50000, num_domains=100, num_entities=20000):
+        self.rng = np.random.default_rng(seed)
+        self.num_conversations = num_conversations
+        self.num_authors = num_authors
+        self.duplicate_rate = duplicate_rate
+        self.invalid_rate = invalid_rate
+        self.edge_case_rate = edge_case_rate
+        self.unknown_author_rate = unknown_author_rate
+        self.density = {
+            "hashtags": hashtags,
+            "annotations": annotations,
+            "context_annotations": context_annotations,
+            "urls": urls,
+            "references": references,
+        }
+        self.num_tags = num_tags
+        self.num_domains = num_domains
+        self.num_entities = num_entities
+
+    def text(self, num_words):
+        text = " ".join(WORDS[i] for i in self.rng.integers(0, len(WORDS), num_words))
+        if self.rng.random() < self.edge_case_rate:
+            text += " " + EDGE_CASE_STRINGS[self.rng.integers(0, len(EDGE_CASE_STRINGS))]
+        return text
+
+    def count(self, name):
+        return int(self.rng.poisson(self.density[name]))
+
+    def zipf_index(self, size):
+        # a few tags and entities are very common, most of them are rare
+        return int(self.rng.zipf(1.3) - 1) % size
+
+    def author(self, i):
+        obj = {
+            "id": str(AUTHOR_ID_BASE + i),
+            "name": self.text(2)[:300],
+            "username": f"user_{i}",
+            "description": self.text(int(self.rng.integers(0, 20))),
+            "public_metrics": {
+                "followers_count": int(self.rng.integers(0, 10**6)),
+                "following_count": int(self.rng.integers(0, 10**4)),
+                "tweet_count": int(self.rng.integers(0, 10**5)),
+                "listed_count": int(self.rng.integers(0, 10**3)),
+            },
+        }
+        if self.rng.random() < self.edge_case_rate:
+            # longer than the varchar(255) columns, or a count that is not a number
+            obj["name"] = "n" * 300
+            obj["public_metrics"]["listed_count"] = "many"
+        return obj
+
+    def conversation(self, i):
+        conversation_id = CONVERSATION_ID_BASE + i
+        author = int(self.rng.integers(0, self.num_authors))
+        if self.rng.random() < self.unknown_author_rate:
+            # authors missing from authors.jsonl.gz, the importers add them as placeholders
+            author = self.num_authors + int(self.rng.integers(0, self.num_authors))
+
+        text = self.text(int(self.rng.integers(3, 40)))
+        hashtags = []
+        for _ in range(self.count("hashtags")):
+            tag = f"tag{self.zipf_index(self.num_tags)}"
+            hashtags.append({"start": 0, "end": len(tag) + 1, "tag": tag})
+            text += " #" + tag
+
+        annotations = [
+            {"start": 0, "end": 4, "probability": round(float(self.rng.random()), 4),
+             "type": ANNOTATION_TYPES[self.rng.integers(0, len(ANNOTATION_TYPES))],
+             "normalized_text": self.text(1)}
+            for _ in range(self.count("annotations"))
+        ]
+        urls = [
+            {"start": 0, "end": 23, "url": "https://t.co/abcdefghij",
+             "expanded_url": f"https://www.example.com/{conversation_id}/{j}",
+             "display_url": "example.com/…", "status": 200,
+             "title": self.text(6), "description": self.text(12)}
+            for j in range(self.count("urls"))
+        ]
+        context_annotations = []
+        for _ in range(self.count("context_annotations")):
+            domain = self.zipf_index(self.num_domains)
+            entity = self.zipf_index(self.num_entities)
+            context_annotations.append({
+                "domain": {"id": str(domain + 1), "name": f"Domain {domain}", "description": self.text(8)},
+                "entity": {"id": str(10**6 + entity), "name": f"Entity {entity}"},
+            })
+        references = [
+            # parents anywhere in the export, some of them outside of it
+            {"type": REFERENCE_TYPES[self.rng.integers(0, len(REFERENCE_TYPES))],
+             "id": str(CONVERSATION_ID_BASE + int(self.rng.integers(-self.num_conversations // 10,
+                                                                     self.num_conversations)))}
+            for _ in range(self.count("references"))
+        ]
+
+        obj = {
+            "id": str(conversation_id),
+            "author_id": str(AUTHOR_ID_BASE + author),
+            "conversation_id": str(conversation_id),
+            "created_at": f"2022-02-{24 + i * 5 // max(self.num_conversations, 1):02d}T"
+                          f"{self.rng.integers(0, 24):02d}:{self.rng.integers(0, 60):02d}:"
+                          f"{self.rng.integers(0, 60):02d}.000Z",
+            "lang": LANGUAGES[self.rng.integers(0, len(LANGUAGES))],
+            "possibly_sensitive": bool(self.rng.random() < 0.05),
+            "reply_settings": "everyone",
+            "source": SOURCES[self.rng.integers(0, len(SOURCES))],
+            "text": text,
+            "public_metrics": {
+                "retweet_count": int(self.rng.integers(0, 10**4)),
+                "reply_count": int(self.rng.integers(0, 100)),
+                "like_count": int(self.rng.integers(0, 10**4)),
+                "quote_count": int(self.rng.integers(0, 100)),
+            },
+            "entities": {"hashtags": hashtags, "annotations": annotations, "urls": urls},
+            "context_annotations": context_annotations,
+            "referenced_tweets": references,
+        }
+
+        if self.rng.random() < self.edge_case_rate:
+            self.add_edge_case(obj)
+        return obj
+
+    def add_edge_case(self, obj):
+        # rows preprocess.py keeps but has to clean up or partly drop
+        case = self.rng.integers(0, 5)
+        if case == 0:
+            obj["entities"]["hashtags"].append({"start": 0, "end": 1, "tag": ""})
+        elif case == 1:
+            obj["entities"]["urls"].append({"expanded_url": "https://www.example.com/" + "x" * 3000})
+        elif case == 2:
+            obj["entities"]["annotations"].append({"normalized_text": "Kyiv", "type": "Place", "probability": "high"})
+        elif case == 3:
+            obj["context_annotations"].append({"domain": {"id": "", "name": "no id"}, "entity": {"id": "1"}})
+        else:
+            obj["referenced_tweets"].append({"type": "quoted", "id": "not a number"})
+            obj["lang"] = "en-GB-oxendict"
+
+    def invalid_author(self, obj):
+        # lines preprocess.py rejects as a whole
+        case = self.rng.integers(0, 3)
+        if case == 0:
+            del obj["id"]
+        elif case == 1:
+            obj["id"] = ""
+        else:
+            obj["id"] = "abc"
+        return obj
+
+    def invalid_conversation(self, obj):
+        case = self.rng.integers(0, 6)
+        if case == 0:
+            del obj["id"]
+        elif case == 1:
+            obj["id"] = ""
+        elif case == 2:
+            obj["author_id"] = "abc"
+        elif case == 3:
+            del obj["text"]
+        elif case == 4:
+            obj["created_at"] = None
+        else:
+            del obj["possibly_sensitive"]
+        return obj
+
+    def lines(self, make_obj, make_invalid, num_objects):
+        # duplicates repeat a recent line, as the exports do
+        recent = []
+        for i in range(num_objects):
+            if len(recent) > 0 and self.rng.random() < self.duplicate_rate:
+                yield recent[self.rng.integers(0, len(recent))]
+                continue
+
+            obj = make_obj(i)
+            if self.rng.random() < self.invalid_rate:
+                obj = make_invalid(obj)
+
+            line = json.dumps(obj, ensure_ascii=False).encode("utf-8") + b"\n"
+            if len(recent) < 1000:
+                recent.append(line)
+            else:
+                recent[self.rng.integers(0, len(recent))] = line
+            yield line
+
+    def write(self, out_dir, compresslevel=6):
+        # returns the paths of the authors and conversations exports
+        os.makedirs(out_dir, exist_ok=True)
+        paths = []
+        for file_name, make_obj, make_invalid, num_objects in [
+            ("authors.jsonl.gz", self.author, self.invalid_author, self.num_authors),
+            ("conversations.jsonl.gz", self.conversation, self.invalid_conversation, self.num_conversations),
+        ]:
+            path = os.path.join(out_dir, file_name)
+            with gzip.open(path, "wb", compresslevel=compresslevel) as f:
+                for line in self.lines(make_obj, make_invalid, num_objects):
+                    f.write(line)
+            paths.append(path)
+            print(f"...Generated {num_objects} lines of '{path}'...")
+        return paths
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("out_dir", help="directory for authors.jsonl.gz and conversations.jsonl.gz")
+    parser.add_argument("--conversations", type=int, default=100000, help="lines of conversations.jsonl.gz")
+    parser.add_argument("--authors", type=int, default=20000, help="lines of authors.jsonl.gz")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--duplicate-rate", type=float, default=0.05, help="lines repeating an earlier line")
+    parser.add_argument("--invalid-rate", type=float, default=0.01, help="lines preprocess.py rejects")
+    parser.add_argument("--edge-case-rate", type=float, default=0.01,
+                        help="lines with NUL bytes, unicode edge cases or values preprocess.py cleans up")
+    parser.add_argument("--unknown-author-rate", type=float, default=0.05,
+                        help="conversations by authors missing from authors.jsonl.gz")
+    for name, default in [("hashtags", 1.0), ("annotations", 0.8), ("context-annotations", 2.0),
+                          ("urls", 0.5), ("references", 0.7)]:
+        parser.add_argument(f"--{name}", type=float, default=default, help=f"mean {name} per conversation")
+    args = parser.parse_args()
+
+    ExportGenerator(
+        num_conversations=args.conversations, num_authors=args.authors, seed=args.seed,
+        duplicate_rate=args.duplicate_rate, invalid_rate=args.invalid_rate,
+        edge_case_rate=args.edge_case_rate, unknown_author_rate=args.unknown_author_rate,
+        hashtags=args.hashtags, annotations=args.annotations, context_annotations=args.context_annotations,
+        urls=args.urls, references=args.references,
+    ).write(args.out_dir)
@@ -0,0 +1,131 @@
+import gzip
+import json
+import math
+import os
+import sys
+from contextlib import contextmanager
+
+try:
+    import indexed_gzip
+except ImportError:
+    indexed_gzip = None
+
+
+INDEX_SUFFIX = ".gzidx"
+LINES_SUFFIX = ".gzidx.lines"
+
+
+def build_index(path_to_export, line_step=1000000, spacing=4*1024*1024):
+    # one pass over the export, storing zlib restart points every `spacing` bytes
+    # and the uncompressed offset of every `line_step`-th line next to the file
+    if indexed_gzip is None:
+        raise ImportError("building a gzip index requires the 'indexed_gzip' package")
+
+    checkpoints = [[0, 0]]
+    offset = 0
+    it = -1
+
+    with indexed_gzip.IndexedGzipFile(path_to_export, spacing=spacing) as f:
+        for it, line in enumerate(f):
+            offset += len(line)
+
+            if (it + 1) % line_step == 0:
+                checkpoints.append([it + 1, offset])
+
+        f.build_full_index()
+        f.export_index(path_to_export + INDEX_SUFFIX)
+        seek_points = list(f.seek_points())
+
+    # compressed offset of the restart point that is used to reach each line checkpoint
+    point_idx = 0
+    for checkpoint in checkpoints:
+        while point_idx + 1 < len(seek_points) and seek_points[point_idx + 1][0] <= checkpoint[1]:
+            point_idx += 1
+        checkpoint.append(seek_points[point_idx][1] if len(seek_points) > 0 else 0)
+
+    line_index = {
+        "line_step": line_step,
+        "total_lines": it + 1,
+        "compressed_size": os.path.getsize(path_to_export),
+        "checkpoints": checkpoints
+    }
+    with open(path_to_export + LINES_SUFFIX, "w") as f:
+        json.dump(line_index, f)
+
+    return line_index
+
+
+def load_line_index(path_to_export):
+    if not os.path.exists(path_to_export + LINES_SUFFIX) or not os.path.exists(path_to_export + INDEX_SUFFIX):
+        return None
+
+    with open(path_to_export + LINES_SUFFIX) as f:
+        line_index = json.load(f)
+
+    if line_index["compressed_size"] != os.path.getsize(path_to_export):
+        print(f"Index of '{path_to_export}' is out of date, ignoring it")
+        return None
+    return line_index
+
+
+@contextmanager
+def open_export(path_to_export, first_line=0):
+    # yields (file, number of the first line it returns); the caller still skips
+    # the lines between that checkpoint and its real start
+    line_index = load_line_index(path_to_export) if first_line > 0 else None
+
+    if line_index is None or indexed_gzip is None:
+        with gzip.open(path_to_export, 'r') as f:
+            yield f, 0
+        return
+
+    checkpoint = [0, 0, 0]
+    for c in line_index["checkpoints"]:
+        if c[0] > first_line:
+            break
+        checkpoint = c
+
+    with indexed_gzip.IndexedGzipFile(path_to_export, index_file=path_to_export + INDEX_SUFFIX) as f:
+        f.seek(checkpoint[1])
+        yield f, checkpoint[0]
+
+
+def compressed_position(f):
+    # bytes of the compressed export consumed so far, None when it cannot be told;
+    # an indexed file tells the restart point it decompresses from, at most `spacing`
+    # uncompressed bytes behind its position (IndexedGzipFile.fileobj is a method)
+    if indexed_gzip is not None and isinstance(f, indexed_gzip.IndexedGzipFile):
+        position = f.tell()
+        offset = 0
+        for uncompressed_offset, compressed_offset in f.seek_points():
+            if uncompressed_offset > position:
+                break
+            offset = compressed_offset
+        return offset
+    if isinstance(f, gzip.GzipFile):
+        return f.fileobj.tell()
+    return None
+
+
+def shard_row_ranges(path_to_export, num_shards):
+    # row ranges aligned to the line checkpoints, so each shard starts with a seek
+    line_index = load_line_index(path_to_export)
+    if line_index is None:
+        raise FileNotFoundError(f"'{path_to_export}' has no index, run 'python gzip_index.py {path_to_export}'")
+
+    line_step = line_index["line_step"]
+    shard_size = math.ceil(line_index["total_lines"] / num_shards / line_step) * line_step
+
+    row_ranges = []
+    for start in range(0, max(line_index["total_lines"], 1), max(shard_size, line_step)):
+        row_ranges.append((start, start + shard_size))
+
+    row_ranges[-1] = (row_ranges[-1][0], -1)
+    return row_ranges
+
+
+if __name__ == "__main__":
+    for path in sys.argv[1:]:
+        print(f"...Indexing '{path}'...")
+        line_index = build_index(path)
+        print(f"...Indexed {line_index['total_lines']} lines of '{path}'...")
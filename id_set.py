@@ -0,0 +1,243 @@
+import itertools
+import os
+
+import numpy as np
+
+
+# where IdSet.spill() writes the runs it moves out of memory
+SPILL_DIR = "./spill"
+
+# ids every merge step reads from each run at once
+MERGE_BLOCK = 2**20
+
+_spill_numbers = itertools.count()
+
+
+def _sorted_contains(run, ids):
+    if len(run) == 0:
+        return np.zeros(len(ids), dtype=bool)
+    pos = np.minimum(run.searchsorted(ids), len(run) - 1)
+    return run[pos] == ids
+
+
+class IdSet:
+    # set of int64 ids stored as a few sorted numpy runs (8 bytes per id), single
+    # ids are first collected in a small python set that is merged in once it fills up;
+    # another dtype (the 128-bit row hashes of row_dedup.py) works with the batch methods
+    def __init__(self, buffer_size=1000000, dtype=np.int64):
+        self.dtype = np.dtype(dtype)
+        self.runs = []
+        self.buffer = set()
+        self.buffer_size = buffer_size
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, new_id):
+        new_id = int(new_id)
+        if new_id in self.buffer:
+            return True
+
+        for run in self.runs:
+            pos = run.searchsorted(new_id)
+            if pos < len(run) and run[pos] == new_id:
+                return True
+        return False
+
+    def add(self, new_id):
+        # returns True if the id was not in the set yet
+        new_id = int(new_id)
+        if new_id in self:
+            return False
+
+        self.buffer.add(new_id)
+        self.size += 1
+
+        if len(self.buffer) >= self.buffer_size:
+            self.flush_buffer()
+        return True
+
+    def contains_many(self, ids):
+        ids = np.asarray(ids, dtype=self.dtype)
+
+        mask = np.zeros(len(ids), dtype=bool)
+        if len(self.buffer) > 0:
+            mask[:] = [new_id in self.buffer for new_id in ids.tolist()]
+
+        for run in self.runs:
+            mask |= _sorted_contains(run, ids)
+        return mask
+
+    def add_and_test(self, ids):
+        # batch version of add, returns a mask of the ids seen for the first time,
+        # for repeated ids inside the batch only the first occurrence is marked
+        ids = np.asarray(ids, dtype=self.dtype)
+        if len(ids) == 0:
+            return np.zeros(0, dtype=bool)
+
+        # searchsorted is much faster with sorted needles, np.unique gives them sorted
+        unique_ids, first_idx = np.unique(ids, return_index=True)
+        is_new = ~self.contains_many(unique_ids)
+
+        mask = np.zeros(len(ids), dtype=bool)
+        mask[first_idx[is_new]] = True
+
+        new_ids = unique_ids[is_new]
+        if len(new_ids) > 0:
+            self.add_run(new_ids)
+            self.size += len(new_ids)
+        return mask
+
+    def add_many(self, ids):
+        return int(self.add_and_test(ids).sum())
+
+    def flush_buffer(self):
+        if len(self.buffer) == 0:
+            return
+
+        run = np.fromiter(self.buffer, dtype=self.dtype, count=len(self.buffer))
+        run.sort()
+        self.buffer = set()
+        self.add_run(run)
+
+    def add_run(self, run):
+        # runs are kept with decreasing sizes, a run is merged into the previous one
+        # once it is at least as big, so there are only log(n) of them
+        self.runs.append(run)
+
+        # a spilled run stays in its file, the runs after it are merged until the next spill
+        while len(self.runs) > 1 and not is_mapped(self.runs[-2]) and len(self.runs[-2]) <= len(self.runs[-1]):
+            last = self.runs.pop()
+            merged = np.concatenate((self.runs.pop(), last))
+            merged.sort(kind="stable")
+            self.runs.append(merged)
+
+    def to_array(self):
+        self.flush_buffer()
+        if len(self.runs) == 0:
+            return np.zeros(0, dtype=self.dtype)
+
+        while len(self.runs) > 1:
+            last = self.runs.pop()
+            merged = np.concatenate((self.runs.pop(), last))
+            merged.sort(kind="stable")
+            self.runs.append(merged)
+        return self.runs[0]
+
+    def nbytes(self):
+        # approximate memory used by the set, the buffer counts ~64 bytes per python int;
+        # spilled runs are pages of the page cache, which the kernel can drop
+        return sum(run.nbytes for run in self.runs if not is_mapped(run)) + 64 * len(self.buffer)
+
+    def spill(self, spill_dir=SPILL_DIR):
+        # moves the set into one sorted file that is memory mapped; the runs in memory are
+        # merged with the file of an earlier spill block by block, never all at once
+        self.flush_buffer()
+        in_memory = [run for run in self.runs if not is_mapped(run)]
+        if len(in_memory) == 0:
+            return
+
+        paths = [run.filename for run in self.runs if is_mapped(run)]
+        for run in in_memory:
+            paths.append(spill_path(spill_dir))
+            save_ids(paths[-1], run)
+
+        path = spill_path(spill_dir)
+        merge_runs(paths, path)
+        self.runs = [np.load(path, mmap_mode="r")]
+        for merged_path in paths:
+            os.remove(merged_path)
+
+
+def is_mapped(run):
+    # a run in a file, a run unpickled from a checkpoint has no file anymore
+    return isinstance(run, np.memmap) and run.filename is not None
+
+
+def spill_path(spill_dir=SPILL_DIR):
+    return os.path.join(spill_dir, f"ids-{os.getpid()}-{next(_spill_numbers):05d}.npy")
+
+
+def merge_runs(paths, path, block_size=MERGE_BLOCK):
+    # merges sorted runs that share no id into one file, reading a block of every run at
+    # a time: all ids up to the smallest last id of the blocks are in their final place
+    runs = [np.load(p, mmap_mode="r") for p in paths]
+    tmp_path = path + ".tmp"
+    merged = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=runs[0].dtype, shape=(sum(len(r) for r in runs),))
+
+    positions = [0] * len(runs)
+    written = 0
+    while written < len(merged):
+        blocks = [run[pos:pos + block_size] for run, pos in zip(runs, positions)]
+        unfinished = [block[-1] for block, run, pos in zip(blocks, runs, positions) if pos + len(block) < len(run)]
+        limit = min(unfinished) if len(unfinished) > 0 else None
+
+        parts = []
+        for i, block in enumerate(blocks):
+            end = len(block) if limit is None else int(block.searchsorted(limit, side="right"))
+            parts.append(block[:end])
+            positions[i] += end
+
+        part = np.concatenate(parts)
+        part.sort()
+        merged[written:written + len(part)] = part
+        written += len(part)
+
+    merged.flush()
+    del merged
+    os.replace(tmp_path, path)
+
+
+def save_ids(path, ids):
+    # one sorted array in .npy format (an IdSet or ids already sorted, int64 unless they
+    # are an array already), written under a temporary name so that a reader never maps
+    # a partial file
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        if isinstance(ids, IdSet):
+            ids = ids.to_array()
+        np.save(f, ids if isinstance(ids, np.ndarray) else np.asarray(ids, dtype=np.int64))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class MappedIdSet:
+    # read-only IdSet over a file written by save_ids; the file is memory mapped, so
+    # all processes that open it share the same pages of the page cache
+    def __init__(self, path):
+        self.path = path
+        self.ids = np.load(path, mmap_mode="r")
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, new_id):
+        return bool(_sorted_contains(self.ids, np.asarray([int(new_id)], dtype=np.int64))[0])
+
+    def contains_many(self, ids):
+        return _sorted_contains(self.ids, np.asarray(ids, dtype=self.ids.dtype))
+
+    def nbytes(self):
+        return self.ids.nbytes
+
+
+class LineFilter:
+    # skips the line numbers of a sorted array while the lines are read in order,
+    # one comparison per line
+    def __init__(self, lines, first_line=0):
+        self.lines = np.asarray(lines, dtype=np.int64)
+        self.pos = int(self.lines.searchsorted(first_line))
+        self.next_line = self._line_at(self.pos)
+
+    def _line_at(self, pos):
+        return int(self.lines[pos]) if pos < len(self.lines) else -1
+
+    def skip(self, line):
+        if line != self.next_line:
+            return False
+        self.pos += 1
+        self.next_line = self._line_at(self.pos)
+        return True
@@ -1,256 +1,546 @@
-from locale import currency
-from shutil import which
-from turtle import clear
-import psycopg as pg3
-import psycopg2 as pg
-import psycopg2.extensions
-from psycopg2.extras import execute_batch
-import copy
 import time
-import gzip
-import json
 import os
-from multiprocessing import Pool
 import concurrent.futures
-from dotenv import load_dotenv
+import numpy as np
 
 import preprocess
-from utils import copy_data_to_table, log_time, make_string_valid, not_duplicate
+import json_backend
+import metrics
+from utils import log_time, make_string_valid, unique_rows
+from writers import WriterGroup
+from gzip_index import open_export, compressed_position
+from id_set import IdSet, LineFilter, MappedIdSet, save_ids
+from checkpoints import Checkpointer, checkpoint_name
+from dimensions import DimensionKeys, DimensionWriter, insert_rows
+from copy_formats import copy_columns
+import schema
+import pipeline
+import profiling
+import progress
+import row_dedup
+import sinks
+
+
+COPY_AUTHORS = """
+    COPY authors (id, name, username, description, 
+    followers_count, following_count, tweet_count, 
+    listed_count) FROM STDIN
+"""
+COPY_CONVERSATIONS = """
+    COPY conversations (id, author_id, content,
+    possibly_sensitive, language, source,
+    retweet_count, reply_count, like_count,
+    quote_count, created_at) FROM STDIN
+"""
+COPY_ANNOTATIONS = """
+    COPY annotations (conversation_id, value, type, 
+    probability) FROM STDIN
+"""
+COPY_LINKS = """
+    COPY links (conversation_id, url, title, 
+    description) FROM STDIN
+"""
+COPY_CONVERSATION_REFERENCES = """
+    COPY conversation_references (conversation_id, 
+    parent_id, type) FROM STDIN
+"""
+COPY_CONTEXT_DOMAINS = """
+    COPY context_domains (id, name,
+    description) FROM STDIN
+"""
+COPY_CONTEXT_ENTITIES = """
+    COPY context_entities (id, name,
+    description) FROM STDIN
+"""
+COPY_CONTEXT_ANNOTATIONS = """
+    COPY context_annotations (conversation_id, 
+    context_domain_id, context_entity_id) 
+    FROM STDIN
+"""
+COPY_HASHTAGS = """
+    COPY hashtags (id, tag) FROM STDIN
+"""
+COPY_CONVERSATION_HASHTAGS = """
+    COPY conversation_hashtags 
+    (conversation_id, hashtag_id) 
+    FROM STDIN
+"""
+CREATE_PENDING_REFERENCES = schema.create_staging_table_sql("pending_references")
+COPY_PENDING_REFERENCES = """
+    COPY pending_references (conversation_id, 
+    parent_id, type) FROM STDIN
+"""
+INSERT_VALID_REFERENCES = """
+    INSERT INTO conversation_references (conversation_id, parent_id, type)
+    SELECT p.conversation_id, p.parent_id, p.type
+    FROM pending_references p
+    WHERE EXISTS (SELECT 1 FROM conversations c WHERE c.id = p.parent_id)
+    ORDER BY p.seq
+"""
+
+CONVERSATION_EXPORT_TABLES = [
+    "conversations",
+    "hashtags",
+    "conversation_hashtags",
+    "context_domains",
+    "context_entities",
+    "context_annotations",
+    "annotations",
+    "links",
+    "conversation_references",
+]
+
+# ids of all imported conversations, written by import_conversation_table for the
+# workers that check parent ids of the references, and the lines it dropped as
+# duplicates, so that importers reading a part of the export drop the same ones
+CONVERSATION_IDS_PATH = "./ids/conversations.npy"
+CONVERSATION_DUPLICATES_PATH = "./ids/conversation_duplicates.npy"
+
+# ids of the authors export, and of the authors the conversations reference when the
+# two exports are imported at the same time, the placeholder authors are the difference
+AUTHOR_IDS_PATH = "./ids/authors.npy"
+CONVERSATION_AUTHOR_IDS_PATH = "./ids/conversation_authors.npy"
+
+
+def connect(**kwargs):
+    # the database, or the null or file sink of sinks.py
+    return sinks.connect(**kwargs)
+
+
+def create_tables(cursor, table_names, bulk_load=False, unlogged=False):
+    for table_name in table_names:
+        cursor.execute(schema.create_table_sql(table_name, bulk_load, unlogged))
+
+
+def prepare_tables(table_names, bulk_load=False, unlogged=False):
+    # for importers running in several shards at once, two concurrent
+    # CREATE TABLE IF NOT EXISTS of the same table can fail
+    with connect() as connection:
+        with connection.cursor() as cursor:
+            create_tables(cursor, table_names, bulk_load, unlogged)
+        connection.commit()
 
 
 def import_authors_table(path_to_author_export, start_time, row_range=(0,-1), 
-                            log_step=1000000, drop_table=True, batch_size=1000):
+                            log_step=1000000, drop_table=True, batch_size=1000,
+                            bulk_load=False, unlogged=False, checkpoint_step=None):
     print("...Filling 'authors' table...")
     prev_block_time = time.time()
 
-    create_table_string = """
-        CREATE TABLE IF NOT EXISTS authors (
-	    id int8 PRIMARY KEY,
-        name varchar(255),
-        username varchar(255),
-        description text,
-        followers_count int4,
-        following_count int4,
-        tweet_count int4,
-        listed_count int4
-        );
-    """
-    authors_query_string = """
-        COPY authors (id, name, username, description, 
-        followers_count, following_count, tweet_count, 
-        listed_count) FROM STDIN
-    """
-
-    with pg3.connect(host="localhost", user=os.getenv('PDT_POSTGRES_USER'), 
-            password=os.getenv('PDT_POSTGRES_PASS'), dbname="postgres") as connection:
+    with connect() as connection:
 
-        with connection.cursor() as cursor:
+        checkpointer = Checkpointer(connection, checkpoint_name("authors", row_range), checkpoint_step)
+        checkpoint = checkpointer.load()
+        if checkpoint is not None and checkpoint.finished:
+            print("...'authors' table already imported...")
+            return checkpoint.state["all_author_ids"]
 
-            # create table
-            cursor.execute(create_table_string)
+        start_line = row_range[0] if checkpoint is None else checkpoint.next_line
+        metrics.record_start("authors", start_line)
+
+        with connection.cursor() as cursor:
 
             # clear the table if necessary
-            if drop_table:
+            if drop_table and checkpoint is None:
                 cursor.execute("""
-                    DROP TABLE authors;
+                    DROP TABLE IF EXISTS authors CASCADE;
                 """)
 
-            with gzip.open(path_to_author_export, 'r') as f:
-                author_rows_batch = []
-                all_author_ids = {}
-            
-                for it, author_json_str in enumerate(f):
-                    if it < row_range[0]:
+            # create table
+            create_tables(cursor, ["authors"], bulk_load, unlogged)
+
+            # duplicate ids are dropped for the whole buffer at once before the copy
+            def drop_duplicates():
+                authors_writer.rows = unique_rows(all_author_ids, authors_writer.rows)
+
+            writers = WriterGroup(cursor, batch_size, before_flush=drop_duplicates)
+            authors_writer = writers.add_table("authors", COPY_AUTHORS)
+
+            with open_export(path_to_author_export, start_line) as (f, first_line):
+                all_author_ids = IdSet() if checkpoint is None else checkpoint.state["all_author_ids"]
+                writers.memory.track("all_author_ids", all_author_ids)
+
+                # the writer is always empty when a checkpoint is taken
+                current_state = lambda: {"all_author_ids": all_author_ids}
+
+                it = start_line - 1
+                export_lines = progress.track("authors", path_to_author_export, row_range, f, first_line)
+                for it, author_json_str in enumerate(writers.stages.read(export_lines), first_line):
+                    if it < start_line:
                         continue
                     if row_range[1] != -1 and it >= row_range[1]:
                         break
 
-                    author_obj = json.loads(author_json_str)
+                    start = time.perf_counter()
+                    author_obj = json_backend.loads(author_json_str)
+                    start = writers.stages.lap("json", start)
                     author_row = preprocess.prepare_authors(author_obj)
+                    writers.stages.lap("preprocess", start)
 
-                    if author_row is not None and not_duplicate(all_author_ids, author_row[0]):
-                        author_rows_batch.append(author_row)
-                    
-                        if len(author_rows_batch) == batch_size:
-                            author_rows_batch = copy_data_to_table(
-                                cursor, authors_query_string, author_rows_batch)
-                            connection.commit()
+                    if author_row is not None:
+                        authors_writer.append(author_row)
+                        writers.maybe_flush(lambda: checkpointer.commit(it, current_state))
 
                     if it % log_step == 0 and it != 0 and it != row_range[0]:
-                        prev_block_time = log_time("authors", it, log_step, start_time, prev_block_time)
+                        prev_block_time = log_time("authors", it, log_step, start_time, prev_block_time,
+                                                   bytes_read=compressed_position(f))
                     
-                if len(author_rows_batch) != 0:
-                    copy_data_to_table(
-                        cursor, authors_query_string, author_rows_batch)
-                    connection.commit()
+                writers.finish("authors")
+
+                # saved before the checkpoint, a finished import always has its file
+                if row_range == (0, -1):
+                    with metrics.timed("authors", "save-ids"):
+                        save_ids(AUTHOR_IDS_PATH, all_author_ids)
+
+                checkpointer.finish(it, current_state)
 
-    prev_block_time = log_time("authors", it, log_step, start_time, prev_block_time)
+    prev_block_time = log_time("authors", it, log_step, start_time, prev_block_time, event="finish")
     print("...Finished importing 'authors' table...")
     return all_author_ids
 
 
 def import_conversation_table(path_to_conversation_export, start_time, authors_ids, row_range=(0, -1),
-                              log_step=1000000, drop_table=True, batch_size=1000):
+                              log_step=1000000, drop_table=True, batch_size=1000,
+                              bulk_load=False, unlogged=False, checkpoint_step=None, copy_streams=1):
+
+    if copy_streams > 1:
+        return import_conversation_table_parallel(
+            path_to_conversation_export, start_time, authors_ids, row_range, log_step, drop_table,
+            batch_size, bulk_load, unlogged, copy_streams)
 
     print("...Filling 'conversations' table...")
     prev_block_time = time.time()
 
-    create_table_string = """
-        CREATE TABLE IF NOT EXISTS conversations (
-        id int8 PRIMARY KEY,
-        author_id int8 NOT NULL,
-        content text NOT NULL,
-        possibly_sensitive bool NOT NULL,
-        language varchar(3) NOT NULL,
-        source text NOT NULL,
-        retweet_count int4,
-        reply_count int4,
-        like_count int4,
-        quote_count int4,
-        created_at TIMESTAMPTZ,
-        FOREIGN KEY(author_id) REFERENCES authors (id)
-        );
-    """
-
-    with pg3.connect(host="localhost", user=os.getenv('PDT_POSTGRES_USER'),
-                     password=os.getenv('PDT_POSTGRES_PASS'), dbname="postgres") as connection:
+    with connect() as connection:
+
+        checkpointer = Checkpointer(connection, checkpoint_name("conversations", row_range), checkpoint_step)
+        checkpoint = checkpointer.load()
+        if checkpoint is not None and checkpoint.finished:
+            print("...'conversations' table already imported...")
+            return checkpoint.state["all_ids"]
+
+        start_line = row_range[0] if checkpoint is None else checkpoint.next_line
+        metrics.record_start("conversations", start_line)
 
         with connection.cursor() as cursor:
 
             # drop the table if necessary
-            if drop_table:
+            if drop_table and checkpoint is None:
                 cursor.execute("""
                     DROP TABLE IF EXISTS conversations;
                 """)
+
+            # files left by an earlier import would not match the table anymore
+            for path in [CONVERSATION_IDS_PATH, CONVERSATION_DUPLICATES_PATH, CONVERSATION_AUTHOR_IDS_PATH]:
+                if checkpoint is None and os.path.exists(path):
+                    os.remove(path)
                 
             # create table
-            cursor.execute(create_table_string)
-
-            with gzip.open(path_to_conversation_export, 'r') as f:
-                conversation_rows_batch = []
-                new_author_rows_to_add = []
-
-                all_ids = {}
-
-                for it, conversation_json_str in enumerate(f):
-                    if it < row_range[0]:
+            create_tables(cursor, ["conversations"], bulk_load, unlogged)
+
+            # duplicate ids are dropped for the whole buffer at once before the copy,
+            # the authors writer comes first and gets the placeholders of the rows left;
+            # without authors_ids the authors are still loading, only their ids are kept
+            def drop_duplicates():
+                is_new = all_ids.add_and_test([row[0] for row in conversations_writer.rows])
+                duplicate_lines.extend(line for line, new in zip(buffered_lines, is_new) if not new)
+                buffered_lines.clear()
+
+                conversations_writer.rows = [row for row, new in zip(conversations_writer.rows, is_new) if new]
+                if authors_ids is None:
+                    referenced_authors.add_many([row[1] for row in conversations_writer.rows])
+                else:
+                    writers["authors"].extend(new_author_rows(authors_ids, conversations_writer.rows))
+
+            writers = WriterGroup(cursor, batch_size, before_flush=drop_duplicates)
+            writers.add_table("authors", COPY_AUTHORS)
+            conversations_writer = writers.add_table("conversations", COPY_CONVERSATIONS)
+
+            with open_export(path_to_conversation_export, start_line) as (f, first_line):
+                all_ids = IdSet()
+                buffered_lines = []
+                duplicate_lines = []
+                referenced_authors = IdSet()
+
+                # the placeholder authors copied so far are part of the state as well
+                if checkpoint is not None:
+                    all_ids = checkpoint.state["all_ids"]
+                    authors_ids = checkpoint.state["authors_ids"]
+                    duplicate_lines = checkpoint.state["duplicate_lines"]
+                    referenced_authors = checkpoint.state["referenced_authors"]
+
+                current_state = lambda: {"all_ids": all_ids, "authors_ids": authors_ids,
+                                         "duplicate_lines": duplicate_lines,
+                                         "referenced_authors": referenced_authors}
+
+                writers.memory.track("all_ids", all_ids)
+                if authors_ids is None:
+                    writers.memory.track("referenced_authors", referenced_authors)
+                else:
+                    writers.memory.track("authors_ids", authors_ids)
+
+                it = start_line - 1
+                export_lines = progress.track("conversations", path_to_conversation_export, row_range, f, first_line)
+                for it, conversation_json_str in enumerate(writers.stages.read(export_lines), first_line):
+                    if it < start_line:
                         continue
                     if row_range[1] != -1 and it >= row_range[1]:
                         break
 
-                    conversation_obj = json.loads(conversation_json_str)
+                    start = time.perf_counter()
+                    conversation_obj = json_backend.loads(conversation_json_str)
+                    start = writers.stages.lap("json", start)
                     conversation = preprocess.prepare_conversation(conversation_obj)
+                    writers.stages.lap("preprocess", start)
 
-                    # if weve got a duplicate id, the size of dictionary remains the same
-                    if conversation is not None and not_duplicate(all_ids, conversation[0]):
-                        conversation_rows_batch.append(conversation)
+                    if conversation is not None:
+                        conversations_writer.append(conversation)
+                        buffered_lines.append(it)
+                        writers.maybe_flush(lambda: checkpointer.commit(it, current_state))
 
-                        if not_duplicate(authors_ids, conversation[1]):
-                            new_author_rows_to_add.append(
-                                [conversation[1]] + [None]*7
-                            )
+                    if it % log_step == 0 and it != 0 and it != row_range[0]:
+                        prev_block_time = log_time("conversations", it, log_step, start_time, prev_block_time,
+                                                   bytes_read=compressed_position(f))
 
-                        if len(conversation_rows_batch) == batch_size:
-                            conversation_rows_batch, new_author_rows_to_add = conversation_copy_cmd(
-                                cursor, conversation_rows_batch, new_author_rows_to_add)
-                            connection.commit()
+                writers.finish("conversations")
 
-                    if it % log_step == 0 and it != 0 and it != row_range[0]:
-                        prev_block_time = log_time("conversations", it, log_step, start_time, prev_block_time)
+                # saved before the checkpoint, a finished import always has its file;
+                # an import of a part of the export leaves the other parts out
+                if row_range == (0, -1):
+                    with metrics.timed("conversations", "save-ids"):
+                        save_ids(CONVERSATION_IDS_PATH, all_ids)
+                        save_ids(CONVERSATION_DUPLICATES_PATH, duplicate_lines)
+                        if authors_ids is None:
+                            save_ids(CONVERSATION_AUTHOR_IDS_PATH, referenced_authors)
 
-                if len(conversation_rows_batch) != 0:
-                    conversation_copy_cmd(
-                        cursor, conversation_rows_batch, new_author_rows_to_add)
-                    connection.commit()
+                checkpointer.finish(it, current_state)
 
-    prev_block_time = log_time("conversations", it, log_step, start_time, prev_block_time)
+    prev_block_time = log_time("conversations", it, log_step, start_time, prev_block_time, event="finish")
     print("...Finished importing 'conversations' table...")
 
     return all_ids
 
 
-def conversation_copy_cmd(cursor, conversations, authors):
-    if len(authors) > 0:
-        with cursor.copy("""
-            COPY authors (id, name, username, description, 
-            followers_count, following_count, tweet_count, 
-            listed_count) FROM STDIN
-        """) as copy:
-            for author_record in authors:
-                copy.write_row(author_record)
-    
-    with cursor.copy("""
-        COPY conversations (id, author_id, content,
-        possibly_sensitive, language, source,
-        retweet_count, reply_count, like_count,
-        quote_count, created_at) FROM STDIN
-    """) as copy:
-        for conversation_record in conversations:
-            copy.write_row(conversation_record)
+def import_conversation_table_parallel(path_to_conversation_export, start_time, authors_ids, row_range=(0, -1),
+                                       log_step=1000000, drop_table=True, batch_size=1000,
+                                       bulk_load=False, unlogged=False, copy_streams=4, queue_depth=8):
+    # like import_conversation_table, but the rows are copied over copy_streams connections
+    # at once, split by id; duplicates and placeholder authors are still picked here in
+    # file order, and a stream copies a chunk only once the authors of the chunk are committed.
+    # Every stream commits on its own connection, so this import has no checkpoints
+
+    print(f"...Filling 'conversations' table over {copy_streams} connections...")
+    prev_block_time = time.time()
+    metrics.record_start("conversations", row_range[0])
+
+    with connect() as connection:
+        with connection.cursor() as cursor:
+            if drop_table:
+                cursor.execute("""
+                    DROP TABLE IF EXISTS conversations;
+                """)
+            for path in [CONVERSATION_IDS_PATH, CONVERSATION_DUPLICATES_PATH, CONVERSATION_AUTHOR_IDS_PATH]:
+                if os.path.exists(path):
+                    os.remove(path)
+            create_tables(cursor, ["authors", "conversations"], bulk_load, unlogged)
+        connection.commit()
+
+    writers = pipeline.PipelineWriters(connect, queue_depth)
+    writers.add_table("authors", COPY_AUTHORS)
+    streams = [
+        writers.add_table(f"conversations-{i}", COPY_CONVERSATIONS, [] if bulk_load else ["authors"])
+        for i in range(copy_streams)
+    ]
+    router_stats = pipeline.StageStats("route")
+    stages = profiling.StageTimer()
+
+    # every stream copies about batch_size rows of a chunk
+    chunk_rows = batch_size * copy_streams
+    all_ids = IdSet()
+    duplicate_lines = []
+    referenced_authors = IdSet()
+
+    def send_chunk(seq, rows, lines):
+        start = time.time()
+        stage_start = time.perf_counter()
+        num_rows = len(rows)
+        is_new = all_ids.add_and_test([row[0] for row in rows])
+        duplicate_lines.extend(line for line, new in zip(lines, is_new) if not new)
+        rows = [row for row, new in zip(rows, is_new) if new]
+        stages.lap("dedup", stage_start, num_rows)
+
+        if authors_ids is None:
+            referenced_authors.add_many([row[1] for row in rows])
+        else:
+            writers["authors"].extend(new_author_rows(authors_ids, rows))
+        for row in rows:
+            streams[row[0] % copy_streams].append(row)
+        router_stats.busy += time.time() - start
+
+        writers.send(seq, router_stats)
+
+    writers.start()
+    try:
+        with open_export(path_to_conversation_export, row_range[0]) as (f, first_line):
+            seq = 0
+            rows = []
+            lines = []
+
+            it = row_range[0] - 1
+            export_lines = progress.track("conversations", path_to_conversation_export, row_range, f, first_line,
+                                          {f"queue-{n}": w.queue.qsize for n, w in writers.writers.items()})
+            for it, conversation_json_str in enumerate(stages.read(export_lines), first_line):
+                if it < row_range[0]:
+                    continue
+                if row_range[1] != -1 and it >= row_range[1]:
+                    break
+
+                start = time.perf_counter()
+                conversation_obj = json_backend.loads(conversation_json_str)
+                start = stages.lap("json", start)
+                conversation = preprocess.prepare_conversation(conversation_obj)
+                stages.lap("preprocess", start)
+                if conversation is not None:
+                    rows.append(conversation)
+                    lines.append(it)
+                    if len(rows) >= chunk_rows:
+                        send_chunk(seq, rows, lines)
+                        seq += 1
+                        rows = []
+                        lines = []
+
+                if it % log_step == 0 and it != 0 and it != row_range[0]:
+                    prev_block_time = log_time("conversations", it, log_step, start_time, prev_block_time,
+                                               bytes_read=compressed_position(f))
+
+            send_chunk(seq, rows, lines)
+        writers.close(router_stats)
+    except BaseException:
+        writers.abort()
+        raise
+
+    if row_range == (0, -1):
+        with metrics.timed("conversations", "save-ids"):
+            save_ids(CONVERSATION_IDS_PATH, all_ids)
+            save_ids(CONVERSATION_DUPLICATES_PATH, duplicate_lines)
+            if authors_ids is None:
+                save_ids(CONVERSATION_AUTHOR_IDS_PATH, referenced_authors)
+
+    stages.finish("conversations")
+    log_time("conversations", it, log_step, start_time, prev_block_time, event="finish")
+    pipeline.report_stalls("conversations", [router_stats] + [w.stats for w in writers.writers.values()])
+    print("...Finished importing 'conversations' table...")
+
+    return all_ids
 
-    return [], []
+
+def new_author_rows(authors_ids, conversations):
+    # placeholder rows for authors that are referenced but missing from the authors export
+    return [[row[1]] + [None]*7 for row in unique_rows(authors_ids, conversations, id_idx=1)]
+
+
+def prepare_concurrent_authors(bulk_load=False, unlogged=False):
+    # before the authors and conversations are imported at the same time: the foreign key
+    # of the conversations' authors waits for the placeholders
+    with connect() as connection:
+        with connection.cursor() as cursor:
+            create_tables(cursor, ["authors", "conversations"], bulk_load, unlogged)
+            cursor.execute(f"""
+                ALTER TABLE conversations DROP CONSTRAINT IF EXISTS
+                {schema.foreign_key_name("conversations", "author_id")}
+            """)
+        connection.commit()
+
+
+def insert_placeholder_authors(bulk_load=False, block_size=1000000):
+    # once both imports are done: the authors the conversations reference minus the ones
+    # of the authors export, both files are sorted; inserted with ON CONFLICT DO NOTHING,
+    # so a resumed import can run it again
+    print("...Inserting placeholder authors...")
+    referenced = np.load(CONVERSATION_AUTHOR_IDS_PATH, mmap_mode="r")
+    exported = MappedIdSet(AUTHOR_IDS_PATH)
+    columns = copy_columns(COPY_AUTHORS)[1]
+
+    inserted = 0
+    with connect() as connection:
+        with connection.cursor() as cursor:
+            with metrics.timed("authors", "placeholders"):
+                for start in range(0, len(referenced), block_size):
+                    block = np.asarray(referenced[start:start + block_size])
+                    missing = block[~exported.contains_many(block)]
+                    if len(missing) > 0:
+                        inserted += insert_rows(cursor, "authors", columns,
+                                                [[author_id] + [None]*7 for author_id in missing.tolist()])
+
+            # in bulk load mode build_deferred_constraints adds all foreign keys
+            if bulk_load == False:
+                with metrics.timed("conversations", "author-foreign-key"):
+                    cursor.execute(f"""
+                        ALTER TABLE conversations DROP CONSTRAINT IF EXISTS
+                        {schema.foreign_key_name("conversations", "author_id")}
+                    """)
+                    for sql in schema.foreign_key_sqls("conversations") + schema.validate_sqls("conversations"):
+                        cursor.execute(sql)
+        connection.commit()
+
+    print(f"...Inserted {inserted} placeholder authors...")
+
+
+def duplicate_line_filter(importer_name, row_range, start_line):
+    # an importer of a part of the export cannot tell which conversations appeared in
+    # the lines before its part, the conversation import has listed them
+    if os.path.exists(CONVERSATION_DUPLICATES_PATH):
+        return LineFilter(np.load(CONVERSATION_DUPLICATES_PATH), start_line)
+
+    if row_range[0] > 0:
+        print(f"...'{importer_name}' found no list of duplicate conversations, the ones "
+              f"that appeared before line {row_range[0]} are imported again...")
+    return LineFilter([])
+
+
+def load_conversation_ids(connection):
+    # the file of import_conversation_table is mapped instead of copying the ids
+    # into every worker, without it they are read from the table
+    with metrics.timed("annot-links-refs", "load-parent-ids"):
+        if os.path.exists(CONVERSATION_IDS_PATH):
+            return MappedIdSet(CONVERSATION_IDS_PATH)
+
+        ids = IdSet()
+        with connection.cursor(name="parent_ids") as id_cursor:
+            id_cursor.execute("""
+                SELECT id FROM conversations
+            """)
+            while True:
+                id_rows = id_cursor.fetchmany(1000000)
+                if len(id_rows) == 0:
+                    break
+                ids.add_many([item[0] for item in id_rows])
+        return ids
 
 
 def import_annotations_links_references_table(path_to_conversation_export, start_time, row_range=(0, -1),
-                              log_step=1000000, drop_table=True, batch_size=1000):
+                              log_step=1000000, drop_table=True, batch_size=1000,
+                              bulk_load=False, unlogged=False, checkpoint_step=None):
 
     print("...Filling 'annotations' table...")
     print("...Filling 'links' table...")
     print("...Filling 'conversation_references' table...")
     prev_block_time = time.time()
 
-    create_table_string1 = """
-        CREATE TABLE IF NOT EXISTS annotations (
-        id BIGSERIAL PRIMARY KEY,
-        conversation_id int8 NOT NULL,
-        value text NOT NULL,
-        type text NOT NULL,
-        probability numeric(4,3) NOT NULL,
-        FOREIGN KEY(conversation_id) REFERENCES conversations (id)
-        );
-    """
-    create_table_string2 = """
-        CREATE TABLE IF NOT EXISTS links (
-        id BIGSERIAL PRIMARY KEY,
-        conversation_id int8 NOT NULL,
-        url varchar(2048) NOT NULL,
-        title text,
-        description text,
-        FOREIGN KEY(conversation_id) REFERENCES conversations (id)
-        );
-    """
-    create_table_string3 = """
-        CREATE TABLE IF NOT EXISTS conversation_references (
-        id BIGSERIAL PRIMARY KEY,
-        conversation_id int8 NOT NULL,
-        parent_id int8 NOT NULL,
-        type varchar(20) NOT NULL,
-        FOREIGN KEY(conversation_id) REFERENCES conversations (id),
-        FOREIGN KEY(parent_id) REFERENCES conversations (id)
-        );
-    """
-
-    ####################################
-
-    annotation_copy_query = """
-        COPY annotations (conversation_id, value, type, 
-        probability) FROM STDIN
-    """
-    links_copy_query = """
-        COPY links (conversation_id, url, title, 
-        description) FROM STDIN
-    """
-    references_copy_query = """
-        COPY conversation_references (conversation_id, 
-        parent_id, type) FROM STDIN
-    """
-
-    with pg3.connect(host="localhost", user=os.getenv('PDT_POSTGRES_USER'),
-                     password=os.getenv('PDT_POSTGRES_PASS'), dbname="postgres") as connection:
+    with connect() as connection:
+
+        checkpointer = Checkpointer(connection, checkpoint_name("annot-links-refs", row_range), checkpoint_step)
+        checkpoint = checkpointer.load()
+        if checkpoint is not None and checkpoint.finished:
+            print("...'annotations', 'links' and 'conversation_references' tables already imported...")
+            return
+
+        start_line = row_range[0] if checkpoint is None else checkpoint.next_line
+        metrics.record_start("annot-links-refs", start_line)
 
         with connection.cursor() as cursor:
 
-            if drop_table:
+            if drop_table and checkpoint is None:
                 cursor.execute("""
                     DROP TABLE IF EXISTS annotations;
                 """)
@@ -261,141 +551,105 @@ def import_annotations_links_references_table(path_to_conversation_export, start
                     DROP TABLE IF EXISTS conversation_references;
                 """)
                 
-            cursor.execute(create_table_string1)
-            cursor.execute(create_table_string2)
-            cursor.execute(create_table_string3)
+            create_tables(cursor, ["annotations", "links", "conversation_references"], bulk_load, unlogged)
 
-            with gzip.open(path_to_conversation_export, 'r') as f:
-                annotation_rows_batch = []
-                link_rows_batch = []
-                references_rows_batch = []
+            writers = WriterGroup(cursor, batch_size, before_flush=lambda: child_rows.drop_duplicates(writers))
+            writers.add_table("annotations", COPY_ANNOTATIONS)
+            writers.add_table("links", COPY_LINKS)
+            writers.add_table("conversation_references", COPY_CONVERSATION_REFERENCES)
 
-                conversation_ids = {}
+            with open_export(path_to_conversation_export, start_line) as (f, first_line):
+                conversation_ids = IdSet()
+                child_rows = row_dedup.ChildRowDedup(
+                    {name: name for name in ["annotations", "links", "conversation_references"]})
 
-                cursor.execute("""
-                        SELECT id FROM conversations
-                    """)
-                all_possible_parent_id_values = cursor.fetchall()
-                all_possible_parent_id_values = {item[0]:"1" for item in all_possible_parent_id_values}
-            
-                for it, conversation_json_str in enumerate(f):
-                    if it < row_range[0]:
+                if checkpoint is not None:
+                    conversation_ids = checkpoint.state["conversation_ids"]
+                    child_rows = checkpoint.state["child_rows"]
+
+                # the writers are flushed together, they are empty at every checkpoint
+                current_state = lambda: {"conversation_ids": conversation_ids, "child_rows": child_rows}
+
+                # in bulk load mode the conversations may still be loading, the references
+                # to missing parents are moved aside by build_deferred_constraints instead
+                all_possible_parent_id_values = None if bulk_load else load_conversation_ids(connection)
+
+                writers.memory.track("conversation_ids", conversation_ids)
+                writers.memory.track("child_rows", child_rows)
+                if all_possible_parent_id_values is not None:
+                    writers.memory.track("parent_ids", all_possible_parent_id_values)
+
+                duplicate_lines = duplicate_line_filter("annot-links-refs", row_range, start_line)
+
+                it = start_line - 1
+                export_lines = progress.track("annot-links-refs", path_to_conversation_export, row_range, f, first_line)
+                for it, conversation_json_str in enumerate(writers.stages.read(export_lines), first_line):
+                    if it < start_line:
                         continue
                     if row_range[1] != -1 and it >= row_range[1]:
                         break
 
-                    conversation_obj = json.loads(conversation_json_str)
+                    start = time.perf_counter()
+                    conversation_obj = json_backend.loads(conversation_json_str)
+                    start = writers.stages.lap("json", start)
                     
-                    if preprocess.check_conversation_validity(conversation_obj) and not_duplicate(conversation_ids, conversation_obj["id"]):
+                    if (not duplicate_lines.skip(it) and preprocess.check_conversation_validity(conversation_obj)
+                            and conversation_ids.add(conversation_obj["id"])):
                         annotation_arr = preprocess.prepare_annotations(conversation_obj)
                         links_arr = preprocess.prepare_links(conversation_obj)
                         references_arr = preprocess.prepare_conversation_references(conversation_obj)
+                        writers.stages.lap("preprocess", start)
                         
-                        to_commit = False
-
-                        if annotation_arr is not None:
-                            annotation_rows_batch.extend(annotation_arr)
-                            if len(annotation_rows_batch) >= batch_size:
-                                annotation_rows_batch = copy_data_to_table(
-                                    cursor, annotation_copy_query, annotation_rows_batch)
-                                to_commit = True
-                                
-                        if links_arr is not None:
-                            link_rows_batch.extend(links_arr)
-                            if len(link_rows_batch) >= batch_size:
-                                link_rows_batch = copy_data_to_table(
-                                    cursor, links_copy_query, link_rows_batch)
-                                to_commit = True
-                            
+                        writers["annotations"].extend(annotation_arr)
+                        writers["links"].extend(links_arr)
+
                         if references_arr is not None:
-                            valid_references = list(filter(lambda ref: ref[1] in all_possible_parent_id_values, references_arr))
+                            valid_references = references_arr
+                            if all_possible_parent_id_values is not None:
+                                valid_mask = all_possible_parent_id_values.contains_many([ref[1] for ref in references_arr])
+                                valid_references = [ref for ref, valid in zip(references_arr, valid_mask) if valid]
 
-                            references_rows_batch.extend(valid_references)
-                            if len(references_rows_batch) >= batch_size:
-                                references_rows_batch = copy_data_to_table(
-                                    cursor, references_copy_query, references_rows_batch)
-                                to_commit = True
-                                
-                        if to_commit:
-                            connection.commit()
+                            writers["conversation_references"].extend(valid_references)
 
-                    if it % log_step == 0 and it != 0 and it != row_range[0]:
-                        prev_block_time = log_time("annot-links-refs", it, log_step, start_time, prev_block_time)
+                        writers.maybe_flush(lambda: checkpointer.commit(it, current_state))
 
-                if len(annotation_rows_batch) != 0:
-                    copy_data_to_table(cursor, annotation_copy_query, annotation_rows_batch)
-                    connection.commit()
+                    if it % log_step == 0 and it != 0 and it != row_range[0]:
+                        prev_block_time = log_time("annot-links-refs", it, log_step, start_time, prev_block_time,
+                                                   bytes_read=compressed_position(f))
 
-                if len(link_rows_batch) != 0:
-                    copy_data_to_table(cursor, links_copy_query, link_rows_batch)
-                    connection.commit()
+                writers.finish("annot-links-refs")
+                child_rows.finish("annot-links-refs")
 
-                if len(references_rows_batch) != 0:
-                    copy_data_to_table(cursor, references_copy_query, references_rows_batch)
-                    connection.commit()
+                checkpointer.finish(it, current_state)
 
-    prev_block_time = log_time("annot-links-refs", it, log_step, start_time, prev_block_time)
+    prev_block_time = log_time("annot-links-refs", it, log_step, start_time, prev_block_time, event="finish")
     print("...Finished importing 'annotations' table...")
     print("...Finished importing 'links' table...")
     print("...Finished importing 'conversation_references' table...")
 
 def import_context_domains_entities_annotations_tables(path_to_conversation_export, start_time, row_range=(0, -1),
-                            log_step=1000000, drop_table=True, batch_size=1000):
+                            log_step=1000000, drop_table=True, batch_size=1000,
+                            bulk_load=False, unlogged=False, checkpoint_step=None):
     
     print("...Filling 'context_domains' table...")
     print("...Filling 'context_entities' table...")
     print("...Filling 'context_annotation' table...")
     prev_block_time = time.time()
 
-    create_table_string1 = """
-        CREATE TABLE IF NOT EXISTS context_domains (
-        id int8 PRIMARY KEY,
-        name varchar(255) NOT NULL,
-        description text
-        );
-    """
-    create_table_string2 = """
-        CREATE TABLE IF NOT EXISTS context_entities (
-        id int8 PRIMARY KEY,
-        name varchar(255) NOT NULL,
-        description text
-        );
-    """
-    create_table_string3 = """
-        CREATE TABLE IF NOT EXISTS context_annotations (
-        id BIGSERIAL PRIMARY KEY,
-        conversation_id int8 NOT NULL,
-        context_domain_id int8 NOT NULL,
-        context_entity_id int8 NOT NULL,
-        FOREIGN KEY(conversation_id) REFERENCES conversations (id),
-        FOREIGN KEY(context_domain_id) REFERENCES context_domains (id),
-        FOREIGN KEY(context_entity_id) REFERENCES context_entities (id)
-        );
-    """
-
-    ######################
+    with connect() as connection:
 
-    
-    domain_query_string = """
-        COPY context_domains (id, name,
-        description) FROM STDIN
-    """
-    entity_query_string = """
-        COPY context_entities (id, name,
-        description) FROM STDIN
-    """
-    annotation_query_string = """
-        COPY context_annotations (conversation_id, 
-        context_domain_id, context_entity_id) 
-        FROM STDIN
-    """
-
-    with pg3.connect(host="localhost", user=os.getenv('PDT_POSTGRES_USER'),
-                     password=os.getenv('PDT_POSTGRES_PASS'), dbname="postgres") as connection:
+        checkpointer = Checkpointer(connection, checkpoint_name("context", row_range), checkpoint_step)
+        checkpoint = checkpointer.load()
+        if checkpoint is not None and checkpoint.finished:
+            print("...'context_domains', 'context_entities' and 'context_annotation' tables already imported...")
+            return
+
+        start_line = row_range[0] if checkpoint is None else checkpoint.next_line
+        metrics.record_start("context", start_line)
 
         with connection.cursor() as cursor:
 
-            if drop_table:
+            if drop_table and checkpoint is None:
                 cursor.execute("""
                     DROP TABLE IF EXISTS context_domains;
                 """)
@@ -406,110 +660,103 @@ def import_context_domains_entities_annotations_tables(path_to_conversation_expo
                     DROP TABLE IF EXISTS context_annotations;
                 """)
                 
-            cursor.execute(create_table_string1)
-            cursor.execute(create_table_string2)
-            cursor.execute(create_table_string3)
-
-            with gzip.open(path_to_conversation_export, 'r') as f:
-                domain_rows_batch = []
-                entity_rows_batch = []
-                annotation_rows_batch = []
-
-                conversation_ids = {}
-                domain_ids = {}
-                entity_ids = {}
-                
-                for it, conversation_json_str in enumerate(f):
-                    if it < row_range[0]:
+            create_tables(cursor, ["context_domains", "context_entities", "context_annotations"], bulk_load, unlogged)
+            # the dimension writers insert on connections of their own, they see committed tables only
+            connection.commit()
+
+            writers = WriterGroup(cursor, batch_size, before_flush=lambda: child_rows.drop_duplicates(writers))
+            writers.add_writer("context_domains", DimensionWriter(connect, COPY_CONTEXT_DOMAINS))
+            writers.add_writer("context_entities", DimensionWriter(connect, COPY_CONTEXT_ENTITIES))
+            writers.add_table("context_annotations", COPY_CONTEXT_ANNOTATIONS)
+
+            with open_export(path_to_conversation_export, start_line) as (f, first_line):
+                conversation_ids = IdSet()
+                domain_keys = DimensionKeys()
+                entity_keys = DimensionKeys()
+                child_rows = row_dedup.ChildRowDedup({"context_annotations": "context_annotations"})
+
+                if checkpoint is not None:
+                    conversation_ids = checkpoint.state["conversation_ids"]
+                    domain_keys = checkpoint.state["domain_keys"]
+                    entity_keys = checkpoint.state["entity_keys"]
+                    child_rows = checkpoint.state["child_rows"]
+
+                writers.memory.track("conversation_ids", conversation_ids)
+                writers.memory.track("domain_keys", domain_keys)
+                writers.memory.track("entity_keys", entity_keys)
+                writers.memory.track("child_rows", child_rows)
+
+                # all three writers are flushed together, they are empty at every checkpoint
+                current_state = lambda: {
+                    "conversation_ids": conversation_ids,
+                    "domain_keys": domain_keys,
+                    "entity_keys": entity_keys,
+                    "child_rows": child_rows,
+                }
+
+                duplicate_lines = duplicate_line_filter("context", row_range, start_line)
+
+                it = start_line - 1
+                export_lines = progress.track("context", path_to_conversation_export, row_range, f, first_line)
+                for it, conversation_json_str in enumerate(writers.stages.read(export_lines), first_line):
+                    if it < start_line:
                         continue
                     if row_range[1] != -1 and it >= row_range[1]:
                         break
 
-                    conversation_obj = json.loads(conversation_json_str)
+                    start = time.perf_counter()
+                    conversation_obj = json_backend.loads(conversation_json_str)
+                    start = writers.stages.lap("json", start)
                     
-                    if preprocess.check_conversation_validity(conversation_obj) and not_duplicate(conversation_ids, conversation_obj["id"]):
+                    if (not duplicate_lines.skip(it) and preprocess.check_conversation_validity(conversation_obj)
+                            and conversation_ids.add(conversation_obj["id"])):
                         domain_arr, entity_arr, annotation_arr = preprocess.prepare_context_annotations(conversation_obj)
+                        writers.stages.lap("preprocess", start)
 
                         if domain_arr is not None:
-                            new_domains = []
-                            new_domains = list(filter(lambda d: not_duplicate(domain_ids, d[0]), domain_arr))
-
-                            new_entities = []
-                            new_entities = list(filter(lambda e: not_duplicate(entity_ids, e[0]), entity_arr))
-
-                            domain_rows_batch.extend(new_domains)
-                            entity_rows_batch.extend(new_entities)
-                            annotation_rows_batch.extend(annotation_arr)
+                            writers["context_domains"].extend([d for d in domain_arr if domain_keys.add(d[0])[1]])
+                            writers["context_entities"].extend([e for e in entity_arr if entity_keys.add(e[0])[1]])
+                            writers["context_annotations"].extend(annotation_arr)
 
-                            if it % batch_size == 0:
-                                domain_rows_batch = copy_data_to_table(
-                                    cursor, domain_query_string, domain_rows_batch)
+                            writers.maybe_flush(lambda: checkpointer.commit(it, current_state))
 
-                                entity_rows_batch = copy_data_to_table(
-                                    cursor, entity_query_string, entity_rows_batch)
-                                
-                                annotation_rows_batch = copy_data_to_table(
-                                    cursor, annotation_query_string, annotation_rows_batch)
-                                
-                                connection.commit()
-                    
                     if it % log_step == 0 and it != 0 and it != row_range[0]:
-                        prev_block_time = log_time("context", it, log_step, start_time, prev_block_time)
+                        prev_block_time = log_time("context", it, log_step, start_time, prev_block_time,
+                                                   bytes_read=compressed_position(f))
 
-                if len(domain_rows_batch) + len(entity_rows_batch) + len(annotation_rows_batch) > 0:
-                    copy_data_to_table(cursor, domain_query_string, domain_rows_batch)
-                    copy_data_to_table(cursor, entity_query_string, entity_rows_batch)
-                    copy_data_to_table(cursor, annotation_query_string, annotation_rows_batch)
+                writers.finish("context")
+                child_rows.finish("context")
 
-                    connection.commit()
+                checkpointer.finish(it, current_state)
 
-    prev_block_time = log_time("context", it, log_step, start_time, prev_block_time)
+    prev_block_time = log_time("context", it, log_step, start_time, prev_block_time, event="finish")
     print("...Finished importing 'context_domains' table...")
     print("...Finished importing 'context_entities' table...")
     print("...Finished importing 'context_annotation' table...")
 
 
 def import_hashtags(path_to_conversation_export, start_time, row_range=(0, -1),
-                            log_step=1000000, drop_table=True, batch_size=1000):
+                            log_step=1000000, drop_table=True, batch_size=1000,
+                            bulk_load=False, unlogged=False, checkpoint_step=None):
     
     print("...Filling 'hashtags' table...")
     print("...Filling 'conversation_hashtags' table...")
     prev_block_time = time.time()
 
-    create_table_string1 = """
-        CREATE TABLE IF NOT EXISTS hashtags (
-        id int8 PRIMARY KEY,
-        tag text UNIQUE NOT NULL
-        );
-    """
-    create_table_string2 = """
-        CREATE TABLE IF NOT EXISTS conversation_hashtags (
-        id BIGSERIAL PRIMARY KEY,
-        conversation_id int8 NOT NULL,
-        hashtag_id int8 NOT NULL,
-        FOREIGN KEY(conversation_id) REFERENCES conversations (id),
-        FOREIGN KEY(hashtag_id) REFERENCES hashtags (id)
-        );
-    """
-
-    ######################
+    with connect() as connection:
 
-    
-    hashtag_query_string = """
-        COPY hashtags (id, tag) FROM STDIN
-    """
-    conv_hash_query_string = """
-        COPY conversation_hashtags 
-        (conversation_id, hashtag_id) 
-        FROM STDIN
-    """
-
-    with pg3.connect(host="localhost", user=os.getenv('PDT_POSTGRES_USER'),
-                     password=os.getenv('PDT_POSTGRES_PASS'), dbname="postgres") as connection:
+        checkpointer = Checkpointer(connection, checkpoint_name("hashtags", row_range), checkpoint_step)
+        checkpoint = checkpointer.load()
+        if checkpoint is not None and checkpoint.finished:
+            print("...'hashtags' and 'conversation_hashtags' tables already imported...")
+            return
+
+        start_line = row_range[0] if checkpoint is None else checkpoint.next_line
+        metrics.record_start("hashtags", start_line)
 
         with connection.cursor() as cursor:
 
-            if drop_table:
+            if drop_table and checkpoint is None:
                 cursor.execute("""
                     DROP TABLE IF EXISTS hashtags CASCADE;
                 """)
@@ -517,84 +764,387 @@ def import_hashtags(path_to_conversation_export, start_time, row_range=(0, -1),
                     DROP TABLE IF EXISTS conversation_hashtags;
                 """)
                 
-            cursor.execute(create_table_string1)
-            cursor.execute(create_table_string2)
-            
-            with gzip.open(path_to_conversation_export, 'r') as f:
-                hashtag_rows_batch = []
-                conv_hash_rows_batch = []
-
-                conversation_ids = {}
-                
-                new_tag_dict = {}
-                dict_tag_to_id = {}
-                serial_number = 1
-                
-                for it, conversation_json_str in enumerate(f):
-                    if it < row_range[0]:
+            create_tables(cursor, ["hashtags", "conversation_hashtags"], bulk_load, unlogged)
+            # the dimension writers insert on connections of their own, they see committed tables only
+            connection.commit()
+
+            writers = WriterGroup(cursor, batch_size)
+            writers.add_writer("hashtags", DimensionWriter(connect, COPY_HASHTAGS))
+            writers.add_table("conversation_hashtags", COPY_CONVERSATION_HASHTAGS)
+
+            with open_export(path_to_conversation_export, start_line) as (f, first_line):
+                conversation_ids = IdSet()
+                hashtag_keys = DimensionKeys(surrogate=True)
+
+                if checkpoint is not None:
+                    conversation_ids = checkpoint.state["conversation_ids"]
+                    hashtag_keys = checkpoint.state["hashtag_keys"]
+
+                writers.memory.track("conversation_ids", conversation_ids)
+                writers.memory.track("hashtag_keys", hashtag_keys)
+
+                # both writers are flushed together, they are empty at every checkpoint
+                current_state = lambda: {
+                    "conversation_ids": conversation_ids,
+                    "hashtag_keys": hashtag_keys,
+                }
+
+                duplicate_lines = duplicate_line_filter("hashtags", row_range, start_line)
+
+                it = start_line - 1
+                export_lines = progress.track("hashtags", path_to_conversation_export, row_range, f, first_line)
+                for it, conversation_json_str in enumerate(writers.stages.read(export_lines), first_line):
+                    if it < start_line:
                         continue
                     if row_range[1] != -1 and it >= row_range[1]:
                         break
 
-                    conversation_obj = json.loads(conversation_json_str)
+                    start = time.perf_counter()
+                    conversation_obj = json_backend.loads(conversation_json_str)
+                    start = writers.stages.lap("json", start)
                     
-                    if preprocess.check_conversation_validity(conversation_obj) and not_duplicate(conversation_ids, conversation_obj["id"]):
+                    if (not duplicate_lines.skip(it) and preprocess.check_conversation_validity(conversation_obj)
+                            and conversation_ids.add(conversation_obj["id"])):
                         hashtag_arr = preprocess.prepare_hashtags(conversation_obj)
+                        writers.stages.lap("preprocess", start)
 
                         new_hashtags = []
                         new_conv_hash = []
 
                         if hashtag_arr is not None:
                             for tag in hashtag_arr:
-                                if not_duplicate(new_tag_dict, tag[0], cast_to_int=False):
-                                    dict_tag_to_id[tag[0]] = serial_number
-                                    new_hashtags.append([serial_number, tag[0]])
-                                    
-                                    serial_number += 1
+                                hashtag_id, is_new = hashtag_keys.add(tag[0])
+                                if is_new:
+                                    new_hashtags.append([hashtag_id, tag[0]])
                                 new_conv_hash.append([
                                     int(conversation_obj["id"]),
-                                    dict_tag_to_id[tag[0]]
+                                    hashtag_id
                                 ])
                                 
-                            hashtag_rows_batch.extend(new_hashtags)
-                            conv_hash_rows_batch.extend(new_conv_hash)
-
-                            if it % batch_size == 0:
-                                hashtag_rows_batch = copy_data_to_table(
-                                    cursor, hashtag_query_string, hashtag_rows_batch)
-                                conv_hash_rows_batch = copy_data_to_table(
-                                    cursor, conv_hash_query_string, conv_hash_rows_batch)
-                                
-                                connection.commit()
-                    
+                            writers["hashtags"].extend(new_hashtags)
+                            writers["conversation_hashtags"].extend(new_conv_hash)
+
+                            writers.maybe_flush(lambda: checkpointer.commit(it, current_state))
+
                     if it % log_step == 0 and it != 0 and it != row_range[0]:
-                        prev_block_time = log_time("hashtags", it, log_step, start_time, prev_block_time)
+                        prev_block_time = log_time("hashtags", it, log_step, start_time, prev_block_time,
+                                                   bytes_read=compressed_position(f))
 
-                if len(hashtag_rows_batch) + len(conv_hash_rows_batch) > 0:
-                    copy_data_to_table(cursor, hashtag_query_string, hashtag_rows_batch)
-                    copy_data_to_table(cursor, conv_hash_query_string, conv_hash_rows_batch)
+                writers.finish("hashtags")
 
-                    connection.commit()
+                checkpointer.finish(it, current_state)
 
-    prev_block_time = log_time("hashtags", it, log_step, start_time, prev_block_time)
+    prev_block_time = log_time("hashtags", it, log_step, start_time, prev_block_time, event="finish")
     print("...Finish importing 'hashtags' table...")
     print("...Finish importing 'conversation_hashtags' table...")
 
+def conversation_export_writers(bulk_load=False):
+    # (writer name, table, copy query) of the tables filled from conversations.jsonl.gz,
+    # in the order the tables reference each other
+    return [
+        ("authors", "authors", COPY_AUTHORS),
+        ("conversations", "conversations", COPY_CONVERSATIONS),
+        ("hashtags", "hashtags", COPY_HASHTAGS),
+        ("conversation_hashtags", "conversation_hashtags", COPY_CONVERSATION_HASHTAGS),
+        ("context_domains", "context_domains", COPY_CONTEXT_DOMAINS),
+        ("context_entities", "context_entities", COPY_CONTEXT_ENTITIES),
+        ("context_annotations", "context_annotations", COPY_CONTEXT_ANNOTATIONS),
+        ("annotations", "annotations", COPY_ANNOTATIONS),
+        ("links", "links", COPY_LINKS),
+        ("references", "conversation_references", COPY_CONVERSATION_REFERENCES) if bulk_load
+        else ("references", "pending_references", COPY_PENDING_REFERENCES),
+    ]
+
+
+def create_conversation_export_tables(cursor, drop_table, bulk_load=False, unlogged=False, resume=False):
+    if drop_table and not resume:
+        for table_name in CONVERSATION_EXPORT_TABLES[::-1]:
+            cursor.execute(f"DROP TABLE IF EXISTS {table_name} CASCADE")
+
+    create_tables(cursor, CONVERSATION_EXPORT_TABLES, bulk_load, unlogged)
+
+    # parent ids may point to conversations that appear later in the file,
+    # so the references are filtered only after all conversations are copied;
+    # in bulk load mode they are checked together with the other foreign keys.
+    # pending_references is a regular table, a resumed import keeps filling it
+    if bulk_load == False:
+        if not resume:
+            cursor.execute("DROP TABLE IF EXISTS pending_references")
+        cursor.execute(CREATE_PENDING_REFERENCES)
+
+
+def filter_pending_references(cursor, table_name):
+    with metrics.timed(table_name, "filter-references"):
+        cursor.execute(INSERT_VALID_REFERENCES)
+        cursor.execute("DROP TABLE pending_references")
+
+
+class ConversationRouter:
+    # the order dependent part of the single pass: drops duplicate conversations, adds
+    # placeholder authors, picks the new dimension keys and passes every row to writers[name];
+    # the repeated rows of the child tables are dropped by drop_duplicates() before a flush
+    def __init__(self, authors_ids):
+        # the placeholders are added as the conversations come, there is no later pass for them
+        if authors_ids is None:
+            raise ValueError("the single pass needs the ids of the imported authors")
+        self.all_ids = IdSet()
+        self.authors_ids = authors_ids
+        self.domain_keys = DimensionKeys()
+        self.entity_keys = DimensionKeys()
+        self.hashtag_keys = DimensionKeys(surrogate=True)
+        self.child_rows = row_dedup.ChildRowDedup({
+            "context_annotations": "context_annotations",
+            "annotations": "annotations",
+            "links": "links",
+            "references": "conversation_references",
+        })
+
+    def track_memory(self, accounting):
+        for name in ["all_ids", "authors_ids", "domain_keys", "entity_keys", "hashtag_keys", "child_rows"]:
+            accounting.track(name, getattr(self, name))
+
+    def route(self, prepared, writers):
+        if prepared is None or not self.all_ids.add(prepared[0][0]):
+            return False
+
+        (
+            conversation,
+            hashtag_arr,
+            annotation_arr,
+            links_arr,
+            domain_arr,
+            entity_arr,
+            context_annotation_arr,
+            references_arr
+        ) = prepared
+
+        if self.authors_ids.add(conversation[1]):
+            writers["authors"].append([conversation[1]] + [None]*7)
+        writers["conversations"].append(conversation)
+
+        if hashtag_arr is not None:
+            for tag in hashtag_arr:
+                hashtag_id, is_new = self.hashtag_keys.add(tag[0])
+                if is_new:
+                    writers["hashtags"].append([hashtag_id, tag[0]])
+                writers["conversation_hashtags"].append([
+                    conversation[0],
+                    hashtag_id
+                ])
+
+        if domain_arr is not None:
+            writers["context_domains"].extend([d for d in domain_arr if self.domain_keys.add(d[0])[1]])
+            writers["context_entities"].extend([e for e in entity_arr if self.entity_keys.add(e[0])[1]])
+            writers["context_annotations"].extend(context_annotation_arr)
+
+        writers["annotations"].extend(annotation_arr)
+        writers["links"].extend(links_arr)
+        writers["references"].extend(references_arr)
+
+        return True
+
+    def route_chunk(self, rows, writers):
+        # the pipeline's router gets the rows of a whole chunk at once
+        for prepared in rows:
+            self.route(prepared, writers)
+        self.drop_duplicates(writers)
+
+    def drop_duplicates(self, writers):
+        self.child_rows.drop_duplicates(writers)
+
+
+def import_conversation_export_single_pass(path_to_conversation_export, start_time, authors_ids, row_range=(0, -1),
+                                           log_step=1000000, drop_table=True, batch_size=1000,
+                                           bulk_load=False, unlogged=False, checkpoint_step=None):
+    # reads conversations.jsonl.gz once and fills every table derived from it
+
+    print("...Filling all conversation tables in a single pass...")
+    prev_block_time = time.time()
+
+    with connect() as connection:
+
+        checkpointer = Checkpointer(connection, checkpoint_name("single-pass", row_range), checkpoint_step)
+        checkpoint = checkpointer.load()
+        if checkpoint is not None and checkpoint.finished:
+            print("...All conversation tables already imported...")
+            return checkpoint.state["router"].all_ids
+
+        start_line = row_range[0] if checkpoint is None else checkpoint.next_line
+        metrics.record_start("single-pass", start_line)
+
+        with connection.cursor() as cursor:
+
+            create_conversation_export_tables(cursor, drop_table, bulk_load, unlogged, resume=checkpoint is not None)
+            # the dimension writers insert on connections of their own, they see committed tables only
+            connection.commit()
+
+            writers = WriterGroup(cursor, batch_size, before_flush=lambda: router.drop_duplicates(writers))
+            for writer_name, table_name, copy_query in conversation_export_writers(bulk_load):
+                if schema.is_dimension(table_name):
+                    writers.add_writer(writer_name, DimensionWriter(connect, copy_query))
+                else:
+                    writers.add_table(writer_name, copy_query)
+
+            with open_export(path_to_conversation_export, start_line) as (f, first_line):
+                router = ConversationRouter(authors_ids) if checkpoint is None else checkpoint.state["router"]
+                router.track_memory(writers.memory)
+
+                # the writers are flushed right before every checkpoint, so they hold no rows
+                current_state = lambda: {"router": router}
+
+                it = start_line - 1
+                export_lines = progress.track("single-pass", path_to_conversation_export, row_range, f, first_line)
+                for it, conversation_json_str in enumerate(writers.stages.read(export_lines), first_line):
+                    if it < start_line:
+                        continue
+                    if row_range[1] != -1 and it >= row_range[1]:
+                        break
+
+                    start = time.perf_counter()
+                    conversation_obj = json_backend.loads(conversation_json_str)
+                    start = writers.stages.lap("json", start)
+                    prepared = preprocess.prepare_conversation(conversation_obj, prepare_other_models=True)
+                    writers.stages.lap("preprocess", start)
+
+                    if router.route(prepared, writers):
+                        writers.maybe_flush(lambda: checkpointer.commit(it, current_state))
+
+                    if it % log_step == 0 and it != 0 and it != row_range[0]:
+                        prev_block_time = log_time("single-pass", it, log_step, start_time, prev_block_time,
+                                                   bytes_read=compressed_position(f))
+
+                writers.finish("single-pass")
+                router.child_rows.finish("single-pass")
+
+            if bulk_load == False:
+                filter_pending_references(cursor, "single-pass")
+
+            # committed together with the references, a crash before this point
+            # leaves pending_references in place for the resumed import
+            checkpointer.finish(it, current_state)
+
+    prev_block_time = log_time("single-pass", it, log_step, start_time, prev_block_time, event="finish")
+    print("...Finished importing all conversation tables...")
+
+    return router.all_ids
+
+
+def dimension_insert(copy_query):
+    # the pipeline's writer of a dimension table inserts instead of copying
+    table_name, columns = copy_columns(copy_query)
+    return lambda cursor, rows: insert_rows(cursor, table_name, columns, rows)
+
+
+def parse_conversation_lines(lines):
+    # runs in the parser processes of the pipelined import
+    prepared = [preprocess.prepare_conversation(json_backend.loads(line), prepare_other_models=True) for line in lines]
+    return [p for p in prepared if p is not None]
+
+
+def import_conversation_export_pipelined(path_to_conversation_export, start_time, authors_ids, row_range=(0, -1),
+                                         log_step=1000000, drop_table=True, batch_size=1000,
+                                         bulk_load=False, unlogged=False, num_parsers=4, queue_depth=8):
+    # the single pass split into stages that run at the same time: a reader, parser
+    # processes, the router and a writer with its own connection for every table
+
+    print("...Filling all conversation tables in a pipeline...")
+    metrics.record_start("pipeline", row_range[0])
+
+    with connect() as connection:
+
+        with connection.cursor() as cursor:
+            create_conversation_export_tables(cursor, drop_table, bulk_load, unlogged)
+        connection.commit()
+
+        # a writer copies a chunk only once the tables it references have committed
+        # theirs, without constraints the writers do not wait for each other
+        writer_specs = conversation_export_writers(bulk_load)
+        writers = pipeline.PipelineWriters(connect, queue_depth)
+        for writer_name, table_name, copy_query in writer_specs:
+            parent_tables = [] if bulk_load else schema.parent_tables(table_name)
+            write = dimension_insert(copy_query) if schema.is_dimension(table_name) else None
+            writers.add_table(writer_name, copy_query, [n for n, t, _ in writer_specs if t in parent_tables], write)
+
+        router = ConversationRouter(authors_ids)
+
+        pipeline.run_pipeline(
+            path_to_conversation_export, row_range, parse_conversation_lines,
+            lambda rows: router.route_chunk(rows, writers), writers,
+            "pipeline", start_time, log_step, num_parsers, batch_size, queue_depth)
+        router.child_rows.finish("pipeline")
+
+        if bulk_load == False:
+            with connection.cursor() as cursor:
+                filter_pending_references(cursor, "pipeline")
+            connection.commit()
+
+    print("...Finished importing all conversation tables...")
+
+    return router.all_ids
+
+
+def build_deferred_constraints(num_connections=4, set_logged=False):
+    # finishes a bulk load: builds the keys, moves the rows breaking a foreign key to
+    # rejected_<table> and adds the foreign keys, spreading the work over several connections
+    print("...Building constraints...")
+    table_names = list(schema.TABLES.keys())
+
+    def run(sqls):
+        with connect(autocommit=True) as connection:
+            rowcounts = []
+            for sql in sqls:
+                rowcounts.append(connection.execute(sql).rowcount)
+            return rowcounts
+
+    def reject_orphans(table_name):
+        sqls = [schema.create_rejected_table_sql(table_name)]
+        sqls += [schema.move_orphans_sql(table_name, column, parent)
+                 for column, parent in schema.TABLES[table_name]["foreign_keys"]]
+        return run(sqls)[1:]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_connections) as executor:
+        if set_logged:
+            with metrics.timed("constraints", "set-logged"):
+                list(executor.map(run, [[f"ALTER TABLE {t} SET LOGGED"] for t in table_names]))
+
+        with metrics.timed("constraints", "keys"):
+            list(executor.map(run, [[sql] for t in table_names for sql in schema.key_constraint_sqls(t)]))
+
+        tables_with_fks = [t for t in table_names if len(schema.TABLES[t]["foreign_keys"]) > 0]
+
+        # a rejected conversation orphans its child rows, so parents are cleaned up first
+        with metrics.timed("constraints", "reject-orphans"):
+            for level in schema.dependency_levels(tables_with_fks):
+                for table_name, rejected_counts in zip(level, executor.map(reject_orphans, level)):
+                    for (column, _), rejected in zip(schema.TABLES[table_name]["foreign_keys"], rejected_counts):
+                        if rejected > 0:
+                            print(f"...Moved {rejected} rows of '{table_name}' with unknown '{column}' "
+                                  f"to '{schema.rejected_table_name(table_name)}'...")
+                            metrics.record("rejected", table_name, column=column, rows=rejected)
+
+                    if sum(rejected_counts) == 0:
+                        run([f"DROP TABLE {schema.rejected_table_name(table_name)}"])
+
+        # adding a NOT VALID foreign key is instant, but it locks the parent table too
+        with metrics.timed("constraints", "foreign-keys"):
+            run([sql for t in tables_with_fks for sql in schema.foreign_key_sqls(t)])
+
+        with metrics.timed("constraints", "validate"):
+            list(executor.map(run, [schema.validate_sqls(t) for t in tables_with_fks]))
+
+    print("...Finished building constraints...")
+
+
 def drop_all_tables():    
-    with pg3.connect(host="localhost", user=os.getenv('PDT_POSTGRES_USER'),
-                        password=os.getenv('PDT_POSTGRES_PASS'), dbname="postgres") as connection:
+    with connect() as connection:
 
         with connection.cursor() as cursor:
 
-            cursor.execute("DROP TABLE IF EXISTS authors CASCADE")
-            cursor.execute("DROP TABLE IF EXISTS conversations CASCADE")
-            cursor.execute("DROP TABLE IF EXISTS hashtags CASCADE")
-            cursor.execute("DROP TABLE IF EXISTS conversation_hashtags CASCADE")
-            cursor.execute("DROP TABLE IF EXISTS conversation_references CASCADE")
-            cursor.execute("DROP TABLE IF EXISTS links CASCADE")
-            cursor.execute("DROP TABLE IF EXISTS annotations CASCADE")
-            cursor.execute("DROP TABLE IF EXISTS context_domains CASCADE")
-            cursor.execute("DROP TABLE IF EXISTS context_entities CASCADE")
-            cursor.execute("DROP TABLE IF EXISTS context_annotations CASCADE")
+            for table_name in schema.TABLES:
+                cursor.execute(f"DROP TABLE IF EXISTS {table_name} CASCADE")
+                cursor.execute(f"DROP TABLE IF EXISTS {schema.rejected_table_name(table_name)}")
+
+            cursor.execute("DROP TABLE IF EXISTS pending_references")
+            cursor.execute("DROP TABLE IF EXISTS import_checkpoints")
 
             connection.commit()
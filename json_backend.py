@@ -0,0 +1,49 @@
+import json
+import os
+
+
+def _load_orjson():
+    import orjson
+    return orjson.loads
+
+
+def _load_simdjson():
+    import simdjson
+    return simdjson.loads
+
+
+def _load_stdlib():
+    return json.loads
+
+
+# tried in this order, PDT_JSON_BACKEND forces one of them
+BACKENDS = {
+    "orjson": _load_orjson,
+    "simdjson": _load_simdjson,
+    "json": _load_stdlib,
+}
+
+
+def pick_backend(name=None):
+    if name is not None:
+        return name, BACKENDS[name]()
+
+    for backend_name, load_backend in BACKENDS.items():
+        try:
+            return backend_name, load_backend()
+        except ImportError:
+            continue
+
+
+BACKEND_NAME, _fast_loads = pick_backend(os.getenv("PDT_JSON_BACKEND"))
+
+
+def loads(line):
+    # takes the raw bytes line from the gzip file, the fast decoders reject some
+    # inputs the stdlib accepts (lone surrogates, NaN), those lines fall back to it
+    try:
+        return _fast_loads(line)
+    except ValueError:
+        if _fast_loads is json.loads:
+            raise
+        return json.loads(line)
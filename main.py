@@ -1,3 +1,4 @@
+import argparse
 import concurrent.futures
 import gzip
 import json
@@ -6,26 +7,42 @@ from functools import partial
 import time 
 import numpy as np
 import os
+import shutil
 
+import copy_formats
 import import_data
+import id_set
+import metrics
+import profiling
+import progress
+import row_dedup
+import sinks
+from gzip_index import shard_row_ranges
 from preprocess import prepare_conversation
 
 
-def job_dispatcher(start_time, value):
+def job_dispatcher(start_time, import_options, value, row_range=(0, -1)):
+    path_to_authors = r"C:\Users\marve\authors.jsonl.gz"
     path_to_conversations = r"C:\Users\marve\conversations.jsonl.gz"
 
-    row_range = (0, -1)
-
     try:
-        if value == "context":
+        if value == "authors":
+            # the ids go to import_data.AUTHOR_IDS_PATH, not back through the pool
+            import_data.import_authors_table(
+                path_to_authors, start_time, row_range=row_range, drop_table=False, log_step=1000000,
+                **import_options)
+        elif value == "context":
             import_data.import_context_domains_entities_annotations_tables(
-                path_to_conversations, start_time, row_range=row_range, drop_table=False, log_step=1000000)
+                path_to_conversations, start_time, row_range=row_range, drop_table=False, log_step=1000000,
+                **import_options)
         elif value == "annot_links_refs":
             import_data.import_annotations_links_references_table(
-                path_to_conversations, start_time, row_range=row_range, drop_table=False, log_step=1000000)
+                path_to_conversations, start_time, row_range=row_range, drop_table=False, log_step=1000000,
+                **import_options)
         elif value == "hashtags":
             import_data.import_hashtags(
-                path_to_conversations, start_time, row_range=row_range, drop_table=False, log_step=1000000)
+                path_to_conversations, start_time, row_range=row_range, drop_table=False, log_step=1000000,
+                **import_options)
         else:
             print(f"ZLY STIRNG: '{value}'")
             raise
@@ -35,31 +52,210 @@ def job_dispatcher(start_time, value):
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--single-pass", action="store_true",
+                        help="read conversations.jsonl.gz once and fill all its tables together")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="like --single-pass, with parsing and copying into every table running in parallel")
+    parser.add_argument("--parsers", type=int, default=4,
+                        help="with --pipeline, number of parser processes")
+    parser.add_argument("--queue-depth", type=int, default=8,
+                        help="with --pipeline, chunks of 1000 lines every queue between two stages holds")
+    parser.add_argument("--bulk-load", action="store_true",
+                        help="copy into tables without constraints and build them at the end")
+    parser.add_argument("--unlogged", action="store_true",
+                        help="with --bulk-load, load into UNLOGGED tables and set them LOGGED at the end")
+    parser.add_argument("--copy-format", choices=copy_formats.COPY_FORMATS, default=copy_formats.copy_format,
+                        help="format of the COPY data sent to postgres")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue an interrupted import from its last checkpoints instead of starting over")
+    parser.add_argument("--checkpoint-step", type=int, default=1000000,
+                        help="number of input lines between two checkpoints (and commits) of every importer")
+    parser.add_argument("--flush-rows", type=int,
+                        help="rows a table buffers before they are sent into its COPY stream (default 1000)")
+    parser.add_argument("--flush-mb", type=float,
+                        help="MB a table buffers before they are sent into its COPY stream (default 8)")
+    parser.add_argument("--flush-seconds", type=float,
+                        help="seconds rows stay buffered at most (default 5)")
+    parser.add_argument("--commit-mb", type=float,
+                        help="MB sent into the COPY streams between two commits (default 64)")
+    parser.add_argument("--commit-seconds", type=float,
+                        help="seconds between two commits at most (default 30)")
+    parser.add_argument("--memory-budget-mb", type=float,
+                        help="MB all buffers of one importer may hold together (default 256)")
+    parser.add_argument("--sink", choices=sinks.SINKS, default=sinks.sink_name,
+                        help="write into postgres, only count the rows ('null') or write COPY files ('file')")
+    parser.add_argument("--sink-format", choices=sinks.FILE_FORMATS, default=sinks.file_format,
+                        help="with --sink file, COPY's text format or CSV")
+    parser.add_argument("--dsn",
+                        help="libpq connection string of the database (default localhost with the .env user)")
+    parser.add_argument("--max-sessions", type=int,
+                        help="postgres sessions all workers open at once (default max_connections of "
+                             "postgresql.conf minus the reserved ones)")
+    parser.add_argument("--conversation-streams", type=int, default=1,
+                        help="COPY the 'conversations' table over this many connections at once")
+    parser.add_argument("--concurrent-authors", action="store_true",
+                        help="import authors.jsonl.gz and the 'conversations' table at the same time and insert "
+                             "the placeholder authors once both are done")
+    parser.add_argument("--keep-repeated-rows", action="store_true",
+                        help="do not drop repeated rows of the annotations, links, references and context annotations")
+    parser.add_argument("--dedup-mb", type=float,
+                        help="MB of row hashes every child table keeps in memory before it spills them to disk "
+                             "(default 64)")
+    parser.add_argument("--shards", type=int, default=1,
+                        help="split the 'hashtags' and 'context' imports into this many parts of the export "
+                             "imported in parallel, needs the index of gzip_index.py")
+    parser.add_argument("--progress-file",
+                        help="keep the progress of every import job in this file in the Prometheus text format, "
+                             "e.g. for the textfile collector of node_exporter")
+    parser.add_argument("--progress-port", type=int,
+                        help="serve the progress of every import job at http://localhost:<port>/metrics")
+    parser.add_argument("--progress-seconds", type=float, default=10.0,
+                        help="seconds between two progress lines on the console, 0 for none")
+    parser.add_argument("--worker-memory-mb", type=float,
+                        help="resident memory every worker process may use; a worker over it flushes its writers "
+                             "and spills its id sets, caches and row hashes instead of running out of memory")
+    parser.add_argument("--min-free-mb", type=float,
+                        help="memory of the machine the workers leave free with --worker-memory-mb, they pause "
+                             "reading below it (default 512)")
+    parser.add_argument("--cprofile", action="store_true",
+                        help="run cProfile over a sample of the lines every process reads and print the profile "
+                             "of all processes at the end")
+    parser.add_argument("--profile-sample", type=float,
+                        help="part of the blocks of lines profiled with --cprofile (default 0.05)")
+    args = parser.parse_args()
+
+    # the writers of the pipeline commit on their own connections, there is no single
+    # transaction a checkpoint could be part of
+    if args.pipeline and args.resume:
+        parser.error("--pipeline imports cannot be resumed")
+    if args.conversation_streams > 1 and args.resume:
+        parser.error("--conversation-streams imports cannot be resumed")
+    # the single pass and the pipeline add the placeholder authors as they go
+    if args.concurrent_authors and (args.single_pass or args.pipeline):
+        parser.error("--concurrent-authors works with the table by table import only")
+    # the checkpoints are kept in the database
+    if args.sink != "postgres" and args.resume:
+        parser.error("only imports into postgres can be resumed")
+
+    copy_formats.set_copy_format(args.copy_format)
+    sinks.set_sink(args.sink, args.sink_format)
+
+    # read by writers.FlushPolicy, connection_pool.py, row_dedup.py, memory.py and profiling.py,
+    # through the environment in the worker processes as well
+    for variable, value in [("PDT_FLUSH_ROWS", args.flush_rows), ("PDT_FLUSH_MB", args.flush_mb),
+                            ("PDT_FLUSH_SECONDS", args.flush_seconds), ("PDT_COMMIT_MB", args.commit_mb),
+                            ("PDT_COMMIT_SECONDS", args.commit_seconds),
+                            ("PDT_MEMORY_BUDGET_MB", args.memory_budget_mb),
+                            ("PDT_POSTGRES_DSN", args.dsn), ("PDT_MAX_SESSIONS", args.max_sessions),
+                            ("PDT_DEDUP_CHILD_ROWS", "0" if args.keep_repeated_rows else None),
+                            ("PDT_DEDUP_MB", args.dedup_mb),
+                            ("PDT_WORKER_MEMORY_MB", args.worker_memory_mb), ("PDT_MIN_FREE_MB", args.min_free_mb),
+                            ("PDT_PROFILE", "cprofile" if args.cprofile else None),
+                            ("PDT_PROFILE_SAMPLE", args.profile_sample)]:
+        if value is not None:
+            os.environ[variable] = str(value)
+
     START_TIME = time.time()
     
-    # remove logs file from previous run
-    if os.path.exists("./logs"):
-        for file in os.listdir("./logs"):
-            fullpath = os.path.join("./logs", file)
-            os.remove(fullpath)
+    # remove logs, checkpoints, id files, spilled ids and row hashes and sink files from previous run
+    if not args.resume:
+        for directory in ["./logs", "./checkpoints", "./ids", row_dedup.DEDUP_DIR, id_set.SPILL_DIR]:
+            if os.path.exists(directory):
+                for file in os.listdir(directory):
+                    fullpath = os.path.join(directory, file)
+                    os.remove(fullpath)
+        if args.sink == "file":
+            shutil.rmtree(sinks.SINK_DIR, ignore_errors=True)
+    progress.clear_statuses()
+
+    # every job reports its progress into ./logs, from whichever process it runs in
+    monitor = progress.Monitor(args.progress_file, args.progress_port, args.progress_seconds).start()
 
     load_dotenv()
 
-    import_data.drop_all_tables()
+    if not args.resume:
+        import_data.drop_all_tables()
     
     path_to_authors = r"C:\Users\marve\authors.jsonl.gz"
     path_to_conversations = r"C:\Users\marve\conversations.jsonl.gz"
 
-    all_author_ids = import_data.import_authors_table(path_to_authors, START_TIME, drop_table=False, log_step=1000000)
-    import_data.import_conversation_table(path_to_conversations, START_TIME, all_author_ids, drop_table=False, log_step=1000000)
+    import_options = {
+        "bulk_load": args.bulk_load,
+        "unlogged": args.bulk_load and args.unlogged,
+        "checkpoint_step": args.checkpoint_step,
+    }
 
-    tables_to_import = [
-        "context",
-        "annot_links_refs",
-        "hashtags",
-    ]
+    # with --concurrent-authors the authors are imported in the pool, next to the conversations
+    all_author_ids = None
+    if not args.concurrent_authors:
+        all_author_ids = import_data.import_authors_table(path_to_authors, START_TIME, drop_table=False,
+                                                          log_step=1000000, **import_options)
 
-    func = partial(job_dispatcher, START_TIME)
-    
-    with concurrent.futures.ProcessPoolExecutor(max_workers=4) as executor:
-        executor.map(func, tables_to_import)
+    if args.pipeline:
+        import_data.import_conversation_export_pipelined(
+            path_to_conversations, START_TIME, all_author_ids, drop_table=False, log_step=1000000,
+            bulk_load=import_options["bulk_load"], unlogged=import_options["unlogged"],
+            num_parsers=args.parsers, queue_depth=args.queue_depth)
+    elif args.single_pass:
+        import_data.import_conversation_export_single_pass(
+            path_to_conversations, START_TIME, all_author_ids, drop_table=False, log_step=1000000, **import_options)
+    else:
+        tables_to_import = [
+            "context",
+            "annot_links_refs",
+            "hashtags",
+        ]
+
+        # the dimension keys are the same in every shard; the shards learn which
+        # conversations are duplicates from the conversation import, so they start after it
+        sharded = ["context", "hashtags"] if args.shards > 1 else []
+        if len(sharded) > 0:
+            row_ranges = shard_row_ranges(path_to_conversations, args.shards)
+
+        func = partial(job_dispatcher, START_TIME, import_options)
+        # every job is waited for before the executor shuts down, so a job that fails
+        # aborts the run before the deferred constraints are built
+        jobs = []
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max(4, len(sharded) * args.shards)) as executor:
+            if args.concurrent_authors:
+                import_data.prepare_concurrent_authors(import_options["bulk_load"], import_options["unlogged"])
+                authors_job = executor.submit(func, "authors")
+
+            # without constraints the child tables do not have to wait for the conversations
+            if args.bulk_load:
+                for table in tables_to_import:
+                    if table not in sharded:
+                        jobs.append(executor.submit(func, table))
+
+            import_data.import_conversation_table(path_to_conversations, START_TIME, all_author_ids, drop_table=False,
+                                                  log_step=1000000, copy_streams=args.conversation_streams,
+                                                  **import_options)
+
+            # the placeholders are the authors the conversations reference minus the exported ones
+            if args.concurrent_authors:
+                authors_job.result()
+                import_data.insert_placeholder_authors(import_options["bulk_load"])
+
+            if not args.bulk_load:
+                jobs += [executor.submit(func, t) for t in tables_to_import if t not in sharded]
+
+            if len(sharded) > 0:
+                import_data.prepare_tables(
+                    ["hashtags", "conversation_hashtags", "context_domains", "context_entities", "context_annotations"],
+                    import_options["bulk_load"], import_options["unlogged"])
+
+            for table in sharded:
+                for row_range in row_ranges:
+                    jobs.append(executor.submit(func, table, row_range))
+
+            for job in concurrent.futures.as_completed(jobs):
+                job.result()
+
+    if args.bulk_load:
+        import_data.build_deferred_constraints(set_logged=import_options["unlogged"])
+
+    monitor.stop()
+    metrics.print_report()
+    profiling.print_profile()
@@ -0,0 +1,138 @@
+import os
+import resource
+import time
+from collections import Counter
+
+import metrics
+
+
+# what a worker keeps in memory: every importer tracks its id sets, dimension caches, row
+# hashes and the buffers of its writers in the Accounting of its WriterGroup, which samples
+# their sizes and the resident memory of the process, and records the peaks when the
+# importer finishes (metrics.print_report() lists them per importer)
+#
+#   PDT_WORKER_MEMORY_MB   resident memory every worker process may use, no limit when unset
+#   PDT_MIN_FREE_MB        memory of the machine the workers leave free, 512 by default
+#
+# with a limit, a worker over it, or short of free memory on the machine, first flushes
+# and commits its writers, then spills its largest structures: id sets go into memory
+# mapped files under id_set.SPILL_DIR, row hashes into their runs (row_dedup.py) and the
+# dimension caches drop their older half. While the machine stays short of free memory,
+# the worker pauses reading, so postgres and the other workers can finish their flushes
+
+# seconds between two checks, reading the resident memory is a system call
+CHECK_SECONDS = 1.0
+
+# structures smaller than this are not worth a spill
+SPILL_MIN_BYTES = 16 * 2**20
+
+PAUSE_SECONDS = 0.5
+MAX_PAUSE_SECONDS = 60.0
+
+
+def worker_budget():
+    value = os.getenv("PDT_WORKER_MEMORY_MB")
+    return int(float(value) * 2**20) if value else None
+
+
+def min_free():
+    return int(float(os.getenv("PDT_MIN_FREE_MB", 512)) * 2**20)
+
+
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # the peak instead, in kB on linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def available_bytes():
+    # MemAvailable of the machine, None where /proc/meminfo does not tell
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def format_mb(num_bytes):
+    return f"{num_bytes / 2**20:,.0f} MB"
+
+
+class Accounting:
+    # the structures of one importer in this process, name -> (structure, size());
+    # a structure with a spill() method can be moved out of memory
+    def __init__(self, budget=None):
+        self.budget = worker_budget() if budget is None else budget
+        self.structures = {}
+        self.peaks = Counter()
+        self.rss_peak = 0
+        self.last_check = 0.0
+        self.flushes = 0
+        self.spills = Counter()
+        self.paused_seconds = 0.0
+        self.warned = False
+
+    def track(self, name, structure, size=None):
+        self.structures[name] = (structure, structure.nbytes if size is None else size)
+
+    def sizes(self):
+        sizes = {name: int(size()) for name, (_, size) in self.structures.items()}
+        for name, num_bytes in sizes.items():
+            self.peaks[name] = max(self.peaks[name], num_bytes)
+        return sizes
+
+    def short_of_memory(self):
+        available = available_bytes()
+        return available is not None and available < min_free()
+
+    def over_budget(self):
+        # checked at most every CHECK_SECONDS, the sizes are sampled for the report meanwhile
+        now = time.time()
+        if now - self.last_check < CHECK_SECONDS:
+            return False
+        self.last_check = now
+
+        self.sizes()
+        rss = rss_bytes()
+        self.rss_peak = max(self.rss_peak, rss)
+        return self.budget is not None and (rss >= self.budget or self.short_of_memory())
+
+    def relieve(self):
+        # called with the writers flushed and committed
+        self.flushes += 1
+        sizes = self.sizes()
+        for name in sorted(sizes, key=sizes.get, reverse=True):
+            if rss_bytes() < self.budget and not self.short_of_memory():
+                break
+            structure = self.structures[name][0]
+            if sizes[name] < SPILL_MIN_BYTES or not hasattr(structure, "spill"):
+                continue
+            structure.spill()
+            self.spills[name] += 1
+            print(f"...Spilled '{name}' ({format_mb(sizes[name])}) at {format_mb(rss_bytes())} resident...")
+
+        start = time.time()
+        while self.short_of_memory() and time.time() - start < MAX_PAUSE_SECONDS:
+            time.sleep(PAUSE_SECONDS)
+        if time.time() - start >= PAUSE_SECONDS:
+            self.paused_seconds += time.time() - start
+            print(f"...Paused reading {time.time() - start:.0f} s for free memory...")
+
+        # what is left is not in any structure the importer could spill
+        if rss_bytes() >= self.budget and not self.warned:
+            self.warned = True
+            print(f"...Still over the memory budget of {format_mb(self.budget)} "
+                  f"with {format_mb(rss_bytes())} resident...")
+
+    def report(self, importer_name):
+        self.sizes()
+        self.rss_peak = max(self.rss_peak, rss_bytes())
+        metrics.record("memory", importer_name, rss_peak=self.rss_peak, peaks=dict(self.peaks),
+                       budget=self.budget, budget_flushes=self.flushes, spills=dict(self.spills),
+                       paused_seconds=self.paused_seconds)
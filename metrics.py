@@ -0,0 +1,206 @@
+import glob
+import json
+import os
+import sys
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+
+LOGS_DIR = "./logs"
+
+# rows copied to each table by this process, filled in by copy_formats.CopyStream
+rows_written = Counter()
+_reported_rows_written = Counter()
+
+# number of the last line every importer of this process has recorded
+_recorded_lines = {}
+
+
+def metrics_path(logs_dir=LOGS_DIR):
+    # every process appends to its own file, so concurrent workers never interleave lines
+    return os.path.join(logs_dir, f"metrics-{os.getpid()}.jsonl")
+
+
+def record(event, table_name, **fields):
+    line = {
+        "ts": time.time(),
+        "pid": os.getpid(),
+        "event": event,
+        "table": table_name,
+    }
+    line.update(fields)
+
+    os.makedirs(LOGS_DIR, exist_ok=True)
+    with open(metrics_path(), "a", encoding="utf-8") as f:
+        f.write(json.dumps(line) + "\n")
+
+
+def count_rows(table_name, num_rows):
+    rows_written[table_name] += num_rows
+
+
+def record_start(table_name, first_line=0):
+    _recorded_lines[table_name] = first_line - 1
+    record("start", table_name, line=first_line)
+
+
+def record_checkpoint(table_name, line, elapsed, block_rows, block_time, bytes_read=None, event="checkpoint"):
+    # rows_written holds only the rows copied since the previous checkpoint of this process
+    new_rows = rows_written - _reported_rows_written
+    _reported_rows_written.update(new_rows)
+
+    # the lines read since the previous checkpoint or the start, fewer than block_rows
+    # (log_step) in the last block; block_rows without a start recorded
+    if table_name in _recorded_lines:
+        block_rows = line - _recorded_lines[table_name]
+    _recorded_lines[table_name] = line
+
+    record(
+        event,
+        table_name,
+        line=line,
+        rows_written=dict(new_rows),
+        bytes_read=bytes_read,
+        elapsed=elapsed,
+        block_time=block_time,
+        rows_per_s=block_rows / block_time if block_time > 0 else None,
+    )
+
+
+@contextmanager
+def timed(table_name, stage):
+    start = time.time()
+    try:
+        yield
+    finally:
+        record("stage", table_name, stage=stage, start=start, seconds=time.time() - start)
+
+
+def read_events(logs_dir=LOGS_DIR):
+    events = []
+    for path in glob.glob(os.path.join(logs_dir, "metrics-*.jsonl")):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                # a worker killed mid-write can leave a truncated last line
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    continue
+    return sorted(events, key=lambda e: e["ts"])
+
+
+def summarize(logs_dir=LOGS_DIR):
+    # per importer run: lines read, compressed bytes consumed, duration and rows written to each table
+    events = read_events(logs_dir)
+
+    runs = {}
+    stages = defaultdict(float)
+    flushes = defaultdict(lambda: {"flushes": 0, "rows": 0, "bytes": 0, "largest": 0})
+    profile = defaultdict(lambda: {"seconds": 0.0, "rows": 0})
+    memory = {}
+
+    for e in events:
+        if e["event"] == "stage":
+            stages[(e["table"], e["stage"])] += e["seconds"]
+            continue
+
+        if e["event"] == "flushes":
+            for writer_name, w in e["writers"].items():
+                f = flushes[(e["table"], writer_name)]
+                f["flushes"] += w["flushes"]
+                f["rows"] += w["rows"]
+                f["bytes"] += w["bytes"]
+                f["largest"] = max(f["largest"], w["largest"])
+            continue
+
+        # the stage timers of profiling.py, summed over the processes and shards of an importer
+        if e["event"] == "profile":
+            for stage, p in e["stages"].items():
+                profile[(e["table"], stage)]["seconds"] += p["seconds"]
+                profile[(e["table"], stage)]["rows"] += p["rows"]
+            continue
+
+        # memory.py, the peaks of the worker that needed the most, shards are separate workers
+        if e["event"] == "memory":
+            m = memory.setdefault(e["table"], {"rss_peak": 0, "peaks": Counter(), "spills": Counter(),
+                                               "budget_flushes": 0, "paused_seconds": 0.0})
+            m["rss_peak"] = max(m["rss_peak"], e["rss_peak"])
+            for name, num_bytes in e["peaks"].items():
+                m["peaks"][name] = max(m["peaks"][name], num_bytes)
+            m["spills"].update(e["spills"])
+            m["budget_flushes"] += e["budget_flushes"]
+            m["paused_seconds"] += e["paused_seconds"]
+            continue
+
+        # only the line counters of the importers make up a run
+        if e["event"] not in ("start", "checkpoint", "finish"):
+            continue
+
+        key = (e["pid"], e["table"])
+        if e["event"] == "start" or key not in runs:
+            runs[key] = {"start": e, "last": e, "bytes_read": 0, "rows_written": Counter()}
+
+        run = runs[key]
+        run["last"] = e
+        run["bytes_read"] = max(run["bytes_read"], e.get("bytes_read") or 0)
+        run["rows_written"].update(e.get("rows_written", {}))
+
+    report = {}
+    for (pid, table_name), run in runs.items():
+        summary = report.setdefault(table_name, {"rows_read": 0, "bytes_read": 0, "seconds": 0.0, "rows_written": Counter()})
+        summary["rows_read"] += run["last"]["line"] - run["start"]["line"]
+        summary["bytes_read"] += run["bytes_read"]
+        summary["seconds"] = max(summary["seconds"], run["last"]["ts"] - run["start"]["ts"])
+        summary["rows_written"].update(run["rows_written"])
+
+    return report, dict(stages), dict(flushes), dict(profile), memory
+
+
+def print_report(logs_dir=LOGS_DIR):
+    report, stages, flushes, profile, memory = summarize(logs_dir)
+
+    print(f"{'importer':<26}{'rows read':>14}{'MB read':>10}{'seconds':>10}{'rows/s':>12}")
+    for table_name, s in sorted(report.items()):
+        rate = s["rows_read"] / s["seconds"] if s["seconds"] > 0 else 0
+        print(f"{table_name:<26}{s['rows_read']:>14}{s['bytes_read'] / 2**20:>10.1f}{s['seconds']:>10.0f}{rate:>12,.0f}")
+        for written_table, num_rows in sorted(s["rows_written"].items()):
+            written_rate = num_rows / s["seconds"] if s["seconds"] > 0 else 0
+            print(f"  -> {written_table:<21}{num_rows:>14}{'':>20}{written_rate:>12,.0f}")
+
+    if len(stages) > 0:
+        print(f"\n{'importer':<20}{'stage':<20}{'seconds':>10}")
+        for (table_name, stage), seconds in sorted(stages.items()):
+            print(f"{table_name:<20}{stage:<20}{seconds:>10.1f}")
+
+    if len(profile) > 0:
+        # the most expensive stage of every importer first
+        totals = Counter()
+        for (table_name, stage), p in profile.items():
+            totals[table_name] += p["seconds"]
+        print(f"\n{'importer':<20}{'stage':<14}{'seconds':>10}{'share':>8}{'rows':>14}{'us/row':>10}")
+        for (table_name, stage), p in sorted(profile.items(), key=lambda item: (item[0][0], -item[1]["seconds"])):
+            share = p["seconds"] / totals[table_name] if totals[table_name] > 0 else 0
+            per_row = p["seconds"] / p["rows"] * 1e6 if p["rows"] > 0 else 0
+            print(f"{table_name:<20}{stage:<14}{p['seconds']:>10.1f}{share:>8.0%}{p['rows']:>14,}{per_row:>10.1f}")
+
+    if len(flushes) > 0:
+        print(f"\n{'importer':<20}{'writer':<24}{'flushes':>9}{'rows/flush':>12}{'kB/flush':>10}{'largest':>10}")
+        for (table_name, writer_name), f in sorted(flushes.items()):
+            print(f"{table_name:<20}{writer_name:<24}{f['flushes']:>9}{f['rows'] / f['flushes']:>12,.0f}"
+                  f"{f['bytes'] / f['flushes'] / 2**10:>10,.0f}{f['largest']:>10,}")
+
+    if len(memory) > 0:
+        print(f"\n{'importer':<20}{'structure':<28}{'peak MB':>10}{'spills':>8}")
+        for table_name, m in sorted(memory.items()):
+            print(f"{table_name:<20}{'(resident)':<28}{m['rss_peak'] / 2**20:>10,.0f}{'':>8}")
+            for name, num_bytes in sorted(m["peaks"].items(), key=lambda item: -item[1]):
+                if num_bytes > 0:
+                    print(f"  {name:<46}{num_bytes / 2**20:>10,.1f}{m['spills'][name]:>8}")
+            if m["budget_flushes"] > 0:
+                print(f"  {m['budget_flushes']} flushes over the memory budget, "
+                      f"paused {m['paused_seconds']:.0f} s for free memory")
+
+
+if __name__ == "__main__":
+    print_report(sys.argv[1] if len(sys.argv) > 1 else LOGS_DIR)
@@ -0,0 +1,379 @@
+import multiprocessing
+import queue
+import threading
+import time
+import traceback
+
+import metrics
+import progress
+from gzip_index import open_export, compressed_position
+from utils import copy_data_to_table, log_time
+
+
+# reader thread -> parser processes -> router (calling thread) -> one writer thread per table,
+# every arrow is a bounded queue, so a slow stage blocks the stages before it instead of
+# letting rows pile up in memory; every stage counts the time it spends working and waiting
+# for its input and output, the stage that is busy the most is the one the others wait for
+
+
+class PipelineStopped(Exception):
+    pass
+
+
+class StageStats:
+    def __init__(self, name, workers=1):
+        self.name = name
+        self.workers = workers
+        self.busy = 0.0
+        self.wait_input = 0.0
+        self.wait_output = 0.0
+
+    def merge(self, other):
+        self.busy += other.busy
+        self.wait_input += other.wait_input
+        self.wait_output += other.wait_output
+
+    def record(self, table_name):
+        # seconds per worker, so stages with several workers compare with the others
+        for kind in ["busy", "wait_input", "wait_output"]:
+            metrics.record("stage", table_name, stage=f"{self.name}:{kind.replace('_', '-')}",
+                           seconds=getattr(self, kind) / self.workers)
+
+
+def _put(q, item, stats, check=None):
+    start = time.time()
+    while True:
+        try:
+            q.put(item, timeout=1)
+            break
+        except queue.Full:
+            if check is not None:
+                check()
+    stats.wait_output += time.time() - start
+
+
+def _get(q, stats, check=None):
+    start = time.time()
+    while True:
+        try:
+            item = q.get(timeout=1)
+            break
+        except queue.Empty:
+            if check is not None:
+                check()
+    stats.wait_input += time.time() - start
+    return item
+
+
+class WriteProgress:
+    # the last chunk committed by every writer, writers wait here for the tables they reference
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.committed = {}
+        self.failed = False
+
+    def wait_for(self, writer_names, seq):
+        with self.condition:
+            self.condition.wait_for(
+                lambda: self.failed or all(self.committed.get(n, -1) >= seq for n in writer_names))
+            if self.failed:
+                raise PipelineStopped()
+
+    def mark_committed(self, writer_name, seq):
+        with self.condition:
+            self.committed[writer_name] = seq
+            self.condition.notify_all()
+
+    def fail(self):
+        with self.condition:
+            self.failed = True
+            self.condition.notify_all()
+
+
+class PipelineWriter:
+    # collects rows like writers.TableWriter, send() hands them to the writer thread,
+    # which copies them or passes them to write(cursor, rows)
+    def __init__(self, name, copy_query, connect, progress, queue_depth, parents=(), write=None):
+        self.name = name
+        self.copy_query = copy_query
+        self.write = write
+        self.connect = connect
+        self.progress = progress
+        self.parents = list(parents)
+        self.rows = []
+        self.queue = queue.Queue(queue_depth)
+        self.stats = StageStats(f"write-{name}")
+        self.error = None
+        self.thread = threading.Thread(target=self.run, name=f"writer-{name}", daemon=True)
+
+    def append(self, row):
+        self.rows.append(row)
+
+    def extend(self, rows):
+        if rows is not None:
+            self.rows.extend(rows)
+
+    def send(self, seq, stats, check):
+        _put(self.queue, (seq, self.rows), stats, check)
+        self.rows = []
+
+    def run(self):
+        try:
+            with self.connect() as connection:
+                with connection.cursor() as cursor:
+                    while True:
+                        item = _get(self.queue, self.stats)
+                        if item is None:
+                            break
+                        seq, rows = item
+
+                        start = time.time()
+                        self.progress.wait_for(self.parents, seq)
+                        self.stats.wait_input += time.time() - start
+
+                        start = time.time()
+                        if len(rows) > 0:
+                            if self.write is None:
+                                copy_data_to_table(cursor, self.copy_query, rows)
+                            else:
+                                self.write(cursor, rows)
+                            connection.commit()
+                            progress.record_flush(time.time() - start)
+                        self.progress.mark_committed(self.name, seq)
+                        self.stats.busy += time.time() - start
+        except PipelineStopped:
+            pass
+        except Exception as e:
+            self.error = e
+            self.progress.fail()
+
+
+class PipelineWriters:
+    def __init__(self, connect, queue_depth=8):
+        self.connect = connect
+        self.queue_depth = queue_depth
+        self.progress = WriteProgress()
+        self.writers = {}
+
+    def add_table(self, writer_name, copy_query, parents=(), write=None):
+        self.writers[writer_name] = PipelineWriter(
+            writer_name, copy_query, self.connect, self.progress, self.queue_depth, parents, write)
+        return self.writers[writer_name]
+
+    def __getitem__(self, writer_name):
+        return self.writers[writer_name]
+
+    def start(self):
+        for writer in self.writers.values():
+            writer.thread.start()
+
+    def check(self):
+        for writer in self.writers.values():
+            if writer.error is not None:
+                raise writer.error
+
+    def send(self, seq, stats):
+        # in insertion order, the writers of referenced tables always get the chunk first
+        for writer in self.writers.values():
+            writer.send(seq, stats, self.check)
+
+    def close(self, stats):
+        for writer in self.writers.values():
+            _put(writer.queue, None, stats, self.check)
+        for writer in self.writers.values():
+            writer.thread.join()
+        self.check()
+
+    def abort(self):
+        self.progress.fail()
+        for writer in self.writers.values():
+            while True:
+                try:
+                    writer.queue.get_nowait()
+                except queue.Empty:
+                    break
+            writer.queue.put(None)
+
+
+def _read_chunks(path_to_export, row_range, chunk_lines, chunk_queue, in_flight, num_parsers, stats, stop, errors,
+                 table_name, gauges):
+    def check():
+        if stop.is_set():
+            raise PipelineStopped()
+
+    start = time.time()
+    try:
+        with open_export(path_to_export, row_range[0]) as (f, first_line):
+            seq = 0
+            lines = []
+
+            export_lines = progress.track(table_name, path_to_export, row_range, f, first_line, gauges)
+            for it, line in enumerate(export_lines, first_line):
+                if it < row_range[0]:
+                    continue
+                if row_range[1] != -1 and it >= row_range[1]:
+                    break
+
+                lines.append(line)
+                if len(lines) == chunk_lines:
+                    _send_chunk(chunk_queue, in_flight, (seq, it, lines, compressed_position(f)), stats, check)
+                    seq += 1
+                    lines = []
+
+            if len(lines) > 0:
+                _send_chunk(chunk_queue, in_flight, (seq, it, lines, compressed_position(f)), stats, check)
+    except PipelineStopped:
+        return
+    except Exception as e:
+        errors.append(e)
+    finally:
+        stats.busy = time.time() - start - stats.wait_output
+
+    for _ in range(num_parsers):
+        _put(chunk_queue, None, stats, check)
+
+
+def _send_chunk(chunk_queue, in_flight, chunk, stats, check):
+    # in_flight limits the chunks read but not yet routed, including the ones that
+    # wait in the router for an earlier chunk still being parsed
+    start = time.time()
+    while not in_flight.acquire(timeout=1):
+        check()
+    stats.wait_output += time.time() - start
+
+    _put(chunk_queue, chunk, stats, check)
+
+
+def _parse_chunks(parse_chunk, chunk_queue, result_queue):
+    # runs in a parser process, rows are parsed in chunks to keep the queues cheap
+    stats = StageStats("parse")
+    while True:
+        item = _get(chunk_queue, stats)
+        if item is None:
+            break
+        seq, last_line, lines, bytes_read = item
+
+        start = time.time()
+        try:
+            rows = parse_chunk(lines)
+        except Exception:
+            result_queue.put(("error", traceback.format_exc()))
+            return
+        stats.busy += time.time() - start
+
+        _put(result_queue, ("rows", (seq, last_line, bytes_read, rows)), stats)
+
+    result_queue.put(("done", stats))
+
+
+def run_pipeline(path_to_export, row_range, parse_chunk, route_rows, writers, table_name, start_time,
+                 log_step=1000000, num_parsers=4, chunk_lines=1000, queue_depth=8):
+    # parse_chunk(lines) runs in the parser processes and must be a module level function,
+    # route_rows(rows) gets the parsed chunks in file order and fills writers[name]
+    context = multiprocessing.get_context()
+    chunk_queue = context.Queue(queue_depth)
+    result_queue = context.Queue(queue_depth)
+    in_flight = threading.BoundedSemaphore(2 * queue_depth + num_parsers)
+
+    reader_stats = StageStats("read")
+    parser_stats = StageStats("parse", num_parsers)
+    router_stats = StageStats("route")
+
+    stop = threading.Event()
+    reader_errors = []
+    parser_errors = []
+
+    parsers = [
+        context.Process(target=_parse_chunks, args=(parse_chunk, chunk_queue, result_queue), daemon=True)
+        for _ in range(num_parsers)
+    ]
+    # the queues between the stages, published with the progress of the import
+    gauges = {"queue-chunks": chunk_queue.qsize, "queue-parsed": result_queue.qsize}
+    gauges.update({f"queue-{name}": w.queue.qsize for name, w in writers.writers.items() if hasattr(w, "queue")})
+
+    reader = threading.Thread(
+        target=_read_chunks, name="reader", daemon=True,
+        args=(path_to_export, row_range, chunk_lines, chunk_queue, in_flight, num_parsers, reader_stats, stop, reader_errors,
+              table_name, gauges))
+
+    def check():
+        if len(reader_errors) > 0:
+            raise reader_errors[0]
+        dead = [p for p in parsers if p.exitcode not in (None, 0)]
+        if len(dead) > 0:
+            raise RuntimeError(f"parser process exited with code {dead[0].exitcode}")
+        writers.check()
+
+    prev_block_time = time.time()
+    last_line = row_range[0] - 1
+
+    for parser in parsers:
+        parser.start()
+    reader.start()
+    writers.start()
+
+    try:
+        parsed = {}
+        next_seq = 0
+        finished_parsers = 0
+
+        while finished_parsers < num_parsers:
+            kind, value = _get(result_queue, router_stats, check)
+            if kind == "error":
+                raise RuntimeError(f"parser process failed:\n{value}")
+            if kind == "done":
+                parser_stats.merge(value)
+                finished_parsers += 1
+                continue
+
+            parsed[value[0]] = value[1:]
+
+            # the chunks arrive in any order, the router takes them in file order
+            while next_seq in parsed:
+                chunk_last_line, bytes_read, rows = parsed.pop(next_seq)
+
+                start = time.time()
+                route_rows(rows)
+                router_stats.busy += time.time() - start
+
+                writers.send(next_seq, router_stats)
+                in_flight.release()
+                next_seq += 1
+
+                if chunk_last_line // log_step > last_line // log_step and chunk_last_line >= log_step:
+                    prev_block_time = log_time(table_name, chunk_last_line, log_step, start_time, prev_block_time,
+                                               bytes_read=bytes_read)
+                last_line = chunk_last_line
+
+        if len(reader_errors) > 0:
+            raise reader_errors[0]
+
+        writers.close(router_stats)
+    except BaseException:
+        stop.set()
+        writers.abort()
+        for parser in parsers:
+            parser.terminate()
+        # the chunks nobody will read would keep the process from exiting
+        chunk_queue.cancel_join_thread()
+        raise
+    finally:
+        reader.join()
+        for parser in parsers:
+            parser.join()
+
+    log_time(table_name, last_line, log_step, start_time, prev_block_time, event="finish")
+    report_stalls(table_name, [reader_stats, parser_stats, router_stats] + [w.stats for w in writers.writers.values()])
+
+
+def report_stalls(table_name, stages):
+    print(f"...Pipeline stages of '{table_name}', seconds per worker...")
+    print(f"{'stage':<32}{'busy':>10}{'wait input':>12}{'wait output':>13}")
+    for stage in stages:
+        stage.record(table_name)
+        print(f"{stage.name:<32}{stage.busy / stage.workers:>10.1f}"
+              f"{stage.wait_input / stage.workers:>12.1f}{stage.wait_output / stage.workers:>13.1f}")
+
+    # the busiest stage sets the pace, the stages before it wait on output, the ones after on input
+    bottleneck = max(stages, key=lambda s: s.busy / s.workers)
+    print(f"...The pipeline is limited by '{bottleneck.name}'...")
@@ -1,6 +1,6 @@
 from utils import (
     copy_data_to_table, log_time, not_duplicate, exists, 
-    make_string_valid, exists_same_row
+    make_string_valid
 )
 
 
@@ -28,8 +28,8 @@ def prepare_authors(obj):
 
     public_metrics = [
         "followers_count",
-        "following_count"
-        "tweet_count"
+        "following_count",
+        "tweet_count",
         "listed_count"
     ]
     if exists(obj, "public_metrics") == False:
@@ -0,0 +1,227 @@
+from utils import make_strings_valid
+
+
+# columns of every table produced by the batch functions, the rows of the per-row
+# prepare_* functions are these columns in the same order (hashtags only have "tag")
+BATCH_COLUMNS = {
+    "authors": ["id", "name", "username", "description", "followers_count",
+                "following_count", "tweet_count", "listed_count"],
+    "conversations": ["id", "author_id", "content", "possibly_sensitive", "language", "source",
+                      "retweet_count", "reply_count", "like_count", "quote_count", "created_at"],
+    "hashtags": ["conversation_id", "tag"],
+    "annotations": ["conversation_id", "value", "type", "probability"],
+    "links": ["conversation_id", "url", "title", "description"],
+    "context_domains": ["id", "name", "description"],
+    "context_entities": ["id", "name", "description"],
+    "context_annotations": ["conversation_id", "context_domain_id", "context_entity_id"],
+    "conversation_references": ["conversation_id", "parent_id", "type"],
+}
+
+
+def batch_rows(batch, table_name, columns=None):
+    # turns the columns of one table back into rows, e.g. for copy_data_to_table
+    if columns is None:
+        columns = BATCH_COLUMNS[table_name]
+    return [list(row) for row in zip(*[batch[table_name][c] for c in columns])]
+
+
+def _present(value, is_id=False):
+    return value is not None and not (is_id and value == "")
+
+
+def _int_or_none(value, is_id=False):
+    if not _present(value, is_id):
+        return None
+    try:
+        return int(value)
+    except:
+        return None
+
+
+def _float_or_none(value):
+    try:
+        return float(value)
+    except:
+        return None
+
+
+def int_column(values, is_id=False):
+    return [_int_or_none(v, is_id) for v in values]
+
+
+def string_column(values, max_len=None):
+    strings = make_strings_valid(values)
+    if max_len is not None:
+        strings = [None if s is None else s[:max_len] for s in strings]
+    return strings
+
+
+def select(values, mask):
+    return [v for v, keep in zip(values, mask) if keep]
+
+
+def _metric_columns(objs, metric_names):
+    metrics = [o.get("public_metrics") for o in objs]
+    metrics = [{} if m is None else m for m in metrics]
+    return {m: int_column([pm.get(m) for pm in metrics]) for m in metric_names}
+
+
+def prepare_authors_batch(objs):
+    ids = int_column([o.get("id") for o in objs], is_id=True)
+    valid = [i is not None for i in ids]
+    objs = select(objs, valid)
+
+    columns = {
+        "id": select(ids, valid),
+        "name": string_column([o.get("name") for o in objs], max_len=255),
+        "username": string_column([o.get("username") for o in objs], max_len=255),
+        "description": string_column([o.get("description") for o in objs]),
+    }
+    columns.update(_metric_columns(objs, BATCH_COLUMNS["authors"][4:]))
+
+    return {"authors": columns}
+
+
+def prepare_conversations_batch(objs, prepare_other_models=False):
+    ids = int_column([o.get("id") for o in objs], is_id=True)
+    author_ids = int_column([o.get("author_id") for o in objs], is_id=True)
+
+    valid = [
+        i is not None and a is not None
+        and o.get("text") is not None and o.get("lang") is not None and o.get("source") is not None
+        and "possibly_sensitive" in o and o.get("created_at") is not None
+        for i, a, o in zip(ids, author_ids, objs)
+    ]
+    objs = select(objs, valid)
+    ids = select(ids, valid)
+
+    conversations = {
+        "id": ids,
+        "author_id": select(author_ids, valid),
+        "content": string_column([o["text"] for o in objs]),
+        "possibly_sensitive": [bool(o["possibly_sensitive"]) for o in objs],
+        "language": string_column([o["lang"] for o in objs], max_len=3),
+        "source": string_column([o["source"] for o in objs]),
+    }
+    conversations.update(_metric_columns(objs, BATCH_COLUMNS["conversations"][6:10]))
+    conversations["created_at"] = string_column([o["created_at"] for o in objs])
+
+    batch = {"conversations": conversations}
+    if prepare_other_models == False:
+        return batch
+
+    entities = [o.get("entities") for o in objs]
+    batch["hashtags"] = _hashtag_columns(ids, entities)
+    batch["annotations"] = _annotation_columns(ids, entities)
+    batch["links"] = _link_columns(ids, entities)
+    batch.update(_context_columns(ids, objs))
+    batch["conversation_references"] = _reference_columns(ids, objs)
+
+    return batch
+
+
+def _nested(ids, parents, attr):
+    # flattens the list `attr` of every parent object into (conversation_id, item) pairs
+    pairs = []
+    for conversation_id, parent in zip(ids, parents):
+        if parent is not None and parent.get(attr) is not None:
+            pairs.extend((conversation_id, item) for item in parent[attr])
+    return [p[0] for p in pairs], [p[1] for p in pairs]
+
+
+def _hashtag_columns(ids, entities):
+    conversation_ids, hashtags = _nested(ids, entities, "hashtags")
+    tags = [h.get("tag") for h in hashtags]
+    valid = [t is not None and len(t) > 0 for t in tags]
+
+    return {
+        "conversation_id": select(conversation_ids, valid),
+        "tag": string_column(select(tags, valid)),
+    }
+
+
+def _annotation_columns(ids, entities):
+    conversation_ids, annotations = _nested(ids, entities, "annotations")
+    probabilities = [
+        _float_or_none(a["probability"])
+        if a.get("normalized_text") is not None and a.get("type") is not None and a.get("probability") is not None
+        else None
+        for a in annotations
+    ]
+    valid = [p is not None for p in probabilities]
+    annotations = select(annotations, valid)
+
+    return {
+        "conversation_id": select(conversation_ids, valid),
+        "value": string_column([a["normalized_text"] for a in annotations]),
+        "type": string_column([a["type"] for a in annotations]),
+        "probability": select(probabilities, valid),
+    }
+
+
+def _link_columns(ids, entities):
+    conversation_ids, links = _nested(ids, entities, "urls")
+    links = [(c, l) for c, l in zip(conversation_ids, links) if l.get("expanded_url") is not None]
+
+    urls = string_column([l.get("expanded_url") for _, l in links])
+    valid = [len(u) <= 2048 for u in urls]
+    links = select(links, valid)
+
+    return {
+        "conversation_id": [c for c, _ in links],
+        "url": select(urls, valid),
+        "title": string_column([l.get("title") for _, l in links]),
+        "description": string_column([l.get("description") for _, l in links]),
+    }
+
+
+def _context_columns(ids, objs):
+    conversation_ids, contexts = _nested(ids, objs, "context_annotations")
+    contexts = [(c, ctx) for c, ctx in zip(conversation_ids, contexts)
+                if ctx.get("domain") is not None and ctx.get("entity") is not None]
+
+    # the domain is checked first, an invalid one drops the whole context annotation
+    domains = [ctx["domain"] for _, ctx in contexts]
+    entities = [ctx["entity"] for _, ctx in contexts]
+    domain_ids = [_int_or_none(d.get("id"), is_id=True) if d.get("name") is not None else None for d in domains]
+    entity_ids = [_int_or_none(e.get("id"), is_id=True) if e.get("name") is not None else None for e in entities]
+
+    valid = [d is not None and e is not None for d, e in zip(domain_ids, entity_ids)]
+    contexts = select(contexts, valid)
+    domains = select(domains, valid)
+    entities = select(entities, valid)
+    domain_ids = select(domain_ids, valid)
+    entity_ids = select(entity_ids, valid)
+
+    return {
+        "context_domains": {
+            "id": domain_ids,
+            "name": string_column([d["name"] for d in domains], max_len=255),
+            "description": string_column([d.get("description") for d in domains]),
+        },
+        "context_entities": {
+            "id": entity_ids,
+            "name": string_column([e["name"] for e in entities], max_len=255),
+            "description": string_column([e.get("description") for e in entities]),
+        },
+        "context_annotations": {
+            "conversation_id": [c for c, _ in contexts],
+            "context_domain_id": domain_ids,
+            "context_entity_id": entity_ids,
+        },
+    }
+
+
+def _reference_columns(ids, objs):
+    conversation_ids, references = _nested(ids, objs, "referenced_tweets")
+    parent_ids = [
+        _int_or_none(r.get("id"), is_id=True) if r.get("type") is not None else None
+        for r in references
+    ]
+    valid = [p is not None for p in parent_ids]
+
+    return {
+        "conversation_id": select(conversation_ids, valid),
+        "parent_id": select(parent_ids, valid),
+        "type": string_column([r["type"] for r in select(references, valid)], max_len=20),
+    }
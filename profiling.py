@@ -0,0 +1,142 @@
+import cProfile
+import glob
+import io
+import os
+import pstats
+import random
+import time
+from collections import Counter, defaultdict
+
+import metrics
+
+
+# where the time of an importer goes, stage by stage:
+#
+#   read         decompressing and splitting the export into lines
+#   json         json_backend.loads
+#   preprocess   preprocess.prepare_*
+#   dedup        dropping repeated ids and rows before a flush
+#   copy         encoding the rows and sending them to the COPY streams
+#   commit       the commits of the writers, with the checkpoints
+#
+# the timers are a few perf_counter() calls per line, cheap enough to stay on; every
+# importer records its stages as a "profile" event, metrics.print_report() adds them up
+# over all processes (importer x stage x seconds/rows)
+#
+#   PDT_PROFILE          "cprofile" also runs cProfile over a sample of the blocks of lines
+#                        every process reads, the profiles of all processes are merged
+#                        by print_profile()
+#   PDT_PROFILE_SAMPLE   part of the blocks profiled, 0.05 by default
+
+# lines of a block, cProfile is switched on or off only between blocks
+SAMPLE_LINES = 10000
+
+PROFILE_PREFIX = "profile-"
+
+def cprofile_enabled():
+    return os.getenv("PDT_PROFILE") == "cprofile"
+
+
+def sample_rate():
+    return float(os.getenv("PDT_PROFILE_SAMPLE", 0.05))
+
+
+def profile_path(importer_name, logs_dir=metrics.LOGS_DIR):
+    return os.path.join(logs_dir, f"{PROFILE_PREFIX}{os.getpid()}-{importer_name}.prof")
+
+
+class StageTimer:
+    # seconds and rows of every stage of one importer in this process
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.rows = Counter()
+        self.profiler = cProfile.Profile() if cprofile_enabled() else None
+        self.sample_rate = sample_rate()
+        # seeded from os.urandom, forked workers do not all sample the same blocks
+        self.random = random.Random()
+        self.sampling = False
+        self.blocks = 0
+        self.sampled_blocks = 0
+        self.reader = None
+
+    def lap(self, stage, start, rows=1):
+        # start is the perf_counter() the stage started at, returns the one the next stage starts at
+        now = time.perf_counter()
+        self.seconds[stage] += now - start
+        self.rows[stage] += rows
+        return now
+
+    def add(self, stage, seconds, rows):
+        self.seconds[stage] += seconds
+        self.rows[stage] += rows
+
+    def read(self, lines):
+        self.reader = self._read(lines)
+        return self.reader
+
+    def _read(self, lines):
+        # yields the lines, timing the reads; cProfile sees the whole loop of the
+        # importer while a sampled block is read, the time of the consumer included
+        read_seconds = 0.0
+        num_lines = 0
+        try:
+            start = time.perf_counter()
+            for line in lines:
+                read_seconds += time.perf_counter() - start
+                if self.profiler is not None and num_lines % SAMPLE_LINES == 0:
+                    self.next_block()
+                num_lines += 1
+                yield line
+                start = time.perf_counter()
+        finally:
+            self.stop_sampling()
+            self.add("read", read_seconds, num_lines)
+
+    def next_block(self):
+        self.blocks += 1
+        sample = self.random.random() < self.sample_rate
+        if sample:
+            self.sampled_blocks += 1
+            if not self.sampling:
+                self.profiler.enable()
+        elif self.sampling:
+            self.profiler.disable()
+        self.sampling = sample
+
+    def stop_sampling(self):
+        if self.sampling:
+            self.profiler.disable()
+            self.sampling = False
+
+    def finish(self, importer_name):
+        # an importer that stops at the end of its row range leaves the reader open
+        if self.reader is not None:
+            self.reader.close()
+        self.stop_sampling()
+        metrics.record("profile", importer_name,
+                       stages={stage: {"seconds": self.seconds[stage], "rows": self.rows[stage]}
+                               for stage in self.seconds})
+        if self.profiler is not None and self.sampled_blocks > 0:
+            os.makedirs(metrics.LOGS_DIR, exist_ok=True)
+            self.profiler.dump_stats(profile_path(importer_name))
+            print(f"...Profiled {self.sampled_blocks} of {self.blocks} blocks of '{importer_name}'...")
+
+
+def merged_profile(logs_dir=metrics.LOGS_DIR):
+    # the sampled profiles of all processes and importers in one pstats.Stats, None without any
+    paths = sorted(glob.glob(os.path.join(logs_dir, f"{PROFILE_PREFIX}*.prof")))
+    if len(paths) == 0:
+        return None
+    return pstats.Stats(*paths, stream=io.StringIO())
+
+
+def print_profile(logs_dir=metrics.LOGS_DIR, limit=25):
+    stats = merged_profile(logs_dir)
+    if stats is None:
+        return
+
+    stream = io.StringIO()
+    stats.stream = stream
+    stats.strip_dirs().sort_stats("cumulative").print_stats(limit)
+    print("\nsampled cProfile of all worker processes:")
+    print(stream.getvalue().strip())
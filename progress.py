@@ -0,0 +1,310 @@
+import glob
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import metrics
+from checkpoints import checkpoint_name
+from gzip_index import compressed_position, load_line_index
+from utils import format_duration
+
+
+# live progress of the imports: every importer reading an export (a "job") writes its
+# state into LOGS_DIR/progress-<pid>-<job>.json every few seconds, from whichever process
+# it runs in; the main process reads all of them and publishes
+#
+#   - a Prometheus text file (--progress-file, for node_exporter's textfile collector)
+#   - an HTTP endpoint (--progress-port, http://localhost:<port>/metrics)
+#   - a status line on the console (--progress-seconds)
+#
+# the progress is measured in lines when the export has a line index (gzip_index.py),
+# which also gives the end of a shard, and in compressed bytes of the file otherwise
+
+# lines between two updates of a job, and seconds between two writes of its file
+UPDATE_LINES = 10000
+PUBLISH_SECONDS = 2.0
+
+STATUS_PREFIX = "progress-"
+
+# per process, filled in by writers.WriterGroup and pipeline.PipelineWriter
+flush_latency = {"count": 0, "seconds": 0.0, "max": 0.0}
+
+def record_flush(seconds):
+    flush_latency["count"] += 1
+    flush_latency["seconds"] += seconds
+    flush_latency["max"] = max(flush_latency["max"], seconds)
+
+
+class Job:
+    def __init__(self, name, path_to_export, row_range=(0, -1), logs_dir=metrics.LOGS_DIR):
+        self.name = name
+        self.path = os.path.join(logs_dir, f"{STATUS_PREFIX}{os.getpid()}-{name}.json")
+        self.row_range = row_range
+        self.started = time.time()
+        self.last_publish = 0.0
+        self.finished = False
+        self.gauges = {}
+        self.rows_at_start = metrics.rows_written.copy()
+
+        line_index = load_line_index(path_to_export)
+        if line_index is not None:
+            end = row_range[1] if row_range[1] != -1 else line_index["total_lines"]
+            self.unit = "lines"
+            self.total = max(end - row_range[0], 0)
+        else:
+            self.unit = "bytes"
+            self.total = os.path.getsize(path_to_export)
+
+        self.line = row_range[0]
+        self.done = 0
+        self.done_at_start = None
+
+    def add_gauge(self, name, read):
+        # read() is called on every publish, e.g. the size of a queue
+        self.gauges[name] = read
+
+    def update(self, line, bytes_read):
+        self.line = line
+        if self.unit == "lines":
+            self.done = max(line - self.row_range[0], 0)
+        elif bytes_read is not None:
+            self.done = bytes_read
+
+        # a resumed import starts with part of the work done
+        if self.done_at_start is None:
+            self.done_at_start = self.done
+        if time.time() - self.last_publish >= PUBLISH_SECONDS:
+            self.publish()
+
+    def status(self):
+        gauges = {}
+        for name, read in self.gauges.items():
+            try:
+                gauges[name] = read()
+            except (NotImplementedError, OSError, ValueError):
+                continue
+
+        return {
+            "job": self.name,
+            "pid": os.getpid(),
+            "started": self.started,
+            "updated": time.time(),
+            "finished": self.finished,
+            "line": self.line,
+            "unit": self.unit,
+            "done": self.done,
+            "done_at_start": self.done_at_start or 0,
+            "total": self.total,
+            "rows_written": dict(metrics.rows_written - self.rows_at_start),
+            "flush": dict(flush_latency),
+            "gauges": gauges,
+        }
+
+    def publish(self):
+        self.last_publish = time.time()
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.status(), f)
+        os.replace(tmp_path, self.path)
+
+    def finish(self):
+        self.finished = True
+        self.publish()
+
+
+def track(importer_name, path_to_export, row_range, f, first_line, gauges=None):
+    # yields the lines of f and keeps the job of the importer up to date; the job is
+    # finished at the end of the file or of its range, a job whose importer failed
+    # keeps its last state
+    job = Job(checkpoint_name(importer_name, row_range), path_to_export, row_range)
+    for name, read in (gauges or {}).items():
+        job.add_gauge(name, read)
+
+    line = first_line
+    next_update = first_line + UPDATE_LINES
+    job.update(line, compressed_position(f))
+    for raw_line in f:
+        if line >= next_update:
+            job.update(line, compressed_position(f))
+            next_update = line + UPDATE_LINES
+        # the importers stop after the last line of their range, with the file
+        # closed before this generator is
+        if line == row_range[1]:
+            job.update(line, compressed_position(f))
+            job.finish()
+        line += 1
+        yield raw_line
+
+    job.update(line, compressed_position(f))
+    job.finish()
+
+
+def clear_statuses(logs_dir=metrics.LOGS_DIR):
+    # the jobs of a previous run, a resumed import writes new files
+    for path in glob.glob(os.path.join(logs_dir, f"{STATUS_PREFIX}*.json")):
+        os.remove(path)
+
+
+def read_statuses(logs_dir=metrics.LOGS_DIR):
+    statuses = []
+    for path in glob.glob(os.path.join(logs_dir, f"{STATUS_PREFIX}*.json")):
+        try:
+            with open(path) as f:
+                statuses.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return sorted(statuses, key=lambda s: (s["started"], s["job"]))
+
+
+def rates(status):
+    # (fraction done, work per second, seconds left) of a job, the rate counts only the
+    # work of this run; None while there is nothing to tell from
+    elapsed = status["updated"] - status["started"]
+    fraction = status["done"] / status["total"] if status["total"] > 0 else None
+    rate = (status["done"] - status["done_at_start"]) / elapsed if elapsed > 0 else 0
+
+    eta = None
+    if status["finished"]:
+        eta = 0.0
+    elif rate > 0:
+        eta = max(status["total"] - status["done"], 0) / rate
+    return fraction, rate, eta
+
+
+def prometheus_text(statuses):
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append(f"# HELP pdt_{name} {help_text}")
+        lines.append(f"# TYPE pdt_{name} {kind}")
+        for labels, value in samples:
+            label_text = ",".join(f'{k}="{v}"' for k, v in labels.items())
+            lines.append(f"pdt_{name}{{{label_text}}} {value}")
+
+    jobs = [({"job": s["job"], "pid": s["pid"]}, s) for s in statuses]
+    job_rates = {id(s): rates(s) for s in statuses}
+
+    metric("job_progress_ratio", "gauge", "Part of its export a job has read.",
+           [(l, job_rates[id(s)][0]) for l, s in jobs if job_rates[id(s)][0] is not None])
+    metric("job_eta_seconds", "gauge", "Seconds until a job has read its export.",
+           [(l, round(job_rates[id(s)][2], 1)) for l, s in jobs if job_rates[id(s)][2] is not None])
+    metric("job_finished", "gauge", "1 once a job has read its whole export.",
+           [(l, int(s["finished"])) for l, s in jobs])
+    metric("job_line", "gauge", "Number of the last line a job has read.", [(l, s["line"]) for l, s in jobs])
+
+    rows, rows_per_s = [], []
+    for labels, s in jobs:
+        elapsed = s["updated"] - s["started"]
+        for table_name, num_rows in sorted(s["rows_written"].items()):
+            rows.append((dict(labels, table=table_name), num_rows))
+            if elapsed > 0:
+                rows_per_s.append((dict(labels, table=table_name), round(num_rows / elapsed, 1)))
+    metric("rows_written", "counter", "Rows a job has written to a table.", rows)
+    metric("rows_per_second", "gauge", "Rows a job writes to a table per second.", rows_per_s)
+
+    metric("queue_depth", "gauge", "Items waiting in a queue of a job.",
+           [(dict(l, queue=name), value) for l, s in jobs for name, value in sorted(s["gauges"].items())])
+
+    # the flushes of a process, every job of it reports the same numbers
+    processes = {s["pid"]: s["flush"] for s in statuses}
+    metric("flush_seconds_sum", "counter", "Seconds spent flushing buffered rows.",
+           [({"pid": pid}, round(f["seconds"], 3)) for pid, f in processes.items()])
+    metric("flush_count", "counter", "Flushes of buffered rows.",
+           [({"pid": pid}, f["count"]) for pid, f in processes.items()])
+    metric("flush_seconds_max", "gauge", "Longest flush of buffered rows.",
+           [({"pid": pid}, round(f["max"], 3)) for pid, f in processes.items()])
+
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(path, logs_dir=metrics.LOGS_DIR):
+    # replaced at once, the collector never reads a partial file
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(prometheus_text(read_statuses(logs_dir)))
+    os.replace(tmp_path, path)
+
+
+def status_line(statuses):
+    # "conversations 53% 12,345 rows/s ETA 03:12 | context-5000000 12% ..."
+    parts = []
+    for s in statuses:
+        fraction, _, eta = rates(s)
+        elapsed = s["updated"] - s["started"]
+        rows_per_s = sum(s["rows_written"].values()) / elapsed if elapsed > 0 else 0
+
+        part = s["job"]
+        if fraction is not None:
+            part += f" {min(fraction, 1.0):.0%}"
+        if s["finished"]:
+            part += " done"
+        else:
+            part += f" {rows_per_s:,.0f} rows/s"
+            if eta is not None:
+                part += f" ETA {format_duration(eta)}"
+        parts.append(part)
+    return " | ".join(parts)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    logs_dir = metrics.LOGS_DIR
+
+    def do_GET(self):
+        if self.path not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = prometheus_text(read_statuses(self.logs_dir)).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Monitor:
+    # runs in the main process next to the import, publishes what the jobs report
+    def __init__(self, prometheus_path=None, port=None, console_seconds=10.0, logs_dir=metrics.LOGS_DIR):
+        self.prometheus_path = prometheus_path
+        self.console_seconds = console_seconds
+        self.logs_dir = logs_dir
+        self.stop_event = threading.Event()
+        self.server = None
+        if port is not None:
+            _MetricsHandler.logs_dir = logs_dir
+            self.server = ThreadingHTTPServer(("localhost", port), _MetricsHandler)
+        self.thread = threading.Thread(target=self.run, name="progress", daemon=True)
+
+    def start(self):
+        if self.server is not None:
+            threading.Thread(target=self.server.serve_forever, name="progress-http", daemon=True).start()
+            print(f"...Serving the progress at http://localhost:{self.server.server_address[1]}/metrics...")
+        self.thread.start()
+        return self
+
+    def publish(self, console=True):
+        statuses = read_statuses(self.logs_dir)
+        if self.prometheus_path is not None:
+            write_prometheus(self.prometheus_path, self.logs_dir)
+        if console and len(statuses) > 0:
+            print(f"[progress] {status_line(statuses)}")
+
+    def run(self):
+        last_console = time.time()
+        while not self.stop_event.wait(PUBLISH_SECONDS):
+            console = self.console_seconds > 0 and time.time() - last_console >= self.console_seconds
+            self.publish(console)
+            if console:
+                last_console = time.time()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+        self.publish(console=False)
+        if self.server is not None:
+            self.server.shutdown()
@@ -0,0 +1,175 @@
+import hashlib
+import itertools
+import os
+
+import numpy as np
+
+import metrics
+from id_set import IdSet, MappedIdSet, merge_runs, save_ids
+
+
+# drops repeated rows of the child tables, rows equal in every column of their COPY
+# query; every row is kept as a 128-bit hash (two int64) in an IdSet, once the hashes
+# of a table take more than PDT_DEDUP_MB they are spilled into a sorted run under
+# DEDUP_DIR, and the runs on disk are merged like the runs of an IdSet, so there are
+# only log(n) of them to look the new rows up in
+#
+#   PDT_DEDUP_CHILD_ROWS   "0" keeps the repeated rows
+#   PDT_DEDUP_MB           MB of hashes every table keeps in memory
+
+# sorted by high, then low
+HASH_DTYPE = np.dtype([("high", np.int64), ("low", np.int64)])
+
+DEDUP_DIR = "./dedup"
+
+_run_numbers = itertools.count()
+
+
+def enabled():
+    return os.getenv("PDT_DEDUP_CHILD_ROWS", "1") != "0"
+
+
+def memory_budget():
+    return int(float(os.getenv("PDT_DEDUP_MB", 64)) * 2**20)
+
+
+def hash_rows(rows):
+    # 16 bytes of blake2b over every column; two different rows sharing a hash would
+    # drop one of them, which at 128 bits does not happen for any number of rows
+    keys = np.empty(len(rows), dtype=HASH_DTYPE)
+    for i, row in enumerate(rows):
+        digest = hashlib.blake2b(repr(tuple(row)).encode("utf-8", "surrogatepass"), digest_size=16).digest()
+        keys[i] = (int.from_bytes(digest[:8], "big", signed=True), int.from_bytes(digest[8:], "big", signed=True))
+    return keys
+
+
+class RowDedup:
+    # the hashes of the rows of one table seen so far
+    def __init__(self, table_name, memory_budget=None, dedup_dir=DEDUP_DIR):
+        self.table_name = table_name
+        self.memory_budget = memory_budget
+        self.dedup_dir = dedup_dir
+        self.memory = IdSet(dtype=HASH_DTYPE)
+        self.runs = []
+        self.kept = 0
+        self.dropped = 0
+        self.spills = 0
+
+    def __len__(self):
+        return len(self.memory) + sum(len(run) for run in self.runs)
+
+    def budget(self):
+        return memory_budget() if self.memory_budget is None else self.memory_budget
+
+    def filter(self, rows):
+        # the rows not seen yet, in their order
+        if len(rows) == 0:
+            return rows
+
+        keys = hash_rows(rows)
+        mask = np.ones(len(keys), dtype=bool)
+        for run in self.runs:
+            mask &= ~run.contains_many(keys)
+
+        is_new = np.zeros(len(keys), dtype=bool)
+        is_new[mask] = self.memory.add_and_test(keys[mask])
+
+        if self.memory.nbytes() >= self.budget():
+            self.spill()
+
+        num_new = int(is_new.sum())
+        self.kept += num_new
+        self.dropped += len(rows) - num_new
+        if num_new == len(rows):
+            return rows
+        return [row for row, new in zip(rows, is_new.tolist()) if new]
+
+    def new_run_path(self):
+        return os.path.join(self.dedup_dir, f"{self.table_name}-{os.getpid()}-{next(_run_numbers):05d}.npy")
+
+    def spill(self):
+        if len(self.memory) == 0:
+            return
+
+        path = self.new_run_path()
+        save_ids(path, self.memory)
+        self.memory = IdSet(dtype=HASH_DTYPE)
+        self.spills += 1
+        self.add_run(MappedIdSet(path))
+
+    def add_run(self, run):
+        # the same rule as IdSet.add_run, with the runs in files
+        self.runs.append(run)
+
+        while len(self.runs) > 1 and len(self.runs[-2]) <= len(self.runs[-1]):
+            last = self.runs.pop()
+            previous = self.runs.pop()
+            path = self.new_run_path()
+            merge_runs([previous.path, last.path], path)
+            for merged_run in [previous, last]:
+                os.remove(merged_run.path)
+            self.runs.append(MappedIdSet(path))
+
+    def close(self):
+        for run in self.runs:
+            if os.path.exists(run.path):
+                os.remove(run.path)
+        self.runs = []
+        self.memory = IdSet(dtype=HASH_DTYPE)
+
+    def __getstate__(self):
+        # a checkpoint holds copies of the spilled runs, by the time an import resumes
+        # from it the files may have been merged into others
+        state = self.__dict__.copy()
+        state["runs"] = [np.array(run.ids) for run in self.runs]
+        return state
+
+    def __setstate__(self, state):
+        runs = state.pop("runs")
+        self.__dict__.update(state)
+        self.runs = []
+        for ids in runs:
+            path = self.new_run_path()
+            save_ids(path, ids)
+            self.runs.append(MappedIdSet(path))
+
+
+class ChildRowDedup:
+    # one RowDedup for every writer of a child table, writer name -> table name;
+    # drop_duplicates() filters the rows the writers buffer, so the rows are hashed
+    # and looked up a whole flush at a time
+    def __init__(self, writer_tables, memory_budget=None, dedup_dir=DEDUP_DIR):
+        if not enabled():
+            writer_tables = {}
+        self.dedups = {writer_name: RowDedup(table_name, memory_budget, dedup_dir)
+                       for writer_name, table_name in writer_tables.items()}
+        # writer name -> (buffer, rows of it filtered already), a writer that keeps its
+        # rows across calls (staging.StagedTable) must not have them filtered twice
+        self.checked = {}
+
+    def drop_duplicates(self, writers):
+        for writer_name, dedup in self.dedups.items():
+            writer = writers[writer_name]
+            buffer, checked = self.checked.get(writer_name, (None, 0))
+            if writer.rows is not buffer:
+                writer.rows = dedup.filter(writer.rows)
+            elif checked < len(writer.rows):
+                writer.rows = writer.rows[:checked] + dedup.filter(writer.rows[checked:])
+            self.checked[writer_name] = (writer.rows, len(writer.rows))
+
+    def nbytes(self):
+        # the hashes in memory, the spilled runs are in the page cache
+        return sum(dedup.memory.nbytes() for dedup in self.dedups.values())
+
+    def spill(self):
+        for dedup in self.dedups.values():
+            dedup.spill()
+
+    def finish(self, importer_name):
+        # the runs are not needed once the import is done
+        for dedup in self.dedups.values():
+            if dedup.dropped > 0:
+                print(f"...Dropped {dedup.dropped} repeated rows of '{dedup.table_name}'...")
+            metrics.record("dedup", dedup.table_name, importer=importer_name, kept=dedup.kept,
+                           dropped=dedup.dropped, spills=dedup.spills)
+            dedup.close()
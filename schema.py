@@ -0,0 +1,280 @@
+# table definitions shared by the importers, in the order they reference each other;
+# the constraint names are the ones postgres generates for the inline declarations;
+# "dimension" tables are filled through dimensions.py and keep their keys in every mode
+TABLES = {
+    "authors": {
+        "columns": [
+            "id int8",
+            "name varchar(255)",
+            "username varchar(255)",
+            "description text",
+            "followers_count int4",
+            "following_count int4",
+            "tweet_count int4",
+            "listed_count int4",
+        ],
+        "primary_key": "id",
+        "unique": [],
+        "foreign_keys": [],
+    },
+    "conversations": {
+        "columns": [
+            "id int8",
+            "author_id int8 NOT NULL",
+            "content text NOT NULL",
+            "possibly_sensitive bool NOT NULL",
+            "language varchar(3) NOT NULL",
+            "source text NOT NULL",
+            "retweet_count int4",
+            "reply_count int4",
+            "like_count int4",
+            "quote_count int4",
+            "created_at TIMESTAMPTZ",
+        ],
+        "primary_key": "id",
+        "unique": [],
+        "foreign_keys": [("author_id", "authors")],
+    },
+    "hashtags": {
+        "columns": [
+            "id int8",
+            "tag text NOT NULL",
+        ],
+        "primary_key": "id",
+        "unique": ["tag"],
+        "foreign_keys": [],
+        "dimension": True,
+    },
+    "conversation_hashtags": {
+        "columns": [
+            "id BIGSERIAL",
+            "conversation_id int8 NOT NULL",
+            "hashtag_id int8 NOT NULL",
+        ],
+        "primary_key": "id",
+        "unique": [],
+        "foreign_keys": [("conversation_id", "conversations"), ("hashtag_id", "hashtags")],
+    },
+    "context_domains": {
+        "columns": [
+            "id int8",
+            "name varchar(255) NOT NULL",
+            "description text",
+        ],
+        "primary_key": "id",
+        "unique": [],
+        "foreign_keys": [],
+        "dimension": True,
+    },
+    "context_entities": {
+        "columns": [
+            "id int8",
+            "name varchar(255) NOT NULL",
+            "description text",
+        ],
+        "primary_key": "id",
+        "unique": [],
+        "foreign_keys": [],
+        "dimension": True,
+    },
+    "context_annotations": {
+        "columns": [
+            "id BIGSERIAL",
+            "conversation_id int8 NOT NULL",
+            "context_domain_id int8 NOT NULL",
+            "context_entity_id int8 NOT NULL",
+        ],
+        "primary_key": "id",
+        "unique": [],
+        "foreign_keys": [
+            ("conversation_id", "conversations"),
+            ("context_domain_id", "context_domains"),
+            ("context_entity_id", "context_entities"),
+        ],
+    },
+    "annotations": {
+        "columns": [
+            "id BIGSERIAL",
+            "conversation_id int8 NOT NULL",
+            "value text NOT NULL",
+            "type text NOT NULL",
+            "probability numeric(4,3) NOT NULL",
+        ],
+        "primary_key": "id",
+        "unique": [],
+        "foreign_keys": [("conversation_id", "conversations")],
+    },
+    "links": {
+        "columns": [
+            "id BIGSERIAL",
+            "conversation_id int8 NOT NULL",
+            "url varchar(2048) NOT NULL",
+            "title text",
+            "description text",
+        ],
+        "primary_key": "id",
+        "unique": [],
+        "foreign_keys": [("conversation_id", "conversations")],
+    },
+    "conversation_references": {
+        "columns": [
+            "id BIGSERIAL",
+            "conversation_id int8 NOT NULL",
+            "parent_id int8 NOT NULL",
+            "type varchar(20) NOT NULL",
+        ],
+        "primary_key": "id",
+        "unique": [],
+        "foreign_keys": [("conversation_id", "conversations"), ("parent_id", "conversations")],
+    },
+}
+
+
+# tables used only during the import, they are not part of the final schema
+STAGING_TABLES = {
+    "pending_references": {
+        "columns": [
+            "seq BIGSERIAL",
+            "conversation_id int8 NOT NULL",
+            "parent_id int8 NOT NULL",
+            "type varchar(20) NOT NULL",
+        ],
+    },
+}
+
+
+# unlogged copies of the tables, an incremental import (delta.py) copies a new dump into them
+DELTA_PREFIX = "delta_"
+
+
+def column_types(table_name, column_names):
+    # the type of every column without its modifiers, e.g. "varchar" for "varchar(255)"
+    if table_name.startswith(DELTA_PREFIX):
+        table_name = table_name[len(DELTA_PREFIX):]
+    table = TABLES[table_name] if table_name in TABLES else STAGING_TABLES[table_name]
+    types = {c.split()[0]: c.split()[1].split("(")[0].lower() for c in table["columns"]}
+    return [types[c] for c in column_names]
+
+
+def create_table_sql(table_name, bulk_load=False, unlogged=False, temporary=False):
+    # in bulk load mode the table is created bare, its constraints are added by
+    # the statements below once all the data is copied; the keys of a dimension
+    # table are needed while loading, its rows are inserted with ON CONFLICT
+    table = TABLES[table_name]
+    lines = list(table["columns"])
+
+    if bulk_load == False or is_dimension(table_name):
+        lines[0] += " PRIMARY KEY"
+        lines = [l + " UNIQUE" if l.split()[0] in table["unique"] else l for l in lines]
+    if bulk_load == False:
+        lines += [f"FOREIGN KEY({column}) REFERENCES {parent} (id)" for column, parent in table["foreign_keys"]]
+
+    columns = ",\n    ".join(lines)
+    return f"""
+    CREATE {"TEMPORARY " if temporary else "UNLOGGED " if unlogged else ""}TABLE IF NOT EXISTS {table_name} (
+    {columns}
+    );
+"""
+
+
+def is_dimension(table_name):
+    return table_name in TABLES and TABLES[table_name].get("dimension", False)
+
+
+def parent_tables(table_name):
+    # tables referenced by table_name, a table not listed in TABLES references nothing
+    if table_name not in TABLES:
+        return []
+    return [p for _, p in TABLES[table_name]["foreign_keys"] if p != table_name]
+
+
+def create_staging_table_sql(table_name):
+    columns = ",\n    ".join(STAGING_TABLES[table_name]["columns"])
+    return f"""
+    CREATE TABLE IF NOT EXISTS {table_name} (
+    {columns}
+    );
+"""
+
+
+def delta_table_name(table_name):
+    return DELTA_PREFIX + table_name
+
+
+def create_delta_table_sql(table_name):
+    # the columns of the table without constraints and without the serial ids
+    columns = ",\n    ".join(" ".join(c.split()[:2]) for c in TABLES[table_name]["columns"]
+                              if c.split()[1] != "BIGSERIAL")
+    return f"""
+    CREATE UNLOGGED TABLE {delta_table_name(table_name)} (
+    {columns}
+    );
+"""
+
+
+def dependency_levels(table_names):
+    # groups the tables so that every table comes after the tables it references
+    depth = {}
+    for table_name in TABLES:
+        depth[table_name] = 1 + max([depth[p] for p in parent_tables(table_name)], default=-1)
+
+    levels = {}
+    for table_name in table_names:
+        levels.setdefault(depth[table_name], []).append(table_name)
+    return [levels[d] for d in sorted(levels)]
+
+
+def foreign_key_name(table_name, column):
+    return f"{table_name}_{column}_fkey"
+
+
+def key_constraint_sqls(table_name):
+    # dimension tables are created with their keys
+    if is_dimension(table_name):
+        return []
+
+    table = TABLES[table_name]
+    sqls = [f"ALTER TABLE {table_name} ADD CONSTRAINT {table_name}_pkey PRIMARY KEY ({table['primary_key']})"]
+    sqls += [f"ALTER TABLE {table_name} ADD CONSTRAINT {table_name}_{column}_key UNIQUE ({column})"
+             for column in table["unique"]]
+    return sqls
+
+
+def foreign_key_sqls(table_name):
+    # added as NOT VALID, so adding them does not scan the table
+    return [
+        f"""ALTER TABLE {table_name} ADD CONSTRAINT {foreign_key_name(table_name, column)}
+            FOREIGN KEY ({column}) REFERENCES {parent} (id) NOT VALID"""
+        for column, parent in TABLES[table_name]["foreign_keys"]
+    ]
+
+
+def validate_sqls(table_name):
+    return [
+        f"ALTER TABLE {table_name} VALIDATE CONSTRAINT {foreign_key_name(table_name, column)}"
+        for column, _ in TABLES[table_name]["foreign_keys"]
+    ]
+
+
+def rejected_table_name(table_name):
+    return f"rejected_{table_name}"
+
+
+def create_rejected_table_sql(table_name):
+    # same columns as the table plus the name of the violated constraint
+    return f"""
+        CREATE TABLE IF NOT EXISTS {rejected_table_name(table_name)} AS
+        SELECT t.*, ''::text AS violated_constraint FROM {table_name} t WHERE false
+    """
+
+
+def move_orphans_sql(table_name, column, parent):
+    return f"""
+        WITH moved AS (
+            DELETE FROM {table_name} t
+            WHERE NOT EXISTS (SELECT 1 FROM {parent} p WHERE p.id = t.{column})
+            RETURNING t.*
+        )
+        INSERT INTO {rejected_table_name(table_name)}
+        SELECT moved.*, '{foreign_key_name(table_name, column)}' FROM moved
+    """
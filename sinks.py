@@ -0,0 +1,224 @@
+import itertools
+import os
+
+import connection_pool
+import copy_formats
+
+
+# where the importers write, every importer gets its connections from connect():
+# "postgres" is the database (connection_pool.py), "null" only counts the rows
+# (metrics.py still reports them), so the parsing can be measured apart from the
+# database, and "file" writes the data of every COPY into files under PDT_SINK_DIR
+# for a later COPY FROM (or pg_bulkload) on another machine. Without a database
+# nothing is checked: the references stay in pending_references and the dimension
+# files can repeat a key
+SINKS = ["postgres", "null", "file"]
+
+sink_name = os.getenv("PDT_SINK", "postgres")
+
+SINK_DIR = os.getenv("PDT_SINK_DIR", "./sink_output")
+
+# "copy" is COPY's text format, "csv" is for COPY ... (FORMAT CSV); with a binary
+# copy format (copy_formats.py) the files are in COPY's binary format either way
+FILE_FORMATS = ["copy", "csv"]
+
+file_format = os.getenv("PDT_SINK_FORMAT", "copy")
+
+
+def set_sink(name, file_format_name=None):
+    # also exported to the environment, so the worker processes use the same sink
+    global sink_name, file_format
+    if name not in SINKS:
+        raise ValueError(f"unknown sink '{name}', expected one of {SINKS}")
+    sink_name = name
+    os.environ["PDT_SINK"] = name
+
+    if file_format_name is not None:
+        if file_format_name not in FILE_FORMATS:
+            raise ValueError(f"unknown file format '{file_format_name}', expected one of {FILE_FORMATS}")
+        file_format = file_format_name
+        os.environ["PDT_SINK_FORMAT"] = file_format_name
+
+
+def connect(**kwargs):
+    if sink_name == "null":
+        return NullConnection()
+    if sink_name == "file":
+        return FileConnection(SINK_DIR)
+    return connection_pool.connect(**kwargs)
+
+
+def is_array_insert(query, params):
+    # dimensions.insert_rows: INSERT ... SELECT * FROM unnest(<one array per column>)
+    return params is not None and query.lstrip().startswith("INSERT INTO") and "unnest(" in query
+
+
+class NullCopy:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def write_row(self, row):
+        pass
+
+    def write(self, data):
+        pass
+
+    def set_types(self, types):
+        pass
+
+
+class NullCursor:
+    # accepts every statement and returns no rows, an array INSERT reports all its rows as new
+    rowcount = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def execute(self, query, params=None):
+        self.rowcount = len(params[0]) if is_array_insert(query, params) and len(params) > 0 else 0
+        return self
+
+    def fetchone(self):
+        return None
+
+    def fetchall(self):
+        return []
+
+    def fetchmany(self, size=0):
+        return []
+
+    def __iter__(self):
+        return iter([])
+
+    def copy(self, query, params=None):
+        return NullCopy()
+
+    def close(self):
+        pass
+
+
+class NullConnection:
+    autocommit = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def cursor(self, *args, **kwargs):
+        return NullCursor()
+
+    def execute(self, query, params=None):
+        return self.cursor().execute(query, params)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def _text_value(value):
+    if value is None:
+        return "\\N"
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    return (str(value).replace("\\", "\\\\").replace("\t", "\\t")
+            .replace("\n", "\\n").replace("\r", "\\r"))
+
+
+def _csv_value(value):
+    # an unquoted empty field is NULL, so every string is quoted
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if isinstance(value, str):
+        return '"' + value.replace('"', '""') + '"'
+    return str(value)
+
+
+class FileCopy:
+    # one COPY statement written into its own file <table>/<pid>-<n>.<ext>, so that
+    # concurrent workers and several COPYs of one table never share a file
+    file_numbers = itertools.count()
+
+    def __init__(self, sink_dir, query):
+        self.table_name = query.split()[1]
+        self.binary = "FORMAT BINARY" in query.upper()
+        self.encoders = None
+        # data sent with write() has its signature and trailer already
+        self.raw = False
+
+        table_dir = os.path.join(sink_dir, self.table_name)
+        os.makedirs(table_dir, exist_ok=True)
+        extension = "bin" if self.binary else file_format
+        self.path = os.path.join(table_dir, f"{os.getpid()}-{next(FileCopy.file_numbers):05d}.{extension}")
+        self.file = open(self.path, "wb")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.binary and not self.raw:
+            # the rows came with write_row, the file is ended like psycopg ends such a COPY
+            self.file.write(copy_formats.BINARY_TRAILER)
+        self.file.close()
+        if exc_type is not None:
+            os.remove(self.path)
+        return False
+
+    def set_types(self, types):
+        # rows come with write_row in the "binary" format, the signature is written here
+        self.encoders = [copy_formats.ENCODERS[t] for t in types]
+        self.file.write(copy_formats.BINARY_SIGNATURE)
+
+    def write_row(self, row):
+        if self.binary:
+            self.file.write(copy_formats.encode_rows([row], self.encoders))
+        elif file_format == "csv":
+            self.file.write((",".join(_csv_value(v) for v in row) + "\n").encode("utf-8"))
+        else:
+            self.file.write(("\t".join(_text_value(v) for v in row) + "\n").encode("utf-8"))
+
+    def write(self, data):
+        # the "binary-buffer" format encodes the rows, the signature and the trailer itself
+        self.raw = True
+        self.file.write(data)
+
+
+class FileCursor(NullCursor):
+    def __init__(self, sink_dir):
+        self.sink_dir = sink_dir
+
+    def execute(self, query, params=None):
+        # the rows of a dimension table are inserted, not copied, they go to its files too
+        super().execute(query, params)
+        if is_array_insert(query, params):
+            with FileCopy(self.sink_dir, f"COPY {query.split()[2]}") as copy:
+                for row in zip(*params):
+                    copy.write_row(row)
+        return self
+
+    def copy(self, query, params=None):
+        return FileCopy(self.sink_dir, " ".join(query.split()))
+
+
+class FileConnection(NullConnection):
+    def __init__(self, sink_dir):
+        self.sink_dir = sink_dir
+
+    def cursor(self, *args, **kwargs):
+        return FileCursor(self.sink_dir)
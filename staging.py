@@ -0,0 +1,342 @@
+import argparse
+import concurrent.futures
+import glob
+import json
+import os
+import time
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+import copy_formats
+import import_data
+import json_backend
+import metrics
+import pipeline
+import preprocess
+import progress
+import schema
+from copy_formats import copy_columns
+from dimensions import insert_rows
+from gzip_index import open_export
+from id_set import IdSet
+from utils import log_time
+
+
+# "stage" parses the exports once and writes the final rows of every table into
+# parquet files, "load" copies tables from those files without any JSON work:
+#
+#   python staging.py stage --authors authors.jsonl.gz --conversations conversations.jsonl.gz
+#   python staging.py load hashtags conversation_hashtags
+#
+# the staged rows are the ones the single pass would copy, the references are
+# checked against the conversations when they are loaded
+
+STAGE_DIR = "./staging"
+MANIFEST = "manifest.json"
+
+# rows written as one parquet row group, and at most in one file; the files of a
+# table are loaded in parallel
+ROW_GROUP_ROWS = 100000
+FILE_ROWS = 2000000
+
+ARROW_TYPES = {
+    "int8": "int64",
+    "int4": "int32",
+    "bool": "bool_",
+    "text": "string",
+    "varchar": "string",
+    "numeric": "float64",
+    # kept as the text of the export, like the importers send it
+    "timestamptz": "string",
+}
+
+
+def staged_tables():
+    # table -> copy query, the staged columns are the columns of the query
+    tables = {"authors": import_data.COPY_AUTHORS}
+    for _, table_name, copy_query in import_data.conversation_export_writers(bulk_load=True):
+        tables[table_name] = copy_query
+    return tables
+
+
+def arrow_schema(table_name, columns):
+    types = schema.column_types(table_name, columns)
+    return pa.schema([(c, getattr(pa, ARROW_TYPES[t])()) for c, t in zip(columns, types)])
+
+
+class StagedTable:
+    # collects rows like writers.TableWriter and writes them into numbered parquet files
+    def __init__(self, stage_dir, table_name, copy_query):
+        self.table_name = table_name
+        self.table_dir = os.path.join(stage_dir, table_name)
+        self.columns = copy_columns(copy_query)[1]
+        self.schema = arrow_schema(table_name, self.columns)
+        self.rows = []
+        self.files = []
+        self.file_rows = 0
+        self.writer = None
+        self.num_rows = 0
+        self.stats = pipeline.StageStats(f"stage-{table_name}")
+
+    def append(self, row):
+        self.rows.append(row)
+
+    def extend(self, rows):
+        if rows is not None:
+            self.rows.extend(rows)
+
+    def write(self, final=False):
+        if len(self.rows) < ROW_GROUP_ROWS and not (final and len(self.rows) > 0):
+            return
+
+        start = time.time()
+        rows = self.rows
+        self.rows = []
+        for offset in range(0, len(rows), ROW_GROUP_ROWS):
+            group = rows[offset:offset + ROW_GROUP_ROWS]
+            if self.writer is None:
+                os.makedirs(self.table_dir, exist_ok=True)
+                path = os.path.join(self.table_dir, f"part-{len(self.files):05d}.parquet")
+                self.writer = pq.ParquetWriter(path, self.schema, compression="zstd")
+                self.files.append(path)
+
+            columns = [list(c) for c in zip(*group)]
+            self.writer.write_table(pa.Table.from_arrays(
+                [pa.array(c, type=t) for c, t in zip(columns, self.schema.types)], schema=self.schema))
+            self.file_rows += len(group)
+            self.num_rows += len(group)
+            metrics.count_rows(self.table_name, len(group))
+
+            if self.file_rows >= FILE_ROWS:
+                self.close()
+        self.stats.busy += time.time() - start
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+            self.file_rows = 0
+
+
+class StagedTables:
+    # stands in for pipeline.PipelineWriters, the router's thread writes the files itself
+    def __init__(self, stage_dir):
+        self.stage_dir = stage_dir
+        self.writers = {}
+
+    def add_table(self, writer_name, table_name, copy_query):
+        self.writers[writer_name] = StagedTable(self.stage_dir, table_name, copy_query)
+        return self.writers[writer_name]
+
+    def __getitem__(self, writer_name):
+        return self.writers[writer_name]
+
+    def start(self):
+        pass
+
+    def check(self):
+        pass
+
+    def send(self, seq, stats):
+        for writer in self.writers.values():
+            writer.write()
+
+    def close(self, stats=None):
+        for writer in self.writers.values():
+            writer.write(final=True)
+            writer.close()
+
+    def abort(self):
+        for writer in self.writers.values():
+            writer.close()
+
+    def manifest(self):
+        return {w.table_name: {"files": [os.path.relpath(p, self.stage_dir) for p in w.files],
+                               "rows": w.num_rows, "columns": w.columns}
+                for w in self.writers.values()}
+
+
+def stage_exports(path_to_author_export, path_to_conversation_export, stage_dir=STAGE_DIR, row_range=(0, -1),
+                  log_step=1000000, num_parsers=4, chunk_lines=1000, queue_depth=8):
+    if pa is None:
+        raise ImportError("staging requires the 'pyarrow' package")
+
+    start_time = time.time()
+    for path in glob.glob(os.path.join(stage_dir, "*", "part-*.parquet")) + [os.path.join(stage_dir, MANIFEST)]:
+        if os.path.exists(path):
+            os.remove(path)
+
+    tables = StagedTables(stage_dir)
+    tables.add_table("authors", "authors", import_data.COPY_AUTHORS)
+    for writer_name, table_name, copy_query in import_data.conversation_export_writers(bulk_load=True):
+        if writer_name != "authors":
+            tables.add_table(writer_name, table_name, copy_query)
+
+    print("...Staging 'authors'...")
+    metrics.record_start("stage-authors")
+    authors_ids = IdSet()
+    with open_export(path_to_author_export) as (f, first_line):
+        it = -1
+        export_lines = progress.track("stage-authors", path_to_author_export, (0, -1), f, first_line)
+        for it, author_json_str in enumerate(export_lines, first_line):
+            author_row = preprocess.prepare_authors(json_backend.loads(author_json_str))
+            if author_row is not None and authors_ids.add(author_row[0]):
+                tables["authors"].append(author_row)
+                tables["authors"].write()
+    log_time("stage-authors", it, log_step, start_time, start_time, event="finish")
+
+    # the same router and parser processes as the pipelined import, the placeholder
+    # authors follow the rows of the authors export
+    print("...Staging all conversation tables...")
+    metrics.record_start("stage", row_range[0])
+    router = import_data.ConversationRouter(authors_ids)
+    pipeline.run_pipeline(
+        path_to_conversation_export, row_range, import_data.parse_conversation_lines,
+        lambda rows: router.route_chunk(rows, tables), tables,
+        "stage", start_time, log_step, num_parsers, chunk_lines, queue_depth)
+    router.child_rows.finish("stage")
+
+    manifest = {
+        "sources": [os.path.abspath(path_to_author_export), os.path.abspath(path_to_conversation_export)],
+        "row_range": list(row_range),
+        "tables": tables.manifest(),
+    }
+    with open(os.path.join(stage_dir, MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=1)
+
+    for table_name, table in manifest["tables"].items():
+        print(f"...Staged {table['rows']} rows of '{table_name}' in {len(table['files'])} files...")
+
+
+def read_manifest(stage_dir=STAGE_DIR):
+    path = os.path.join(stage_dir, MANIFEST)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"'{stage_dir}' holds no staged tables, run 'python staging.py stage' first")
+    with open(path) as f:
+        return json.load(f)
+
+
+def load_file(table_name, path, copy_query, batch_rows=ROW_GROUP_ROWS):
+    # runs in a worker process, one connection and one transaction per file
+    with import_data.connect() as connection:
+        with connection.cursor() as cursor:
+            parquet_file = pq.ParquetFile(path)
+            if schema.is_dimension(table_name):
+                # rows staged twice after an eviction of the dimension key cache
+                for batch in parquet_file.iter_batches(batch_size=batch_rows):
+                    rows = list(zip(*[c.to_pylist() for c in batch.columns]))
+                    insert_rows(cursor, table_name, copy_columns(copy_query)[1], rows)
+            else:
+                stream = copy_formats.CopyStream(cursor, copy_query)
+                try:
+                    for batch in parquet_file.iter_batches(batch_size=batch_rows):
+                        stream.write(list(zip(*[c.to_pylist() for c in batch.columns])))
+                except BaseException as e:
+                    stream.close(e)
+                    raise
+                stream.close()
+        connection.commit()
+    return parquet_file.metadata.num_rows
+
+
+def load_tables(table_names=None, stage_dir=STAGE_DIR, drop_table=True, bulk_load=False, unlogged=False,
+                num_workers=4):
+    if pa is None:
+        raise ImportError("loading staged tables requires the 'pyarrow' package")
+
+    start_time = time.time()
+    manifest = read_manifest(stage_dir)
+    if table_names is None or len(table_names) == 0:
+        table_names = list(manifest["tables"])
+    copy_queries = staged_tables()
+
+    # without constraints the references are checked by build_deferred_constraints,
+    # otherwise they are filtered like in the single pass once they are all copied
+    check_references = "conversation_references" in table_names and bulk_load == False
+    if check_references:
+        copy_queries["conversation_references"] = import_data.COPY_PENDING_REFERENCES
+
+    with import_data.connect() as connection:
+        with connection.cursor() as cursor:
+            if drop_table:
+                for table_name in table_names[::-1]:
+                    cursor.execute(f"DROP TABLE IF EXISTS {table_name} CASCADE")
+            for level in schema.dependency_levels(table_names):
+                import_data.create_tables(cursor, level, bulk_load, unlogged)
+            if check_references:
+                cursor.execute("DROP TABLE IF EXISTS pending_references")
+                cursor.execute(import_data.CREATE_PENDING_REFERENCES)
+        connection.commit()
+
+        metrics.record_start("load")
+        loaded_rows = 0
+
+        # the tables of one level only reference tables of the levels before
+        with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
+            for level in schema.dependency_levels(table_names):
+                jobs = [(t, os.path.join(stage_dir, p)) for t in level for p in manifest["tables"][t]["files"]]
+                with metrics.timed("load", ",".join(level)):
+                    futures = [executor.submit(load_file, t, path, copy_queries[t]) for t, path in jobs]
+                    loaded = [f.result() for f in futures]
+
+                for table_name in level:
+                    num_rows = sum(n for (t, _), n in zip(jobs, loaded) if t == table_name)
+                    metrics.count_rows(table_name, num_rows)
+                    print(f"...Loaded {num_rows} rows of '{table_name}'...")
+                loaded_rows += sum(loaded)
+
+        if check_references:
+            with connection.cursor() as cursor:
+                import_data.filter_pending_references(cursor, "load")
+            connection.commit()
+
+    # the rows loaded stand in for the lines read in the report, the last one is number loaded_rows - 1
+    log_time("load", loaded_rows - 1, max(loaded_rows, 1), start_time, start_time, event="finish")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    stage = commands.add_parser("stage", help="parse the exports once into parquet files per table")
+    stage.add_argument("--authors", required=True, help="path to authors.jsonl.gz")
+    stage.add_argument("--conversations", required=True, help="path to conversations.jsonl.gz")
+    stage.add_argument("--parsers", type=int, default=4, help="number of parser processes")
+
+    load = commands.add_parser("load", help="copy tables from the parquet files")
+    load.add_argument("tables", nargs="*", help="tables to load, all staged tables by default")
+    load.add_argument("--workers", type=int, default=4, help="files copied at the same time")
+    load.add_argument("--bulk-load", action="store_true",
+                      help="copy all tables without constraints and build them at the end")
+    load.add_argument("--unlogged", action="store_true",
+                      help="with --bulk-load, load into UNLOGGED tables and set them LOGGED at the end")
+    load.add_argument("--copy-format", choices=copy_formats.COPY_FORMATS, default=copy_formats.copy_format,
+                      help="format of the COPY data sent to postgres")
+
+    for command in [stage, load]:
+        command.add_argument("--stage-dir", default=STAGE_DIR, help="directory of the staged tables")
+    args = parser.parse_args()
+
+    # build_deferred_constraints finishes every table at once
+    if args.command == "load" and args.bulk_load and len(args.tables) > 0:
+        parser.error("--bulk-load loads all staged tables")
+
+    from dotenv import load_dotenv
+
+    load_dotenv()
+
+    if args.command == "stage":
+        stage_exports(args.authors, args.conversations, args.stage_dir, num_parsers=args.parsers)
+    else:
+        copy_formats.set_copy_format(args.copy_format)
+        load_tables(args.tables, args.stage_dir, bulk_load=args.bulk_load,
+                    unlogged=args.bulk_load and args.unlogged, num_workers=args.workers)
+        if args.bulk_load:
+            import_data.build_deferred_constraints(set_logged=args.unlogged)
+
+    metrics.print_report()
@@ -0,0 +1,29 @@
+import os
+import shutil
+import sys
+
+import pytest
+
+# the modules are imported by name from the repository root, like main.py imports them
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from generate_data import ExportGenerator
+
+
+@pytest.fixture(scope="session")
+def conversations_export(tmp_path_factory):
+    # a small conversations.jsonl.gz with repeated, invalid and edge case lines
+    out_dir = tmp_path_factory.mktemp("export")
+    return ExportGenerator(num_conversations=3000, num_authors=300, seed=7).write(str(out_dir))[1]
+
+
+@pytest.fixture(scope="session")
+def indexed_export(conversations_export, tmp_path_factory):
+    # the export with a line checkpoint every 500 lines, so that row ranges start with a seek
+    pytest.importorskip("indexed_gzip")
+    import gzip_index
+
+    path = str(tmp_path_factory.mktemp("indexed") / "conversations.jsonl.gz")
+    shutil.copy(conversations_export, path)
+    gzip_index.build_index(path, line_step=500, spacing=64 * 1024)
+    return path
@@ -0,0 +1,87 @@
+import struct
+from decimal import Decimal
+
+import pytest
+
+from copy_formats import BINARY_SIGNATURE, BINARY_TRAILER, CopyStream, ENCODERS, encode_rows
+
+# the bytes of every value are worked out from postgres' binary send functions:
+# a length, then the value; numeric is ndigits, weight, sign, dscale and base 10000 digits
+
+
+@pytest.mark.parametrize("value, expected", [
+    (0.75, "0000000a 0001 ffff 0000 0002 1d4c"),
+    (12345.678, "0000000e 0003 0001 0000 0003 0001 0929 1a7c"),
+    (Decimal("-1.5"), "0000000c 0002 0000 4000 0001 0001 1388"),
+    (0.0, "00000008 0000 0000 0000 0001"),
+    (100.0, "0000000a 0001 0000 0000 0001 0064"),
+    (float("nan"), "00000008 0000 0000 c000 0000"),
+])
+def test_numeric(value, expected):
+    assert ENCODERS["numeric"](value) == bytes.fromhex(expected)
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("2000-01-01T00:00:00.000Z", "00000008 0000000000000000"),
+    # 8090 days, 4 hours and 123 ms after 2000-01-01
+    ("2022-02-24T04:00:00.123Z", "00000008 00027bba62803078"),
+    ("2022-02-24T06:00:00.123+02:00", "00000008 00027bba62803078"),
+    ("1999-12-31T23:59:59.999Z", "00000008 fffffffffffffc18"),
+])
+def test_timestamptz(value, expected):
+    assert ENCODERS["timestamptz"](value) == bytes.fromhex(expected)
+
+
+def test_row_with_nulls():
+    encoders = [ENCODERS[t] for t in ["int8", "text", "numeric", "timestamptz"]]
+    assert encode_rows([[7, None, None, "2000-01-01T00:00:00.000Z"]], encoders) == bytes.fromhex(
+        "0004"
+        "00000008 0000000000000007"
+        "ffffffff"
+        "ffffffff"
+        "00000008 0000000000000000")
+
+
+class RecordingCopy:
+    def __init__(self, data):
+        self.data = data
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def write(self, data):
+        self.data.append(bytes(data))
+
+
+class RecordingCursor:
+    def __init__(self):
+        self.data = []
+        self.queries = []
+
+    def copy(self, query):
+        self.queries.append(query)
+        return RecordingCopy(self.data)
+
+
+def test_binary_buffer_stream_ends_with_the_trailer():
+    cursor = RecordingCursor()
+    rows = [[1, "Kyiv", "Place", 0.75], [2, "NATO", "Organization", None]]
+    stream = CopyStream(cursor, "COPY annotations (conversation_id, value, type, probability) FROM STDIN",
+                        "binary-buffer")
+    stream.write(rows)
+    stream.close()
+
+    assert cursor.queries[0].endswith("(FORMAT BINARY)")
+    encoders = [ENCODERS[t] for t in ["int8", "text", "text", "numeric"]]
+    assert b"".join(cursor.data) == BINARY_SIGNATURE + encode_rows(rows, encoders) + BINARY_TRAILER
+    assert BINARY_TRAILER == struct.pack(">h", -1)
+
+
+def test_aborted_stream_has_no_trailer():
+    cursor = RecordingCursor()
+    stream = CopyStream(cursor, "COPY links (conversation_id, url) FROM STDIN", "binary-buffer")
+    stream.close(RuntimeError("aborted"))
+    assert b"".join(cursor.data) == BINARY_SIGNATURE
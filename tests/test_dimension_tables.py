@@ -0,0 +1,69 @@
+import itertools
+import re
+import time
+
+import pytest
+
+import import_data
+import schema
+import sinks
+from id_set import IdSet
+
+
+class RecordingCursor(sinks.NullCursor):
+    def __init__(self, connection):
+        self.connection = connection
+
+    def execute(self, query, params=None):
+        self.connection.events.append((self.connection.number, " ".join(query.split())))
+        return super().execute(query, params)
+
+
+class RecordingConnection(sinks.NullConnection):
+    # the null sink, with every statement and commit of every connection in one list
+    numbers = itertools.count()
+
+    def __init__(self, events):
+        self.events = events
+        self.number = next(RecordingConnection.numbers)
+
+    def cursor(self, *args, **kwargs):
+        return RecordingCursor(self)
+
+    def commit(self):
+        self.events.append((self.number, "COMMIT"))
+
+
+def committed_before_insert(events, table_name):
+    # the connection that created the table has committed before any connection inserts into it
+    create = re.compile(rf"CREATE (UNLOGGED )?TABLE IF NOT EXISTS {table_name} \(")
+    first_insert = next(i for i, (_, query) in enumerate(events) if query.startswith(f"INSERT INTO {table_name} "))
+    created = [(i, number) for i, (number, query) in enumerate(events[:first_insert]) if create.match(query)]
+    assert len(created) > 0, f"'{table_name}' is inserted into before it is created"
+    created_at, number = created[-1]
+    return (number, "COMMIT") in events[created_at:first_insert]
+
+
+IMPORTERS = {
+    "hashtags": lambda path: import_data.import_hashtags(path, time.time(), batch_size=100),
+    "context": lambda path: import_data.import_context_domains_entities_annotations_tables(
+        path, time.time(), batch_size=100),
+    "single-pass": lambda path: import_data.import_conversation_export_single_pass(
+        path, time.time(), IdSet(), batch_size=100),
+}
+
+
+@pytest.mark.parametrize("importer_name", sorted(IMPORTERS))
+def test_dimension_tables_are_committed_before_the_first_insert(
+        importer_name, conversations_export, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    events = []
+    monkeypatch.setattr(sinks, "connect", lambda **kwargs: RecordingConnection(events))
+
+    IMPORTERS[importer_name](conversations_export)
+
+    inserted = {query.split()[2] for _, query in events if query.startswith("INSERT INTO")}
+    dimension_tables = [t for t in schema.TABLES if schema.is_dimension(t) and t in inserted]
+    assert len(dimension_tables) > 0
+    for table_name in dimension_tables:
+        assert committed_before_insert(events, table_name), table_name
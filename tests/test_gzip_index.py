@@ -0,0 +1,62 @@
+import glob
+import gzip
+import os
+import time
+from collections import Counter
+
+import import_data
+import sinks
+from gzip_index import compressed_position, open_export, shard_row_ranges
+from id_set import IdSet
+
+
+def sink_lines(sink_dir):
+    # table -> lines of all its files
+    lines = {}
+    for table_dir in glob.glob(os.path.join(sink_dir, "*")):
+        lines[os.path.basename(table_dir)] = Counter()
+        for path in glob.glob(os.path.join(table_dir, "*")):
+            with open(path, "rb") as f:
+                lines[os.path.basename(table_dir)].update(f.read().splitlines())
+    return lines
+
+
+def test_compressed_position_of_a_seek(indexed_export):
+    with open_export(indexed_export, 1200) as (f, first_line):
+        assert first_line == 1000
+        start = compressed_position(f)
+        for _ in range(1500):
+            next(f)
+        position = compressed_position(f)
+
+    with gzip.open(indexed_export) as f:
+        for _ in range(first_line):
+            next(f)
+        expected = compressed_position(f)
+
+    # the restart points are 64 kB of uncompressed data apart
+    assert 0 < start <= expected < position
+
+
+def test_sharded_import_reads_every_row_once(indexed_export, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sinks, "sink_name", "file")
+
+    # the shards skip the repeated conversations the conversation import lists
+    monkeypatch.setattr(sinks, "SINK_DIR", str(tmp_path / "conversations"))
+    import_data.import_conversation_table(indexed_export, time.time(), IdSet(), batch_size=100)
+
+    monkeypatch.setattr(sinks, "SINK_DIR", str(tmp_path / "unsharded"))
+    import_data.import_hashtags(indexed_export, time.time(), batch_size=100)
+
+    row_ranges = shard_row_ranges(indexed_export, 3)
+    assert row_ranges == [(0, 1000), (1000, 2000), (2000, -1)]
+    monkeypatch.setattr(sinks, "SINK_DIR", str(tmp_path / "sharded"))
+    for row_range in row_ranges:
+        import_data.import_hashtags(indexed_export, time.time(), row_range=row_range, batch_size=100)
+
+    unsharded, sharded = sink_lines(tmp_path / "unsharded"), sink_lines(tmp_path / "sharded")
+    assert sum(unsharded["conversation_hashtags"].values()) > 0
+    assert sharded["conversation_hashtags"] == unsharded["conversation_hashtags"]
+    # every shard inserts the keys it sees, the file sink keeps the repeated ones
+    assert set(sharded["hashtags"]) == set(unsharded["hashtags"])
@@ -0,0 +1,64 @@
+import os
+
+import numpy as np
+
+from id_set import IdSet, MappedIdSet, is_mapped, merge_runs, save_ids
+
+
+def random_batches(rng, num_batches, batch_size, high):
+    # ids repeat inside a batch and across batches, negative ids included
+    return [rng.integers(-high, high, size=batch_size) for _ in range(num_batches)]
+
+
+def test_add_and_test_matches_a_set(tmp_path):
+    rng = np.random.default_rng(3)
+    ids = IdSet(buffer_size=50)
+    expected = set()
+
+    for i, batch in enumerate(random_batches(rng, 40, 300, 5000)):
+        mask = ids.add_and_test(batch)
+
+        first_new = []
+        for new_id in batch.tolist():
+            first_new.append(new_id not in expected)
+            expected.add(new_id)
+        assert mask.tolist() == first_new
+
+        # single ids go through the python buffer
+        for new_id in rng.integers(-5000, 5000, size=20).tolist():
+            assert ids.add(new_id) == (new_id not in expected)
+            expected.add(new_id)
+
+        if i % 10 == 9:
+            ids.spill(str(tmp_path))
+            # merged with the file of the earlier spill, which is gone
+            assert is_mapped(ids.runs[0])
+            assert os.listdir(tmp_path) == [os.path.basename(ids.runs[0].filename)]
+
+        assert len(ids) == len(expected)
+
+    probe = np.arange(-5000, 5000)
+    assert ids.contains_many(probe).tolist() == [i in expected for i in probe.tolist()]
+    assert all((i in ids) == (i in expected) for i in range(-5000, 5000, 7))
+    assert ids.to_array().tolist() == sorted(expected)
+
+
+def test_merge_runs_is_sorted_and_unique(tmp_path):
+    rng = np.random.default_rng(5)
+    values = rng.choice(np.arange(-10**6, 10**6), size=20000, replace=False)
+    parts = np.array_split(rng.permutation(values), 4)
+
+    paths = []
+    for i, part in enumerate(parts):
+        paths.append(str(tmp_path / f"run-{i}.npy"))
+        save_ids(paths[-1], np.sort(part))
+
+    # blocks much smaller than the runs, the merge takes several steps
+    path = str(tmp_path / "merged.npy")
+    merge_runs(paths, path, block_size=97)
+
+    merged = MappedIdSet(path)
+    assert len(merged) == len(values)
+    assert np.all(np.diff(merged.ids) > 0)
+    assert merged.ids.tolist() == sorted(values.tolist())
+    assert merged.contains_many(values).all()
@@ -0,0 +1,13 @@
+import metrics
+
+
+def test_rows_per_s_counts_the_lines_of_the_last_block(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    metrics.record_start("hashtags", 100)
+    metrics.record_checkpoint("hashtags", 1000, 10.0, 1000, 2.0)
+    metrics.record_checkpoint("hashtags", 2000, 12.0, 1000, 2.0)
+    # 250 lines in the last half second, not log_step
+    metrics.record_checkpoint("hashtags", 2250, 12.5, 1000, 0.5, event="finish")
+
+    events = [e for e in metrics.read_events() if e["table"] == "hashtags" and e["event"] != "start"]
+    assert [e["rows_per_s"] for e in events] == [450.5, 500.0, 500.0]
@@ -0,0 +1,27 @@
+import gzip
+
+import progress
+from gzip_index import open_export
+
+
+def test_track_a_seek_into_an_indexed_export(indexed_export, tmp_path, monkeypatch):
+    # a shard that starts after a seek, read the way the importers read it
+    monkeypatch.chdir(tmp_path)
+    row_range = (1200, 2200)
+    lines = []
+    with open_export(indexed_export, row_range[0]) as (f, first_line):
+        assert first_line == 1000
+        for it, line in enumerate(progress.track("hashtags", indexed_export, row_range, f, first_line), first_line):
+            if it < row_range[0]:
+                continue
+            if it >= row_range[1]:
+                break
+            lines.append(line)
+
+    with gzip.open(indexed_export) as f:
+        assert lines == f.readlines()[row_range[0]:row_range[1]]
+
+    [status] = progress.read_statuses()
+    assert status["job"] == "hashtags-1200"
+    assert status["finished"]
+    assert (status["unit"], status["done"], status["total"]) == ("lines", 1000, 1000)
@@ -0,0 +1,100 @@
+import glob
+import os
+import time
+from collections import Counter
+
+import pytest
+
+import checkpoints
+import import_data
+import sinks
+from id_set import IdSet
+
+
+class Stopped(Exception):
+    pass
+
+
+class CheckpointFileCursor(sinks.FileCursor):
+    # the file sink with the import_checkpoints table the database would keep; a file
+    # is written at once, so a checkpoint is committed as soon as it is upserted
+    checkpoints = {}
+
+    def __init__(self, sink_dir):
+        super().__init__(sink_dir)
+        self.row = None
+
+    def execute(self, query, params=None):
+        self.row = None
+        if "import_checkpoints" in query and params is not None:
+            if query.lstrip().startswith("INSERT"):
+                CheckpointFileCursor.checkpoints[params[0]] = params[1:4]
+            else:
+                self.row = CheckpointFileCursor.checkpoints.get(params[0])
+            return self
+        return super().execute(query, params)
+
+    def fetchone(self):
+        return self.row
+
+
+@pytest.fixture
+def file_sink(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    # every flush is committed, so a checkpoint is taken as soon as checkpoint_step lines are read
+    monkeypatch.setenv("PDT_COMMIT_SECONDS", "0")
+    monkeypatch.setattr(sinks, "sink_name", "file")
+    monkeypatch.setattr(sinks, "FileCursor", CheckpointFileCursor)
+    monkeypatch.setattr(CheckpointFileCursor, "checkpoints", {})
+
+    def use_dir(name):
+        monkeypatch.setattr(sinks, "SINK_DIR", str(tmp_path / name))
+        return tmp_path / name
+    return use_dir
+
+
+def sink_rows(sink_dir):
+    # table -> lines of all its files, the files of one table are loaded in any order
+    rows = {}
+    for table_dir in sorted(glob.glob(os.path.join(sink_dir, "*"))):
+        lines = Counter()
+        for path in glob.glob(os.path.join(table_dir, "*")):
+            with open(path, "rb") as f:
+                lines.update(f.read().splitlines())
+        rows[os.path.basename(table_dir)] = lines
+    return rows
+
+
+def single_pass(path, checkpoint_step=None):
+    return import_data.import_conversation_export_single_pass(
+        path, time.time(), IdSet(), drop_table=False, batch_size=100, checkpoint_step=checkpoint_step)
+
+
+def test_single_pass_resumed_from_checkpoint(conversations_export, file_sink, monkeypatch):
+    complete_dir = file_sink("complete")
+    single_pass(conversations_export)
+
+    # the import is killed right after its second checkpoint
+    resumed_dir = file_sink("resumed")
+    save = checkpoints.Checkpointer.save
+    saves = []
+
+    def save_and_stop(self, next_line, state, finished=False):
+        save(self, next_line, state, finished)
+        saves.append(next_line)
+        if len(saves) == 2 and not finished:
+            raise Stopped()
+
+    monkeypatch.setattr(checkpoints.Checkpointer, "save", save_and_stop)
+    with pytest.raises(Stopped):
+        single_pass(conversations_export, checkpoint_step=500)
+    assert 0 < saves[-1] < 3000
+
+    all_ids = single_pass(conversations_export, checkpoint_step=500)
+    assert CheckpointFileCursor.checkpoints["single-pass"][2] is True
+
+    complete, resumed = sink_rows(complete_dir), sink_rows(resumed_dir)
+    assert sorted(resumed) == sorted(complete)
+    for table_name in complete:
+        assert resumed[table_name] == complete[table_name], table_name
+    assert len(all_ids) == sum(complete["conversations"].values())
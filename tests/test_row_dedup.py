@@ -0,0 +1,55 @@
+import os
+import pickle
+import random
+
+from row_dedup import RowDedup
+
+
+def annotation_rows(rng, num_rows):
+    # conversation_id, value, type, probability, start, end; a few values only, so that
+    # rows repeat and rows differing in a single column are common
+    return [[rng.randrange(30), rng.choice(["Kyiv", "NATO"]), "Place", rng.choice([0.5, 0.75, None]),
+             rng.randrange(3), 10] for _ in range(num_rows)]
+
+
+def keep_first(rows, seen):
+    kept = []
+    for row in rows:
+        if tuple(row) not in seen:
+            seen.add(tuple(row))
+            kept.append(row)
+    return kept
+
+
+def test_filter_keeps_every_distinct_row(tmp_path):
+    rng = random.Random(1)
+    dedup = RowDedup("annotations", memory_budget=2**20, dedup_dir=str(tmp_path))
+    seen = set()
+    for _ in range(5):
+        rows = annotation_rows(rng, 400)
+        assert dedup.filter(rows) == keep_first(rows, seen)
+    assert dedup.kept == len(seen) == len(dedup)
+
+
+def test_pickle_round_trip_after_spill(tmp_path):
+    rng = random.Random(2)
+    # a budget of one byte spills the hashes after every batch
+    dedup = RowDedup("annotations", memory_budget=1, dedup_dir=str(tmp_path))
+    seen = set()
+    for _ in range(6):
+        rows = annotation_rows(rng, 300)
+        assert dedup.filter(rows) == keep_first(rows, seen)
+    assert dedup.spills == 6 and len(dedup.runs) > 0
+
+    state = pickle.dumps(dedup)
+    # the runs the checkpoint was taken with are merged or removed by the time an import resumes
+    dedup.close()
+    assert os.listdir(tmp_path) == []
+
+    resumed = pickle.loads(state)
+    assert len(resumed) == len(seen)
+    assert all(os.path.exists(run.path) for run in resumed.runs)
+    for _ in range(3):
+        rows = annotation_rows(rng, 300)
+        assert resumed.filter(rows) == keep_first(rows, seen)
+    resumed.close()
@@ -1,8 +1,10 @@
 import time
 import os
-import pandas as pd
 from datetime import datetime
 
+import copy_formats
+import metrics
+
 
 def exists(obj, attr, is_id=False):
     if attr in obj.keys() and obj[attr] is not None:
@@ -12,7 +14,7 @@ def exists(obj, attr, is_id=False):
     return False
 
 
-def make_string_valid(string):
+def _make_string_valid(string):
     string = (str(string)
               .encode("utf-8")
               .decode("utf-8", errors="replace")
@@ -21,26 +23,48 @@ def make_string_valid(string):
     return string
 
 
-def exists_same_row(prior_rows, new_row):
-    for row in prior_rows:
-        eq_num = [r == new_r for r, new_r in zip(row, new_row)]
-        if sum(eq_num) == len(row):
-            return True
+def _is_clean(string):
+    # True when _make_string_valid would return the string unchanged: no NUL and no
+    # lone surrogate, which cannot be encoded (and makes _make_string_valid fail)
+    if "\x00" in string:
+        return False
+    if string.isascii():
+        return True
+    try:
+        string.encode("utf-8")
+    except UnicodeEncodeError:
+        return False
+    return True
 
-    return False
+
+def make_string_valid(string):
+    # almost every string of the exports is valid already and is returned as it is,
+    # the rest (and values that are not strings) get the full conversion
+    if type(string) is str and _is_clean(string):
+        return string
+    return _make_string_valid(string)
 
 
-def log_time(table_name, it, log_step, start_time, prev_block_time, log_to_console=True):
+def make_strings_valid(values):
+    # make_string_valid for a whole column, None stays None; one check of the joined
+    # column finds out whether any of the strings needs the conversion
+    if set(map(type, values)) <= {str} and _is_clean("".join(values)):
+        return list(values)
+    return [None if v is None else make_string_valid(v) for v in values]
+
+
+def log_time(table_name, it, log_step, start_time, prev_block_time, log_to_console=True,
+             bytes_read=None, event="checkpoint"):
     current_time = datetime.now().isoformat()
     t_idx = current_time.find("T")
     current_time = current_time[:t_idx+6] + "Z"
     
     time_checkpoint = time.time()
-    elapsed_time = time_checkpoint - start_time
-    block_time = time_checkpoint - prev_block_time  
+    elapsed_seconds = time_checkpoint - start_time
+    block_seconds = time_checkpoint - prev_block_time
 
-    elapsed_time = format_duration(elapsed_time)
-    block_time = format_duration(block_time)
+    elapsed_time = format_duration(elapsed_seconds)
+    block_time = format_duration(block_seconds)
 
     pid = os.getpid()
 
@@ -50,17 +74,12 @@ def log_time(table_name, it, log_step, start_time, prev_block_time, log_to_conso
     
     os.makedirs("./logs", exist_ok=True)
 
-    try:
-        df = pd.read_csv(f"./logs/{table_name}.csv", sep=";", header=None)
-    except:
-        df = pd.DataFrame(columns=["date", "all-time", "block-time"])
+    # appending a single line is safe when several workers log at once
+    with open(f"./logs/{table_name}.csv", "a") as f:
+        f.write(f"{current_time};{elapsed_time};{block_time}\n")
 
-    df.loc[len(df.index)] = [
-        current_time,
-        elapsed_time,
-        block_time
-    ]
-    df.to_csv(f"./logs/{table_name}.csv", sep=";", index=False, header=False)
+    metrics.record_checkpoint(table_name, it, elapsed_seconds, log_step, block_seconds,
+                              bytes_read=bytes_read, event=event)
 
     return time_checkpoint
 
@@ -72,24 +91,25 @@ def format_duration(duration):
     return f"{mins:02d}:{secs:02d}"
 
 def not_duplicate(all_ids, new_id, cast_to_int=True):
-    len_ids = len(all_ids.keys())
-    
     if cast_to_int:
-        all_ids[int(new_id)] = "1"
-    else:
-        all_ids[new_id] = "1"
+        new_id = int(new_id)
 
-    new_len_ids = len(all_ids.keys())
+    if new_id in all_ids:
+        return False
 
-    return len_ids != new_len_ids
+    all_ids[new_id] = "1"
+    return True
+
+
+def unique_rows(id_set, rows, id_idx=0):
+    # keeps the rows whose id was not seen yet, testing the whole batch at once
+    is_new = id_set.add_and_test([row[id_idx] for row in rows])
+    return [row for row, new in zip(rows, is_new) if new]
 
 
 def copy_data_to_table(cursor, query_str, data):
     if len(data) == 0:
         return []
     
-    with cursor.copy(query_str) as copy:
-        for record in data:
-            copy.write_row(record)
-
+    copy_formats.copy_rows(cursor, query_str, data)
     return []
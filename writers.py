@@ -0,0 +1,268 @@
+import os
+import time
+from collections import Counter
+
+import memory
+import metrics
+import profiling
+import progress
+from copy_formats import CopyStream
+
+
+# rows between two samples of the row size a writer estimates its buffer with
+SAMPLE_EVERY = 64
+
+
+def estimate_row_bytes(row):
+    # rough size of a row in the COPY data, strings by length and anything else as 8 bytes
+    return sum(len(v) if isinstance(v, str) else 8 for v in row) + len(row)
+
+
+class FlushPolicy:
+    # a flush sends the buffered rows into the open COPY streams, a commit ends the
+    # streams and the transaction; every limit can be set per deployment through the
+    # PDT_FLUSH_* variables (main.py sets them from its command line)
+    def __init__(self, max_rows=1000, max_bytes=8 * 2**20, max_seconds=5.0,
+                 commit_bytes=64 * 2**20, commit_seconds=30.0, memory_budget=256 * 2**20):
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.commit_bytes = commit_bytes
+        self.commit_seconds = commit_seconds
+        self.memory_budget = memory_budget
+
+    @classmethod
+    def from_env(cls, max_rows=1000):
+        def env(name, default, scale=1):
+            value = os.getenv(name)
+            return default if value in (None, "") else type(default)(float(value) * scale)
+
+        default = cls(max_rows)
+        return cls(
+            max_rows=env("PDT_FLUSH_ROWS", default.max_rows),
+            max_bytes=env("PDT_FLUSH_MB", default.max_bytes, 2**20),
+            max_seconds=env("PDT_FLUSH_SECONDS", default.max_seconds),
+            commit_bytes=env("PDT_COMMIT_MB", default.commit_bytes, 2**20),
+            commit_seconds=env("PDT_COMMIT_SECONDS", default.commit_seconds),
+            memory_budget=env("PDT_MEMORY_BUDGET_MB", default.memory_budget, 2**20),
+        )
+
+
+class TableWriter:
+    # keeps_stream: the writer leaves a COPY open on the group's connection between flushes
+    keeps_stream = True
+
+    def __init__(self, cursor, copy_query):
+        self.cursor = cursor
+        self.copy_query = copy_query
+        self.rows = []
+        self.stream = None
+
+        self.row_bytes = 0.0
+        self.sampled_rows = 0
+        self.until_sample = 1
+
+        self.flushes = 0
+        self.flushed_rows = 0
+        self.flushed_bytes = 0
+        self.largest_flush = 0
+
+    def append(self, row):
+        self.rows.append(row)
+        self.until_sample -= 1
+        if self.until_sample <= 0:
+            self.sample(row)
+
+    def extend(self, rows):
+        if rows is not None and len(rows) > 0:
+            self.rows.extend(rows)
+            self.until_sample -= len(rows)
+            if self.until_sample <= 0:
+                self.sample(rows[-1])
+
+    def sample(self, row):
+        self.row_bytes += (estimate_row_bytes(row) - self.row_bytes) / (self.sampled_rows + 1)
+        self.sampled_rows += 1
+        self.until_sample = SAMPLE_EVERY
+
+    def buffered_bytes(self):
+        return len(self.rows) * self.row_bytes
+
+    def flush(self):
+        # returns the estimated size of the rows sent
+        if len(self.rows) == 0:
+            return 0
+
+        self.write(self.rows)
+
+        size = int(self.buffered_bytes())
+        self.flushes += 1
+        self.flushed_rows += len(self.rows)
+        self.flushed_bytes += size
+        self.largest_flush = max(self.largest_flush, len(self.rows))
+        self.rows = []
+        return size
+
+    def write(self, rows):
+        if self.stream is None:
+            self.stream = CopyStream(self.cursor, self.copy_query)
+        try:
+            self.stream.write(rows)
+        except BaseException as e:
+            self.stream.close(e)
+            self.stream = None
+            raise
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+
+
+class WriterGroup:
+    # writers are flushed together and in insertion order, so that rows referenced
+    # by a foreign key are always copied before the rows referencing them;
+    # a connection runs one COPY at a time, so a writer's stream stays open across
+    # flushes until another writer of the group has rows to send or the group commits;
+    # before_flush() can still change the buffered rows, e.g. drop duplicates in one go
+    def __init__(self, cursor, batch_size=1000, policy=None, before_flush=None):
+        self.cursor = cursor
+        self.policy = FlushPolicy.from_env(batch_size) if policy is None else policy
+        self.before_flush = before_flush
+        self.writers = {}
+        self.open_writer = None
+
+        self.flush_reason = None
+        self.flush_reasons = Counter()
+        self.commits = 0
+        self.uncommitted_bytes = 0
+        self.last_flush = time.time()
+        self.last_commit = time.time()
+        # the importers time their own stages with it too, recorded by finish()
+        self.stages = profiling.StageTimer()
+        # the importers track their id sets and caches in it next to the buffers
+        self.memory = memory.Accounting()
+
+    def add_table(self, table_name, copy_query):
+        return self.add_writer(table_name, TableWriter(self.cursor, copy_query))
+
+    def add_writer(self, name, writer):
+        self.writers[name] = writer
+        self.memory.track(f"buffer-{name}", writer, writer.buffered_bytes)
+        return writer
+
+    def __getitem__(self, table_name):
+        return self.writers[table_name]
+
+    def needs_flush(self):
+        if self.memory.over_budget():
+            self.flush_reason = "worker-memory"
+            return True
+
+        policy = self.policy
+        buffered = 0
+        for writer in self.writers.values():
+            if len(writer.rows) >= policy.max_rows:
+                self.flush_reason = "rows"
+                return True
+            size = writer.buffered_bytes()
+            if size >= policy.max_bytes:
+                self.flush_reason = "bytes"
+                return True
+            buffered += size
+
+        if buffered >= policy.memory_budget:
+            self.flush_reason = "memory"
+            return True
+        if buffered > 0 and time.time() - self.last_flush >= policy.max_seconds:
+            self.flush_reason = "time"
+            return True
+        return False
+
+    def needs_commit(self):
+        return (self.uncommitted_bytes >= self.policy.commit_bytes
+                or time.time() - self.last_commit >= self.policy.commit_seconds)
+
+    def flush(self):
+        start = time.time()
+        if self.before_flush is not None:
+            stage_start = time.perf_counter()
+            num_rows = sum(len(writer.rows) for writer in self.writers.values())
+            self.before_flush()
+            self.stages.lap("dedup", stage_start, num_rows)
+
+        flushed = False
+        stage_start = time.perf_counter()
+        for writer in self.writers.values():
+            if len(writer.rows) == 0:
+                continue
+            if writer.keeps_stream and self.open_writer is not writer:
+                self.close()
+                self.open_writer = writer
+            num_rows = len(writer.rows)
+            self.uncommitted_bytes += writer.flush()
+            stage_start = self.stages.lap("copy", stage_start, num_rows)
+            flushed = True
+
+        if flushed:
+            self.flush_reasons[self.flush_reason or "final"] += 1
+            progress.record_flush(time.time() - start)
+        self.flush_reason = None
+        self.last_flush = time.time()
+
+    def close(self):
+        # ends the open COPY, needed before any other statement on the connection
+        if self.open_writer is not None:
+            self.open_writer.close()
+            self.open_writer = None
+
+    def maybe_flush(self, commit):
+        # commit() is called with the streams closed, the importers pass their checkpointer
+        if not self.needs_flush():
+            return False
+
+        # over the memory budget the rows go out of the client's buffers before anything is spilled
+        over_budget = self.flush_reason == "worker-memory"
+        self.flush()
+        if over_budget or self.needs_commit():
+            self.close()
+            stage_start = time.perf_counter()
+            commit()
+            self.stages.lap("commit", stage_start)
+            self.commits += 1
+            self.uncommitted_bytes = 0
+            self.last_commit = time.time()
+        if over_budget:
+            self.memory.relieve()
+        return True
+
+    def finish(self, table_name):
+        # flushes what is left and closes the streams, the final commit is up to the caller
+        self.flush()
+        self.close()
+        for writer in self.writers.values():
+            writer.close()
+        self.report(table_name)
+        self.stages.finish(table_name)
+        self.memory.report(table_name)
+
+    def report(self, table_name):
+        written = {name: w for name, w in self.writers.items() if w.flushes > 0}
+
+        for name, writer in written.items():
+            print(f"...Flushed '{name}' {writer.flushes} times, {writer.flushed_rows / writer.flushes:,.0f} rows "
+                  f"(~{writer.flushed_bytes / writer.flushes / 2**10:,.0f} kB) on average, "
+                  f"at most {writer.largest_flush:,} rows...")
+        if len(written) > 0:
+            reasons = ", ".join(f"{reason}: {n}" for reason, n in self.flush_reasons.most_common())
+            print(f"...{sum(self.flush_reasons.values())} flushes of '{table_name}' ({reasons}), "
+                  f"{self.commits + 1} commits...")
+
+        metrics.record(
+            "flushes",
+            table_name,
+            writers={name: {"flushes": w.flushes, "rows": w.flushed_rows, "bytes": w.flushed_bytes,
+                            "largest": w.largest_flush} for name, w in written.items()},
+            reasons=dict(self.flush_reasons),
+            commits=self.commits + 1,
+        )